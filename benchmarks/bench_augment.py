@@ -0,0 +1,183 @@
+""" Throughput, peak memory and per-stage time of the question perturbations and of SQuADDataset.generate
+
+Each case runs on the questions of a SQuAD-like file, and on synthetic corpora which repeat its
+articles `scale` times with new question IDs. Cases run with fixed seeds, each in a new process by
+default, and the results are written to a JSON report which `compare.py` diffs against a report of
+another commit.
+
+    python benchmarks/bench_augment.py --scales 1 100 --output augment.json
+"""
+import argparse
+import json
+import time
+
+import pkg_resources
+
+from bench_utils import StageTimer, latency_stats, run_case, run_isolated, scale_corpus, set_seed, write_report
+
+PERTURBATION_CASES = ['drop', 'repeat', 'synonym', 'misspelling', 'mlmsynonym']
+CASES = PERTURBATION_CASES + ['squad_generate']
+
+
+def _questions(examples: dict) -> list:
+    return [qa['question'] for article in examples['data'] for paragraph in article['paragraphs'] for qa in paragraph['qas']]
+
+
+def _get_perturbation(case: str, use_ner: bool):
+    """ The perturbation of a case, as a function of (question, num_terms, num_output_sents) """
+    from kitanaqa.augment.term_replacement import DropTerms, RepeatTerms, ReplaceTerms
+    if case == 'drop':
+        drop = DropTerms()
+        return lambda question, num_terms, num_output_sents: drop.drop_terms(
+            question, num_terms=num_terms, num_output_sents=num_output_sents)
+    if case == 'repeat':
+        repeat = RepeatTerms()
+        return lambda question, num_terms, num_output_sents: repeat.repeat_terms(
+            question, num_terms=num_terms, num_output_sents=num_output_sents)
+    replace = ReplaceTerms(rep_type=case, use_ner=use_ner)
+    return lambda question, num_terms, num_output_sents: replace.replace_terms(
+        sentence=question, num_replacements=num_terms, num_output_sents=num_output_sents)
+
+
+def bench_perturbation(case: str, examples: dict, args) -> dict:
+    """ Perturbs every question of examples once, timing each call """
+    timer = StageTimer()
+    with timer.stage('import'):
+        import kitanaqa.augment.term_replacement
+    with timer.stage('init'):
+        perturb = _get_perturbation(case, args.use_ner)
+
+    questions = _questions(examples)
+    set_seed(args.seed)
+    latencies = []
+    num_outputs = 0
+    for question in questions:
+        start = time.perf_counter()
+        num_outputs += len(perturb(question, args.num_replacements, args.num_output_sents))
+        latencies.append(time.perf_counter() - start)
+    timer.add('perturb', sum(latencies))
+
+    perturb_time = timer.times['perturb']
+    return {
+        'metrics': {
+            'num_questions': len(questions),
+            'num_outputs': num_outputs,
+            'examples_per_s': len(questions) / perturb_time if perturb_time else None,
+            'outputs_per_s': num_outputs / perturb_time if perturb_time else None,
+            'init_s': timer.times['init'],
+        },
+        'latency_ms': latency_stats(latencies),
+        'stages': timer.report(),
+    }
+
+
+def bench_generate(examples: dict, args) -> dict:
+    """ Generates an augmented training set, timing each perturbation type and the SQuAD formatting """
+    timer = StageTimer()
+    with timer.stage('import'):
+        from kitanaqa.augment import augment_squad
+    augment_squad.format_squad = timer.wrap('format_squad', augment_squad.format_squad)
+
+    set_seed(args.seed)
+    with timer.stage('init'):
+        dataset = augment_squad.SQuADDataset(
+            examples,
+            is_training=True,
+            sample_ratio=args.sample_ratio,
+            num_replacements=args.num_replacements,
+            sampling_strategy=args.sampling_strategy,
+            # No checkpoint is written during the run
+            save_freq=len(_questions(examples)) + 1)
+    # The drop perturbation added to each replacement is timed as drop
+    drop = dataset.augmentation_types['drop']
+    drop.drop_terms = timer.wrap('drop', drop.drop_terms)
+    for aug_type in ['synonym', 'misspelling']:
+        replace = dataset.augmentation_types[aug_type]
+        replace.replace_terms = timer.wrap(aug_type, replace.replace_terms)
+
+    with timer.stage('generate'):
+        dataset.generate()
+
+    generate_time = timer.times['generate']
+    return {
+        'metrics': {
+            'num_questions': len(dataset.examples),
+            'num_outputs': len(dataset.dataset),
+            'examples_per_s': len(dataset.examples) / generate_time if generate_time else None,
+            'outputs_per_s': len(dataset.dataset) / generate_time if generate_time else None,
+            'init_s': timer.times['init'],
+        },
+        'stages': timer.report(),
+    }
+
+
+def run(case: str, scale: int, args) -> dict:
+    with open(args.data_file, 'r') as f:
+        examples = scale_corpus(json.load(f), scale)
+    if case == 'squad_generate':
+        return bench_generate(examples, args)
+    return bench_perturbation(case, examples, args)
+
+
+def _case_args(args, case: str, scale: int) -> list:
+    """ The command line of the process running a case """
+    case_args = [
+        '--case', case,
+        '--scale', str(scale),
+        '--data_file', args.data_file,
+        '--seed', str(args.seed),
+        '--num_replacements', str(args.num_replacements),
+        '--num_output_sents', str(args.num_output_sents),
+        '--sample_ratio', str(args.sample_ratio),
+        '--sampling_strategy', args.sampling_strategy,
+    ]
+    if args.use_ner:
+        case_args.append('--use_ner')
+    return case_args
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--data_file', default=pkg_resources.resource_filename('kitanaqa', 'support/unittest-squad.json'),
+                        help='SQuAD-like file whose questions are perturbed.')
+    parser.add_argument('--scales', type=int, nargs='+', default=[1, 100],
+                        help='Number of times the articles of data_file are repeated in each corpus.')
+    parser.add_argument('--cases', nargs='+', default=CASES, choices=CASES)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--num_replacements', type=int, default=2)
+    parser.add_argument('--num_output_sents', type=int, default=1)
+    parser.add_argument('--sample_ratio', type=float, default=1.)
+    parser.add_argument('--sampling_strategy', default='random')
+    parser.add_argument('--use_ner', action='store_true', help='Use entity-aware replacement, if spark-nlp is installed.')
+    parser.add_argument('--no_isolate', action='store_true',
+                        help='Run every case in this process. Peak RSS is then the peak of all the cases run so far.')
+    parser.add_argument('--timeout', type=float, default=None, help='Timeout of each case, in seconds.')
+    parser.add_argument('--output', default='benchmark_augment.json')
+    # Set when a case runs in its own process
+    parser.add_argument('--case', choices=CASES, help=argparse.SUPPRESS)
+    parser.add_argument('--scale', type=int, help=argparse.SUPPRESS)
+    parser.add_argument('--result_file', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.result_file:
+        with open(args.result_file, 'w') as f:
+            json.dump(run_case(run, args.case, args.scale, args), f)
+        return
+
+    results = []
+    for scale in args.scales:
+        for case in args.cases:
+            if args.no_isolate:
+                result = run_case(run, case, scale, args)
+            else:
+                result = run_isolated(__file__, _case_args(args, case, scale), timeout=args.timeout)
+            result = dict(name='{}/scale={}'.format(case, scale), case=case, scale=scale, **result)
+            print(json.dumps({k: result[k] for k in ['name', 'metrics', 'peak_rss_mb', 'error'] if k in result}))
+            results.append(result)
+
+    config = {k: v for k, v in vars(args).items() if k not in ['case', 'scale', 'result_file']}
+    write_report(args.output, 'augment', config, results)
+
+
+if __name__ == '__main__':
+    main()
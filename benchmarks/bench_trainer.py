@@ -0,0 +1,423 @@
+""" Featurisation throughput, training step latency and evaluation time of tiny randomly initialised models
+
+Models are small BERT, DistilBERT and ALBERT configs built locally, and the data is tokenised with
+a WordPiece vocabulary built from the corpus, so nothing is downloaded. Everything runs on CPU.
+The normal training step is timed alongside the ALUM step at each K, and adversarial evaluation
+at each K, so the cost of the adversarial steps can be read relative to the normal ones.
+Featurisation is timed on `support/unittest-squad.json` and on synthetic corpora repeating its
+articles `scale` times. Cases run with fixed seeds, each in a new process by default, and the
+results are written to a JSON report which `compare.py` diffs against a report of another commit.
+
+    python benchmarks/bench_trainer.py --model_types bert distilbert albert --K 1 2 3 --output trainer.json
+"""
+import argparse
+import collections
+import json
+import os
+import tempfile
+import time
+
+# No GPU and no network: the models, tokenizer and data are all local
+os.environ['CUDA_VISIBLE_DEVICES'] = ''
+os.environ['TRANSFORMERS_OFFLINE'] = '1'
+
+import pkg_resources
+
+from bench_utils import StageTimer, latency_stats, run_case, run_isolated, scale_corpus, set_seed, write_report
+
+MODEL_TYPES = ['bert', 'distilbert', 'albert']
+# Cases run once for each corpus scale
+DATA_CASES = ['featurize', 'featurize_fast', 'load_and_cache_examples']
+# Cases run once for each model type
+MODEL_CASES = ['train_step', 'evaluate', 'adv_evaluate']
+CASES = DATA_CASES + MODEL_CASES
+SPECIAL_TOKENS = ['[PAD]', '[UNK]', '[CLS]', '[SEP]', '[MASK]']
+
+
+def build_vocab(examples: dict, path: str, max_words: int=5000) -> str:
+    """Writes a WordPiece vocabulary of the most frequent words of a corpus, and of its characters as word
+    pieces, so that every word can be tokenised and the rarer words are split into several pieces
+    """
+    from transformers.tokenization_bert import BasicTokenizer
+    basic_tokenizer = BasicTokenizer(do_lower_case=True)
+    counts = collections.Counter()
+    for article in examples['data']:
+        for paragraph in article['paragraphs']:
+            texts = [paragraph['context']] + [qa['question'] for qa in paragraph['qas']]
+            for text in texts:
+                counts.update(basic_tokenizer.tokenize(text))
+    chars = sorted(set(''.join(counts)))
+    words = [word for word, _ in counts.most_common(max_words) if len(word) > 1]
+    vocab = list(collections.OrderedDict.fromkeys(SPECIAL_TOKENS + chars + ['##' + c for c in chars] + words))
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write('\n'.join(vocab) + '\n')
+    return path
+
+
+def build_model(model_type: str, vocab_size: int, args):
+    """ A randomly initialised question answering model of the given type """
+    from transformers import (
+        AlbertConfig,
+        AlbertForQuestionAnswering,
+        BertConfig,
+        BertForQuestionAnswering,
+        DistilBertConfig,
+        DistilBertForQuestionAnswering,
+    )
+    set_seed(args.seed)
+    if model_type == 'bert':
+        config = BertConfig(
+            vocab_size=vocab_size,
+            hidden_size=args.hidden_size,
+            num_hidden_layers=args.num_layers,
+            num_attention_heads=args.num_heads,
+            intermediate_size=4 * args.hidden_size,
+            max_position_embeddings=args.max_seq_length)
+        return BertForQuestionAnswering(config)
+    if model_type == 'distilbert':
+        config = DistilBertConfig(
+            vocab_size=vocab_size,
+            dim=args.hidden_size,
+            n_layers=args.num_layers,
+            n_heads=args.num_heads,
+            hidden_dim=4 * args.hidden_size,
+            max_position_embeddings=args.max_seq_length)
+        return DistilBertForQuestionAnswering(config)
+    if model_type == 'albert':
+        config = AlbertConfig(
+            vocab_size=vocab_size,
+            embedding_size=max(16, args.hidden_size // 2),
+            hidden_size=args.hidden_size,
+            num_hidden_layers=args.num_layers,
+            num_attention_heads=args.num_heads,
+            intermediate_size=4 * args.hidden_size,
+            max_position_embeddings=args.max_seq_length)
+        return AlbertForQuestionAnswering(config)
+    raise ValueError('model_type should be one of {}'.format(', '.join(MODEL_TYPES)))
+
+
+class Workspace():
+    """ The corpus, vocabulary, tokenizer and arguments of a case, in a scratch directory """
+    def __init__(self, args, scale: int=1, model_type: str='bert'):
+        from transformers import BertTokenizer
+        from kitanaqa.trainer.arguments import ModelArguments
+
+        self.dir = os.path.abspath(args.work_dir or '.')
+        with open(args.data_file, 'r') as f:
+            self.examples = scale_corpus(json.load(f), scale)
+        with open(os.path.join(self.dir, 'train.json'), 'w') as f:
+            json.dump(self.examples, f)
+        vocab_file = build_vocab(self.examples, os.path.join(self.dir, 'vocab.txt'))
+        self.tokenizer = BertTokenizer(vocab_file, do_lower_case=True)
+        self.model_args = ModelArguments(
+            model_type=model_type,
+            model_name_or_path='tiny-{}'.format(model_type),
+            data_dir=self.dir,
+            train_file_path='train.json',
+            predict_file_path={'bench': 'train.json'},
+            max_seq_length=args.max_seq_length,
+            doc_stride=args.doc_stride,
+            max_query_length=args.max_query_length,
+            preprocessing_num_workers=1,
+        )
+
+    def training_args(self, args, **kwargs):
+        from transformers import TrainingArguments
+        return TrainingArguments(
+            output_dir=os.path.join(self.dir, 'output'),
+            no_cuda=True,
+            per_device_train_batch_size=args.batch_size,
+            per_device_eval_batch_size=args.batch_size,
+            seed=args.seed,
+            **kwargs)
+
+    def read_examples(self):
+        """ The SquadExamples of the corpus """
+        from kitanaqa.trainer.alum_squad_processor import AlumSquadV1Processor
+        return AlumSquadV1Processor().alum_get_dev_examples(self.dir, filename='train.json')
+
+    def featurize(self, examples, use_fast_tokenizer: bool=False):
+        """ The features and TensorDataset of examples """
+        from kitanaqa.trainer.alum_squad_processor import alum_squad_convert_examples_to_features
+        return alum_squad_convert_examples_to_features(
+            examples=examples,
+            tokenizer=self.tokenizer,
+            max_seq_length=self.model_args.max_seq_length,
+            doc_stride=self.model_args.doc_stride,
+            max_query_length=self.model_args.max_query_length,
+            return_dataset='pt',
+            threads=1,
+            tqdm_enabled=False,
+            use_fast_tokenizer=use_fast_tokenizer,
+        )
+
+
+def bench_featurize(args, scale: int, use_fast_tokenizer: bool) -> dict:
+    """ Converts the examples of the corpus to features """
+    workspace = Workspace(args, scale)
+    timer = StageTimer()
+    with timer.stage('read_examples'):
+        examples = workspace.read_examples()
+    with timer.stage('featurize'):
+        features, _ = workspace.featurize(examples, use_fast_tokenizer)
+    elapsed = timer.times['featurize']
+    return {
+        'metrics': {
+            'num_examples': len(examples),
+            'num_features': len(features),
+            'examples_per_s': len(examples) / elapsed,
+            'features_per_s': len(features) / elapsed,
+            'time_s': elapsed,
+        },
+        'stages': timer.report(),
+    }
+
+
+def bench_load_and_cache(args, scale: int) -> dict:
+    """ Featurises the training file and caches it, then loads it back from the cache """
+    from kitanaqa.trainer.utils import get_cached_features_file, load_and_cache_examples
+    workspace = Workspace(args, scale)
+    model_args = workspace.model_args
+    timer = StageTimer()
+    model_args.overwrite_cache = True
+    with timer.stage('cold'):
+        dataset = load_and_cache_examples(model_args, workspace.tokenizer)
+    model_args.overwrite_cache = False
+    with timer.stage('warm'):
+        load_and_cache_examples(model_args, workspace.tokenizer)
+    return {
+        'metrics': {
+            'num_features': len(dataset),
+            'features_per_s': len(dataset) / timer.times['cold'],
+            'cold_s': timer.times['cold'],
+            'warm_s': timer.times['warm'],
+            'cache_mb': os.path.getsize(get_cached_features_file(model_args)) / (1 << 20),
+        },
+        'stages': timer.report(),
+    }
+
+
+def _build_trainer(workspace: Workspace, model, args, train_dataset=None, **model_kwargs):
+    from dataclasses import replace
+    from kitanaqa.trainer.train import Trainer
+    model_args = replace(workspace.model_args, **model_kwargs)
+    if train_dataset is not None:
+        # The ALUM alpha schedule has one value per epoch, and is advanced at most once per step
+        training_args = workspace.training_args(
+            args,
+            do_train=True,
+            num_train_epochs=args.warmup_steps + args.num_steps + 1)
+    else:
+        training_args = workspace.training_args(args)
+    return Trainer(
+        model_args=model_args,
+        data_collator=None,
+        model=model,
+        tokenizer=workspace.tokenizer,
+        args=training_args,
+        train_dataset=train_dataset,
+        prediction_loss_only=True,
+    ), model_args
+
+
+def _time_steps(trainer, model, args) -> list:
+    """ The latency of each timed training step, run after the warmup steps on batches cycling through the training set """
+    def batches():
+        while True:
+            for batch in trainer.get_train_dataloader():
+                yield batch
+    batch_iter = batches()
+    latencies = []
+    for step in range(args.warmup_steps + args.num_steps):
+        batch = next(batch_iter)
+        start = time.perf_counter()
+        trainer.training_step(model, batch)
+        model.zero_grad()
+        if step >= args.warmup_steps:
+            latencies.append(time.perf_counter() - start)
+    return latencies
+
+
+def bench_train_step(args, model_type: str) -> dict:
+    """ Times the normal training step, then the ALUM training step at each K, on the same model """
+    workspace = Workspace(args, model_type=model_type)
+    _, dataset = workspace.featurize(workspace.read_examples())
+    model = build_model(model_type, len(workspace.tokenizer.vocab), args)
+    timer = StageTimer()
+
+    steps = collections.OrderedDict()
+    set_seed(args.seed)
+    trainer, _ = _build_trainer(workspace, model, args, train_dataset=dataset)
+    with timer.stage('normal'):
+        steps['normal'] = _time_steps(trainer, model, args)
+    for K in args.K:
+        set_seed(args.seed)
+        trainer, _ = _build_trainer(workspace, model, args, train_dataset=dataset, do_alum=True, K=K)
+        with timer.stage('alum_K={}'.format(K)):
+            steps['alum_K={}'.format(K)] = _time_steps(trainer, model, args)
+
+    normal_mean = sum(steps['normal']) / len(steps['normal'])
+    return {
+        'metrics': {
+            'num_params': sum(p.numel() for p in model.parameters()),
+            'batch_size': args.batch_size,
+            'num_steps': args.num_steps,
+        },
+        'steps': {
+            name: {
+                'examples_per_s': args.batch_size * len(latencies) / sum(latencies),
+                'relative_step_time': (sum(latencies) / len(latencies)) / normal_mean,
+                'latency_ms': latency_stats(latencies),
+            }
+            for name, latencies in steps.items()
+        },
+        'stages': timer.report(),
+    }
+
+
+def bench_evaluate(args, model_type: str, adv: bool) -> dict:
+    """ Evaluates on the corpus, with the PGD attack at each K if adv, timing eval_repeats evaluations after a warmup one """
+    workspace = Workspace(args, model_type=model_type)
+    examples = workspace.read_examples()
+    features, dataset = workspace.featurize(examples)
+    model = build_model(model_type, len(workspace.tokenizer.vocab), args)
+    timer = StageTimer()
+
+    runs = collections.OrderedDict()
+    for K in (args.K if adv else [None]):
+        name = 'K={}'.format(K) if adv else 'normal'
+        trainer, model_args = _build_trainer(workspace, model, args, K=K or 1)
+        evaluate = trainer.adv_evaluate if adv else trainer.evaluate
+        # An untimed first run, as the first forward passes are slower
+        evaluate(name, model_args, workspace.tokenizer, dataset, examples, features)
+        latencies = []
+        for _ in range(args.eval_repeats):
+            set_seed(args.seed)
+            start = time.perf_counter()
+            evaluate(name, model_args, workspace.tokenizer, dataset, examples, features)
+            latencies.append(time.perf_counter() - start)
+            timer.add(name, latencies[-1])
+        runs[name] = latencies
+
+    return {
+        'metrics': {
+            'num_examples': len(examples),
+            'num_features': len(features),
+        },
+        'steps': {
+            name: {
+                'features_per_s': len(features) * len(latencies) / sum(latencies),
+                'latency_ms': latency_stats(latencies),
+            }
+            for name, latencies in runs.items()
+        },
+        'stages': timer.report(),
+    }
+
+
+def run(case: str, model_type: str, scale: int, args) -> dict:
+    import torch
+    if args.num_threads:
+        torch.set_num_threads(args.num_threads)
+    set_seed(args.seed)
+    if case in ['featurize', 'featurize_fast']:
+        return bench_featurize(args, scale, use_fast_tokenizer=case == 'featurize_fast')
+    if case == 'load_and_cache_examples':
+        return bench_load_and_cache(args, scale)
+    if case == 'train_step':
+        return bench_train_step(args, model_type)
+    return bench_evaluate(args, model_type, adv=case == 'adv_evaluate')
+
+
+def _case_args(args, case: str, model_type: str, scale: int) -> list:
+    """ The command line of the process running a case """
+    case_args = [
+        '--case', case,
+        '--model_type', model_type,
+        '--scale', str(scale),
+        '--data_file', args.data_file,
+        '--seed', str(args.seed),
+        '--K'] + [str(K) for K in args.K] + [
+        '--batch_size', str(args.batch_size),
+        '--num_steps', str(args.num_steps),
+        '--warmup_steps', str(args.warmup_steps),
+        '--eval_repeats', str(args.eval_repeats),
+        '--max_seq_length', str(args.max_seq_length),
+        '--doc_stride', str(args.doc_stride),
+        '--max_query_length', str(args.max_query_length),
+        '--hidden_size', str(args.hidden_size),
+        '--num_layers', str(args.num_layers),
+        '--num_heads', str(args.num_heads),
+    ]
+    if args.num_threads:
+        case_args += ['--num_threads', str(args.num_threads)]
+    return case_args
+
+
+def _iter_cases(args):
+    """ The (name, case, model_type, scale) of each case to run """
+    for case in args.cases:
+        if case in DATA_CASES:
+            for scale in args.scales:
+                yield '{}/scale={}'.format(case, scale), case, 'bert', scale
+        else:
+            for model_type in args.model_types:
+                yield '{}/{}'.format(case, model_type), case, model_type, 1
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--data_file', default=pkg_resources.resource_filename('kitanaqa', 'support/unittest-squad.json'),
+                        help='SQuAD-like file used for featurisation, training and evaluation.')
+    parser.add_argument('--scales', type=int, nargs='+', default=[1, 10],
+                        help='Number of times the articles of data_file are repeated in the featurisation corpora.')
+    parser.add_argument('--cases', nargs='+', default=CASES, choices=CASES)
+    parser.add_argument('--model_types', nargs='+', default=MODEL_TYPES, choices=MODEL_TYPES)
+    parser.add_argument('--K', type=int, nargs='+', default=[1, 2, 3], help='ALUM and PGD attack steps timed.')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--batch_size', type=int, default=8)
+    parser.add_argument('--num_steps', type=int, default=20, help='Number of timed training steps.')
+    parser.add_argument('--warmup_steps', type=int, default=3, help='Number of training steps run before timing.')
+    parser.add_argument('--eval_repeats', type=int, default=3, help='Number of times each evaluation is timed.')
+    parser.add_argument('--max_seq_length', type=int, default=128)
+    parser.add_argument('--doc_stride', type=int, default=64)
+    parser.add_argument('--max_query_length', type=int, default=32)
+    parser.add_argument('--hidden_size', type=int, default=64)
+    parser.add_argument('--num_layers', type=int, default=2)
+    parser.add_argument('--num_heads', type=int, default=4)
+    parser.add_argument('--num_threads', type=int, default=None, help='Number of torch threads. Defaults to the torch default.')
+    parser.add_argument('--no_isolate', action='store_true',
+                        help='Run every case in this process. Peak RSS is then the peak of all the cases run so far.')
+    parser.add_argument('--timeout', type=float, default=None, help='Timeout of each case, in seconds.')
+    parser.add_argument('--output', default='benchmark_trainer.json')
+    # Set when a case runs in its own process
+    parser.add_argument('--case', choices=CASES, help=argparse.SUPPRESS)
+    parser.add_argument('--model_type', choices=MODEL_TYPES, help=argparse.SUPPRESS)
+    parser.add_argument('--scale', type=int, help=argparse.SUPPRESS)
+    parser.add_argument('--result_file', help=argparse.SUPPRESS)
+    parser.add_argument('--work_dir', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.result_file:
+        with open(args.result_file, 'w') as f:
+            json.dump(run_case(run, args.case, args.model_type, args.scale, args), f)
+        return
+
+    results = []
+    for name, case, model_type, scale in _iter_cases(args):
+        if args.no_isolate:
+            with tempfile.TemporaryDirectory() as work_dir:
+                args.work_dir = work_dir
+                result = run_case(run, case, model_type, scale, args)
+        else:
+            result = run_isolated(__file__, _case_args(args, case, model_type, scale), timeout=args.timeout)
+        result = dict(name=name, case=case, model_type=model_type, scale=scale, **result)
+        print(json.dumps({k: result[k] for k in ['name', 'metrics', 'steps', 'peak_rss_mb', 'error'] if k in result}))
+        results.append(result)
+
+    config = {k: v for k, v in vars(args).items() if k not in ['case', 'model_type', 'scale', 'result_file', 'work_dir']}
+    write_report(args.output, 'trainer', config, results)
+
+
+if __name__ == '__main__':
+    main()
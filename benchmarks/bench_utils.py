@@ -0,0 +1,177 @@
+""" Helpers shared by the benchmark scripts: seeding, corpora, timing, memory, isolated runs and JSON reports """
+import copy
+import datetime
+import json
+import os
+import platform
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import traceback
+from contextlib import contextmanager
+from typing import Callable, Dict, List
+
+import numpy as np
+
+
+def set_seed(seed: int):
+    """ Seed python, numpy and, if installed, torch """
+    random.seed(seed)
+    np.random.seed(seed)
+    try:
+        import torch
+        torch.manual_seed(seed)
+    except ImportError:
+        pass
+
+
+def scale_corpus(examples: dict, scale: int) -> dict:
+    """ A SQuAD-like corpus with the articles of examples repeated scale times, with unique titles and question IDs """
+    if scale == 1:
+        return examples
+    data = []
+    for i in range(scale):
+        for article in examples['data']:
+            article = copy.deepcopy(article)
+            article['title'] = '{}_{}'.format(article['title'], i)
+            for paragraph in article['paragraphs']:
+                for qa in paragraph['qas']:
+                    qa['id'] = '{}_{}'.format(qa['id'], i)
+            data.append(article)
+    return dict(examples, data=data)
+
+
+def peak_rss_mb() -> float:
+    """ Peak resident set size of the current process, in MB """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in KB on Linux
+    return peak / (1 << 20) if sys.platform == 'darwin' else peak / (1 << 10)
+
+
+def latency_stats(samples: List[float]) -> Dict:
+    """ Mean and percentiles of latencies given in seconds, reported in ms """
+    if not samples:
+        return {}
+    ms = np.asarray(samples) * 1000.
+    return {
+        'mean': float(ms.mean()),
+        'p50': float(np.percentile(ms, 50)),
+        'p90': float(np.percentile(ms, 90)),
+        'p99': float(np.percentile(ms, 99)),
+        'max': float(ms.max()),
+    }
+
+
+class StageTimer():
+    """ Accumulates the wall time of named stages, which may be entered many times """
+    def __init__(self):
+        self.times = {}
+        self.calls = {}
+
+    @contextmanager
+    def stage(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - start)
+
+    def add(self, name: str, elapsed: float):
+        self.times[name] = self.times.get(name, 0.) + elapsed
+        self.calls[name] = self.calls.get(name, 0) + 1
+
+    def wrap(self, name: str, fn: Callable) -> Callable:
+        """ fn, timed under name at every call """
+        def timed(*args, **kwargs):
+            with self.stage(name):
+                return fn(*args, **kwargs)
+        return timed
+
+    def report(self) -> Dict:
+        return {
+            name: {'time_s': self.times[name], 'calls': self.calls[name]}
+            for name in self.times
+        }
+
+
+def _git_commit() -> str:
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def environment() -> Dict:
+    """ The commit, library versions and machine a report was produced with """
+    env = {
+        'git_commit': _git_commit(),
+        'timestamp': datetime.datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'processor': platform.processor(),
+        'cpu_count': os.cpu_count(),
+        'numpy': np.__version__,
+    }
+    for name in ['torch', 'transformers']:
+        try:
+            env[name] = __import__(name).__version__
+        except ImportError:
+            env[name] = None
+    try:
+        import torch
+        env['torch_num_threads'] = torch.get_num_threads()
+    except ImportError:
+        pass
+    return env
+
+
+def run_case(fn: Callable, *args) -> Dict:
+    """ The result of a benchmark case, or its error, along with the peak RSS of the process """
+    try:
+        result = fn(*args)
+    except Exception as e:
+        result = {'error': '{}: {}'.format(type(e).__name__, e), 'traceback': traceback.format_exc()}
+    result['peak_rss_mb'] = peak_rss_mb()
+    return result
+
+
+def run_isolated(script: str, case_args: List[str], timeout: float=None) -> Dict:
+    """Runs a benchmark case in a new python process, so that its peak RSS and load times are its own
+
+    The script is called with `case_args` and `--result_file`, where it writes the JSON result of the case.
+    """
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        result_file = os.path.join(tmp_dir, 'result.json')
+        # Cases run in a scratch directory, so files they write do not land in the caller's
+        proc = subprocess.run(
+            [sys.executable, os.path.abspath(script)] + case_args + ['--result_file', result_file],
+            cwd=tmp_dir,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            timeout=timeout)
+        if os.path.exists(result_file):
+            with open(result_file) as f:
+                return json.load(f)
+        return {
+            'error': 'Benchmark process exited with code {}'.format(proc.returncode),
+            'stderr': proc.stderr.decode(errors='replace')[-2000:],
+        }
+
+
+def write_report(path: str, name: str, config: Dict, results: List[Dict]):
+    """ Writes a JSON report of benchmark results, with the environment they were measured in """
+    report = {
+        'benchmark': name,
+        'environment': environment(),
+        'config': config,
+        'results': results,
+    }
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path, 'w') as f:
+        json.dump(report, f, indent=2)
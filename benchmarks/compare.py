@@ -0,0 +1,85 @@
+""" Compares the metrics of two benchmark reports, e.g. of two commits
+
+Results are matched by name. Metrics ending in `_per_s` are better when higher, and the time and
+memory metrics, ending in `_s`, `_ms` or `_mb`, are better when lower. Counts are not compared.
+The script exits with code 1 if any metric regressed by more than the threshold.
+
+    python benchmarks/compare.py base.json new.json --threshold 0.1
+"""
+import argparse
+import json
+import sys
+from typing import Dict, Iterable, Tuple
+
+
+def _flat_metrics(result: Dict) -> Dict:
+    """ The numeric metrics of a result, with nested metrics such as latency percentiles named by their path """
+    metrics = {}
+    def add(prefix, values):
+        for name, value in values.items():
+            if isinstance(value, dict):
+                add(prefix + name + '.', value)
+            elif isinstance(value, (int, float)) and not isinstance(value, bool):
+                metrics[prefix + name] = value
+    add('', result.get('metrics', {}))
+    add('latency_ms.', result.get('latency_ms', {}))
+    add('stages.', result.get('stages', {}))
+    add('steps.', result.get('steps', {}))
+    if 'peak_rss_mb' in result:
+        metrics['peak_rss_mb'] = result['peak_rss_mb']
+    return metrics
+
+
+def _direction(metric: str) -> int:
+    """ 1 if higher is better, -1 if lower is better, 0 if the metric is not compared """
+    # The unit is in the innermost part of the name which has one, e.g. stages.generate.time_s or latency_ms.p50
+    for name in reversed(metric.split('.')):
+        if name.endswith('_per_s'):
+            return 1
+        if name.endswith(('_s', '_ms', '_mb')):
+            return -1
+    return 0
+
+
+def compare(base: Dict, new: Dict) -> Iterable[Tuple[str, str, float, float, float]]:
+    """ The (result name, metric, base value, new value, relative change) of each metric of the results in both reports """
+    base_results = {result['name']: result for result in base['results']}
+    for result in new['results']:
+        if result['name'] not in base_results:
+            continue
+        base_metrics = _flat_metrics(base_results[result['name']])
+        for metric, value in _flat_metrics(result).items():
+            base_value = base_metrics.get(metric)
+            if base_value is None or not _direction(metric):
+                continue
+            change = (value - base_value) / base_value if base_value else 0.
+            yield result['name'], metric, base_value, value, change
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('base', help='Report of the baseline.')
+    parser.add_argument('new', help='Report to compare with the baseline.')
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help='Relative change of a metric, in its worse direction, reported as a regression.')
+    args = parser.parse_args()
+
+    with open(args.base) as f:
+        base = json.load(f)
+    with open(args.new) as f:
+        new = json.load(f)
+    print('base {} ({})  new {} ({})'.format(
+        base['environment'].get('git_commit'), base['environment'].get('timestamp'),
+        new['environment'].get('git_commit'), new['environment'].get('timestamp')))
+
+    regressions = 0
+    for name, metric, base_value, value, change in compare(base, new):
+        regressed = -_direction(metric) * change > args.threshold
+        regressions += regressed
+        print('{:<40} {:<24} {:>12.4g} {:>12.4g} {:>+8.1%}{}'.format(
+            name, metric, base_value, value, change, '  REGRESSION' if regressed else ''))
+    sys.exit(1 if regressions else 0)
+
+
+if __name__ == '__main__':
+    main()
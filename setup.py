@@ -26,7 +26,7 @@ def _get_requirements():
         'nltk',
         'numpy>=1.14.0,<1.18.0',
         'stop-words',
-        'torch>=1.5.1',
+        'torch>=1.11',
         'transformers==3.1.0',
         'prefect==0.13.4',
         'pendulum==2.0.5',
@@ -7,6 +7,7 @@ import copy
 from torch.utils.data import DataLoader
 import math
 from collections import Counter
+from typing import Iterator
 from datetime import datetime
 from kitanaqa.augment.term_replacement import *
 from kitanaqa import get_logger
@@ -103,6 +104,8 @@ class SQuADDataset(Dataset):
         ----------
         generate()
           Generate perturbations for the input dataset using init params.
+        iter_generate()
+          Yield perturbations for the input dataset one at a time, without keeping them.
 
         Parameters
         ----------
@@ -220,55 +223,14 @@ class SQuADDataset(Dataset):
             with open('annotated-train-squadv1.json', 'w') as f:
                 json.dump(new_squad_examples, f)
 
-    def generate(self):
-        """ Generate perturbations for the raw SQuAD-like examples
-        Parameters
-        ----------
-        term : str
-            The input term for which we are looking for synonyms.
-        num_syns : Optional(int)
-            The number of synonyms for the input term. The number of synonyms should be greater than 1. The default value is 10.
-        similarity_thre : Optional(float)
-            The similarity threshold. The function returns the synonyms with higher similarity than the threshold.
-
-        Returns
-        -------
-        None
-
-        Example
-        -------
-        >>> from augment_squad import SQuADDataset
-        >>> with open('support/squad-dev-v1.1.json', 'r') as f:
-        >>>     squad_dev_examples = json.read(f)
-        >>> ds = SQuADDataset(squad_dev_examples, sample_ratio = 0.0001)
-        >>> ds.generate()
-        >>> ds()
-        """
-        aug_examples = copy.deepcopy(self.examples)
-
-        # Randomly sample indices of data in original dataset with replacement
-        aug_indices = np.random.choice(self.orig_indices, size=self.num_aug_examples)
-        aug_freqs = Counter(aug_indices)
-
-        ct = 0
-        if self.from_checkpoint:
-            checkpoint = _from_checkpoint()
-            if not checkpoint:
-                raise RuntimeError('Failed to load checkpoint file')
-            aug_freqs = checkpoint['aug_freqs']
-            self.aug_dataset = checkpoint['aug_dataset']
-            self.hparams = checkpoint['hparams']
-            ct = checkpoint['ct']
-
+    def _iter_aug_examples(self, aug_freqs: Counter) -> Iterator[Tuple[Dict, List[Dict]]]:
+        """ Yields each sampled original example with the list of its perturbations, in the flat format of `dataset` """
         # Reamining number of each agumentation types after exhausting previous example's variations
         remaining_count = {}
         for aug_type in self.augmentation_types.keys():
             remaining_count[aug_type] = 0
 
-        aug_seqs = []
         for aug_idx, count in aug_freqs.items():
-            if len(self.aug_dataset) >= self.num_aug_examples:
-                break
             # Get frequency of each augmentation type for current example with replacement
             aug_type_sample = np.random.choice(list(self.augmentation_types.keys()), size=count, p=self.probs)
             aug_type_freq = Counter(aug_type_sample)
@@ -278,30 +240,14 @@ class SQuADDataset(Dataset):
             # Get raw data from original dataset and get corresponding importance score
             raw_data = self.examples[aug_idx]
             question = raw_data['question']
-            answers = raw_data['answers']
             qid = raw_data['qid']
-            ctx_id = raw_data['ctx_id']
-            tle_id = raw_data['tle_id']
-            # Used for SQuAD v2.0; not present in v1.1
-            is_impossible = raw_data.get('is_impossible', False)
                 
             if self.custom_importance_scores and qid in self.custom_importance_scores:
                 importance_score = self.custom_importance_scores[qid]
             else:
                 importance_score = None
 
-            if ct % self.save_freq == 0 and ct > 0:
-                logger.info('Generated {} examples'.format(len(self.aug_dataset)))
-                checkpoint = {
-                    'aug_freqs':aug_freqs,
-                    'aug_dataset':self.aug_dataset,
-                    'hparams':self.hparams,
-                    'ct':ct
-                }
-                with open('checkpoint.pkl', 'wb') as f:
-                    pickle.dump(checkpoint, f) 
-            sys.stdout.flush()
-
+            aug_examples = []
             for aug_type, aug_times in aug_type_freq.items():
                 # Randomly select a number of terms to replace
                 # up to the max `num_replacements`
@@ -324,37 +270,113 @@ class SQuADDataset(Dataset):
                                                             sampling_k = self.hparams['sampling_k'])
                     # Add an additional drop perturbation to each generated question
                     aug_questions += [
-                                        self.augmentation_types['drop'].drop_terms(
+                                        y
+                                        for x in aug_questions
+                                        for y in self.augmentation_types['drop'].drop_terms(
                                                         x,
                                                         num_terms=reps,
                                                         num_output_sents=1)
-                                        for x in aug_questions
                                     ]
                                                         
                 for aug_question in aug_questions:
+                    aug_example = {
+                        'id':qid,
+                        'ctx_id':raw_data['ctx_id'],
+                        'tle_id':raw_data['tle_id'],
+                        'aug_type':aug_type,
+                        'question':aug_question,
+                        'answers':raw_data['answers'],
+                    }
                     if self.is_training:
-                        self.aug_dataset.append({
-                                                'id':qid,
-                                                'ctx_id':ctx_id,
-                                                'tle_id':tle_id,
-                                                'aug_type':aug_type,
-                                                'question':aug_question,
-                                                'answers':answers,
-                                                'is_impossible':is_impossible
-                                        })
-                    else:
-                        aug_seqs.append({'orig': question, 'aug': aug_question, 'type':aug_type})
-                        self.aug_dataset.append({
-                                                'id':qid,
-                                                'ctx_id':ctx_id,
-                                                'tle_id':tle_id,
-                                                'aug_type':aug_type,
-                                                'question':aug_question,
-                                                'answers':answers,
-                                        })  
+                        # Used for SQuAD v2.0; not present in v1.1
+                        aug_example['is_impossible'] = raw_data.get('is_impossible', False)
+                    aug_examples.append(aug_example)
 
                 remaining_count[aug_type] = aug_times - len(aug_questions)
 
+            yield raw_data, aug_examples
+
+    def iter_generate(self) -> Iterator[Dict]:
+        """ Lazily generate perturbations of the raw SQuAD-like examples
+
+        Yields `num_aug_examples` perturbed examples in the flat format of `dataset`, as they are
+        generated, so they can be featurised without formatting the whole augmented set as a SQuAD
+        file. Perturbations of the same original example are consecutive. Unlike `generate`,
+        nothing is kept in memory, checkpointed or written to disk.
+
+        Example
+        -------
+        >>> ds = SQuADDataset(squad_train_examples, is_training=True, sample_ratio=0.5)
+        >>> for aug_example in ds.iter_generate():
+        >>>     print(aug_example['aug_type'], aug_example['question'])
+        """
+        aug_indices = np.random.choice(self.orig_indices, size=self.num_aug_examples)
+        num_generated = 0
+        for _, aug_examples in self._iter_aug_examples(Counter(aug_indices)):
+            for aug_example in aug_examples[:self.num_aug_examples - num_generated]:
+                yield aug_example
+            num_generated += len(aug_examples)
+            if num_generated >= self.num_aug_examples:
+                break
+
+    def generate(self):
+        """ Generate perturbations for the raw SQuAD-like examples
+        Parameters
+        ----------
+        term : str
+            The input term for which we are looking for synonyms.
+        num_syns : Optional(int)
+            The number of synonyms for the input term. The number of synonyms should be greater than 1. The default value is 10.
+        similarity_thre : Optional(float)
+            The similarity threshold. The function returns the synonyms with higher similarity than the threshold.
+
+        Returns
+        -------
+        None
+
+        Example
+        -------
+        >>> from augment_squad import SQuADDataset
+        >>> with open('support/squad-dev-v1.1.json', 'r') as f:
+        >>>     squad_dev_examples = json.read(f)
+        >>> ds = SQuADDataset(squad_dev_examples, sample_ratio = 0.0001)
+        >>> ds.generate()
+        >>> ds()
+        """
+        # Randomly sample indices of data in original dataset with replacement
+        aug_indices = np.random.choice(self.orig_indices, size=self.num_aug_examples)
+        aug_freqs = Counter(aug_indices)
+
+        ct = 0
+        if self.from_checkpoint:
+            checkpoint = _from_checkpoint()
+            if not checkpoint:
+                raise RuntimeError('Failed to load checkpoint file')
+            aug_freqs = checkpoint['aug_freqs']
+            self.aug_dataset = checkpoint['aug_dataset']
+            self.hparams = checkpoint['hparams']
+            ct = checkpoint['ct']
+
+        aug_seqs = []
+        for raw_data, aug_examples in self._iter_aug_examples(aug_freqs):
+            if len(self.aug_dataset) >= self.num_aug_examples:
+                break
+
+            if ct % self.save_freq == 0 and ct > 0:
+                logger.info('Generated {} examples'.format(len(self.aug_dataset)))
+                checkpoint = {
+                    'aug_freqs':aug_freqs,
+                    'aug_dataset':self.aug_dataset,
+                    'hparams':self.hparams,
+                    'ct':ct
+                }
+                with open('checkpoint.pkl', 'wb') as f:
+                    pickle.dump(checkpoint, f) 
+            sys.stdout.flush()
+
+            self.aug_dataset.extend(aug_examples)
+            if not self.is_training:
+                aug_seqs.extend({'orig': raw_data['question'], 'aug': x['question'], 'type': x['aug_type']} for x in aug_examples)
             ct += 1
 
         self.aug_dataset = self.aug_dataset[:self.num_aug_examples]
@@ -367,7 +389,7 @@ class SQuADDataset(Dataset):
             with open(self.out_prefix+'_aug_seqs.json', 'w') as f:
                 json.dump(aug_seqs, f)
             with open(self.out_prefix+'_aug_squad_v1.json', 'w') as f:
-                json.dump(self.formatted_aug_dataset, f)
+                json.dump(self.formatted_dataset, f)
             with open('hparams.json', 'w') as f:
                 json.dump(self.hparams, f)
 
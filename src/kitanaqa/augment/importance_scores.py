@@ -0,0 +1,307 @@
+import json
+import os
+import torch
+from typing import Callable, Dict, Iterable, List, Tuple
+
+from nltk.tokenize import word_tokenize
+
+from kitanaqa import get_logger
+from kitanaqa.trainer.attack import get_embed_layer
+
+logger = get_logger()
+
+
+def load_importance_scores(path: str) -> Dict:
+    """Reads the importance scores written by `ImportanceScorer.score_file`
+
+    Parameters
+    ----------
+    path : str
+        JSON lines file, where each line maps the question IDs of a chunk to their scores.
+
+    Returns
+    -------
+    Dict
+        The (term, score) pairs of each question, keyed by question ID, as expected by the `custom_importance_scores` of `SQuADDataset`.
+    """
+    scores = {}
+    if not os.path.exists(path):
+        return scores
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                chunk = json.loads(line)
+            except json.JSONDecodeError:
+                # The last chunk of an interrupted run may be incomplete
+                continue
+            for qid, term_scores in chunk.items():
+                scores[qid] = [tuple(x) for x in term_scores]
+    return scores
+
+
+def _append_chunk(path: str, chunk: Dict):
+    """ Append the scores of a chunk of questions as a JSON line """
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(path, "a+", encoding="utf-8") as f:
+        # Start a new line after the incomplete last chunk of an interrupted run
+        if f.tell() > 0:
+            f.seek(f.tell() - 1)
+            if f.read(1) != "\n":
+                f.write("\n")
+        f.write(json.dumps(chunk) + "\n")
+
+
+def _iter_squad_questions(squad_file: str) -> Iterable[Tuple[str, str, str]]:
+    """ The (qid, question, context) of each question of a SQuAD-like file """
+    with open(squad_file, "r", encoding="utf-8") as f:
+        data = json.load(f)["data"]
+    for entry in data:
+        for paragraph in entry["paragraphs"]:
+            for qa in paragraph["qas"]:
+                yield qa["id"], qa["question"], paragraph["context"]
+
+
+class ImportanceScorer():
+    """ Scores the importance of each term of a question to the answer predicted by a QA model
+    ...
+
+    In the default 'mask' mode, a term is scored by masking all of its subword tokens,
+    leave-one-word-out, and measuring the decrease in the log-likelihood of the start and end of
+    the answer span predicted for the unmasked question. The masked variants of many questions are
+    padded into batches, and each batch is scored in one forward pass without gradients.
+
+    In the 'gradient' mode, the saliency of each token is the gradient of that log-likelihood with
+    respect to the input embedding of the token, times the embedding, summed over the embedding
+    dimensions. It is a first order estimate of the decrease in log-likelihood when the embedding
+    is zeroed, and a term is scored with the sum of the saliency of its subword tokens. A batch of
+    questions is scored in one forward and backward pass, rather than one forward pass per term.
+    It is supported for bert, albert and distilbert models.
+
+    Questions are split into terms with
+    the NLTK word tokenizer, as the questions perturbed by `ReplaceTerms`, so the scores line up
+    with the terms sampled by `get_scores`.
+
+    Methods
+    ----------
+    score(questions)
+      Returns the (term, score) pairs of each (qid, question, context).
+    score_file(squad_file, output_file, chunk_size)
+      Scores the questions of a SQuAD-like file and appends the scores to output_file chunk by chunk, skipping questions already scored.
+    """
+    def __init__(
+                self,
+                model,
+                tokenizer,
+                model_type: str,
+                max_seq_length: int=384,
+                max_query_length: int=64,
+                batch_size: int=32,
+                word_tokenizer: Callable[[str], List[str]]=None,
+                mode: str='mask'):
+        """
+        Parameters
+        ----------
+        model : transformers.PreTrainedModel
+            A question answering model, e.g. BertForQuestionAnswering. Scores are computed on the device of the model.
+        tokenizer :
+            The tokenizer of the model.
+        model_type : str
+            The type of the model, e.g. bert, albert or distilbert.
+        max_seq_length : Optional(int)
+            Max length of the question and context tokens. Contexts are truncated. The default value is 384.
+        max_query_length : Optional(int)
+            Max number of question tokens. Terms past it are scored 0. The default value is 64.
+        batch_size : Optional(int)
+            Number of masked variants, or of questions in the 'gradient' mode, scored in each pass. The default value is 32.
+        word_tokenizer : Optional(Callable)
+            Splits a question into terms. The default is the NLTK word tokenizer.
+        mode : Optional(str)
+            'mask' to score terms by leave-one-word-out masking, or 'gradient' to score them by gradient x input saliency. The default value is 'mask'.
+        """
+        if mode not in ['mask', 'gradient']:
+            raise ValueError("mode should be one of 'mask', 'gradient'")
+        self.model = model
+        self.tokenizer = tokenizer
+        self.model_type = model_type
+        self.max_seq_length = max_seq_length
+        self.max_query_length = max_query_length
+        self.batch_size = batch_size
+        self.word_tokenizer = word_tokenizer or word_tokenize
+        self.mode = mode
+        if mode == 'gradient':
+            self._embed_layer = get_embed_layer(model, model_type)
+        # Position of the first question token in the model input
+        self._query_offset = tokenizer.build_inputs_with_special_tokens([-1]).index(-1)
+
+    def _encode(self, question: str, context: str) -> Dict:
+        """ The input of the model for a question, and the span of question tokens of each of its terms """
+        terms = self.word_tokenizer(question)
+        query_ids, term_spans = [], []
+        for term in terms:
+            term_ids = self.tokenizer.convert_tokens_to_ids(self.tokenizer.tokenize(term))
+            term_ids = term_ids[:max(0, self.max_query_length - len(query_ids))]
+            start = self._query_offset + len(query_ids)
+            term_spans.append((start, start + len(term_ids)))
+            query_ids.extend(term_ids)
+        max_context_length = self.max_seq_length - len(query_ids) - self.tokenizer.num_special_tokens_to_add(pair=True)
+        context_ids = self.tokenizer.encode(context, add_special_tokens=False)[:max(0, max_context_length)]
+        return {
+            "terms": terms,
+            "term_spans": term_spans,
+            "input_ids": self.tokenizer.build_inputs_with_special_tokens(query_ids, context_ids),
+            "token_type_ids": self.tokenizer.create_token_type_ids_from_sequences(query_ids, context_ids),
+        }
+
+    def _pad(self, rows: List[Tuple[List[int], List[int]]]) -> Dict:
+        """ The model inputs of a batch of (input_ids, token_type_ids) rows, padded on the right """
+        device = next(self.model.parameters()).device
+        max_length = max(len(input_ids) for input_ids, _ in rows)
+        input_ids = torch.full((len(rows), max_length), self.tokenizer.pad_token_id, dtype=torch.long)
+        token_type_ids = torch.zeros((len(rows), max_length), dtype=torch.long)
+        attention_mask = torch.zeros((len(rows), max_length), dtype=torch.long)
+        for i, (row_input_ids, row_token_type_ids) in enumerate(rows):
+            input_ids[i, :len(row_input_ids)] = torch.tensor(row_input_ids)
+            token_type_ids[i, :len(row_token_type_ids)] = torch.tensor(row_token_type_ids)
+            attention_mask[i, :len(row_input_ids)] = 1
+        inputs = {
+            "input_ids": input_ids.to(device),
+            "attention_mask": attention_mask.to(device),
+            "token_type_ids": token_type_ids.to(device),
+        }
+        if self.model_type in ["xlm", "roberta", "distilbert"]:
+            del inputs["token_type_ids"]
+        return inputs
+
+    def _log_probs(self, outputs, attention_mask: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+        """ The start and end log-probabilities of the outputs of a batch """
+        # Padding is excluded from the answer distributions
+        padding = attention_mask == 0
+        start_logits = outputs[0].float().masked_fill(padding, float("-inf"))
+        end_logits = outputs[1].float().masked_fill(padding, float("-inf"))
+        return torch.log_softmax(start_logits, dim=-1), torch.log_softmax(end_logits, dim=-1)
+
+    def _forward(self, rows: List[Tuple[List[int], List[int]]]) -> Tuple[torch.Tensor, torch.Tensor]:
+        """ The start and end log-probabilities of a batch of (input_ids, token_type_ids) rows """
+        inputs = self._pad(rows)
+        return self._log_probs(self.model(**inputs), inputs["attention_mask"])
+
+    def _iter_batches(self, lengths: List[int]) -> Iterable[List[int]]:
+        """ Indices of the rows of each batch, grouping rows of similar length to limit padding """
+        order = sorted(range(len(lengths)), key=lengths.__getitem__)
+        for i in range(0, len(order), self.batch_size):
+            yield order[i:i + self.batch_size]
+
+    def _mask_term(self, encoded: Dict, term_index: int) -> Tuple[List[int], List[int]]:
+        """ The input of a question with the tokens of one of its terms masked """
+        start, end = encoded["term_spans"][term_index]
+        input_ids = list(encoded["input_ids"])
+        input_ids[start:end] = [self.tokenizer.mask_token_id] * (end - start)
+        return input_ids, encoded["token_type_ids"]
+
+    def _mask_scores(self, encoded: List[Dict]) -> List[List[float]]:
+        """ The leave-one-word-out score of each term of each encoded question """
+        # The answer span predicted for each unmasked question
+        targets = [None] * len(encoded)
+        for batch in self._iter_batches([len(x["input_ids"]) for x in encoded]):
+            start_log_probs, end_log_probs = self._forward([(encoded[i]["input_ids"], encoded[i]["token_type_ids"]) for i in batch])
+            start_positions = start_log_probs.argmax(dim=-1)
+            end_positions = end_log_probs.argmax(dim=-1)
+            for j, i in enumerate(batch):
+                start, end = start_positions[j].item(), end_positions[j].item()
+                targets[i] = (start, end, (start_log_probs[j, start] + end_log_probs[j, end]).item())
+
+        # A masked variant of each question for each term with question tokens, built when its batch is scored
+        variants = [
+            (i, k)
+            for i, x in enumerate(encoded)
+            for k, (start, end) in enumerate(x["term_spans"])
+            if start < end
+        ]
+        scores = [[0.] * len(x["terms"]) for x in encoded]
+        for batch in self._iter_batches([len(encoded[i]["input_ids"]) for i, _ in variants]):
+            start_log_probs, end_log_probs = self._forward([self._mask_term(encoded[variants[b][0]], variants[b][1]) for b in batch])
+            for j, b in enumerate(batch):
+                i, k = variants[b]
+                start, end, log_likelihood = targets[i]
+                scores[i][k] = log_likelihood - (start_log_probs[j, start] + end_log_probs[j, end]).item()
+        return scores
+
+    def _gradient_scores(self, encoded: List[Dict]) -> List[List[float]]:
+        """ The gradient x input score of each term of each encoded question """
+        scores = [None] * len(encoded)
+        for batch in self._iter_batches([len(x["input_ids"]) for x in encoded]):
+            inputs = self._pad([(encoded[i]["input_ids"], encoded[i]["token_type_ids"]) for i in batch])
+            with torch.enable_grad():
+                # As in the ALUM step, the model is fed the input embeddings, here to take their gradient
+                input_embedding = self._embed_layer(inputs.pop("input_ids")).detach().requires_grad_()
+                outputs = self.model(inputs_embeds=input_embedding, **inputs)
+                start_log_probs, end_log_probs = self._log_probs(outputs, inputs["attention_mask"])
+                # The log-likelihood of the answer span predicted for each question
+                batch_range = torch.arange(len(batch), device=input_embedding.device)
+                log_likelihood = (
+                    start_log_probs[batch_range, start_log_probs.argmax(dim=-1)]
+                    + end_log_probs[batch_range, end_log_probs.argmax(dim=-1)]
+                )
+                # Questions are independent, so the gradient of the sum is the gradient of each question
+                grad, = torch.autograd.grad(log_likelihood.sum(), input_embedding)
+            saliency = (grad * input_embedding.detach()).sum(dim=-1).tolist()
+            for j, i in enumerate(batch):
+                scores[i] = [sum(saliency[j][start:end]) for start, end in encoded[i]["term_spans"]]
+        return scores
+
+    @torch.no_grad()
+    def score(self, questions: List[Tuple[str, str, str]]) -> Dict:
+        """Scores the terms of each question
+
+        Parameters
+        ----------
+        questions : List[Tuple]
+            The (qid, question, context) of each question.
+
+        Returns
+        -------
+        Dict
+            The (term, score) pairs of each question in the order of its terms, keyed by qid. Terms whose masking, or whose gradient x input saliency, shows they raise the log-likelihood of the predicted answer span score higher.
+        """
+        was_training = self.model.training
+        self.model.eval()
+        encoded = [self._encode(question, context) for _, question, context in questions]
+        if self.mode == 'gradient':
+            scores = self._gradient_scores(encoded)
+        else:
+            scores = self._mask_scores(encoded)
+        self.model.train(was_training)
+        return {
+            qid: list(zip(x["terms"], question_scores))
+            for (qid, _, _), x, question_scores in zip(questions, encoded, scores)
+        }
+
+    def score_file(self, squad_file: str, output_file: str, chunk_size: int=1000) -> Dict:
+        """Scores the questions of a SQuAD-like file, appending the scores of each chunk of questions to output_file
+
+        Questions already scored in output_file are skipped, so an interrupted run resumes from its last complete chunk.
+
+        Parameters
+        ----------
+        squad_file : str
+            The SQuAD-like data file.
+        output_file : str
+            JSON lines file of the scores, read with `load_importance_scores`.
+        chunk_size : Optional(int)
+            Number of questions scored and written together. The default value is 1000.
+
+        Returns
+        -------
+        Dict
+            The scores of all the questions of squad_file, keyed by qid.
+        """
+        scores = load_importance_scores(output_file)
+        if scores:
+            logger.info("Resuming from {} scored questions in {}".format(len(scores), output_file))
+        questions = [x for x in _iter_squad_questions(squad_file) if x[0] not in scores]
+        for i in range(0, len(questions), chunk_size):
+            chunk = self.score(questions[i:i + chunk_size])
+            _append_chunk(output_file, chunk)
+            scores.update(chunk)
+            logger.info("Scored {} of {} questions".format(min(i + chunk_size, len(questions)), len(questions)))
+        return scores
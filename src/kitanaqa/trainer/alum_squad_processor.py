@@ -1,14 +1,22 @@
+import hashlib
+import itertools
 import json
 import os
+import re
+import tempfile
 import torch
 from torch.utils.data import TensorDataset
 from functools import partial
 from multiprocessing import Pool, cpu_count
 
+from transformers import BertTokenizer, BertTokenizerFast
+from transformers.tokenization_bert import whitespace_tokenize
 from transformers.data.processors.squad import (
+    _improve_answer_span,
     squad_convert_example_to_features,
     squad_convert_example_to_features_init,
     SquadExample,
+    SquadFeatures,
     DataProcessor
 )
 
@@ -23,6 +31,489 @@ MULTI_SEP_TOKENS_TOKENIZERS_SET = {"roberta", "camembert", "bart"}
 logger = get_logger()
 
 
+def _get_chunksize(num_examples, threads, max_chunksize=256):
+    """ Size imap chunks so that each worker gets about four of them """
+    if num_examples is None:
+        return 32
+    return max(1, min(max_chunksize, num_examples // (threads * 4)))
+
+
+def _num_examples(examples):
+    """ Number of examples for progress bars, or None when they are streamed """
+    return len(examples) if hasattr(examples, "__len__") else None
+
+
+_WHITESPACE = re.compile(r"[ \t\r\n]*")
+
+
+class _JSONStream():
+    """ Reads the values of a JSON document one at a time, from a file read only as far as each value needs """
+    def __init__(self, reader, chunk_size):
+        self.reader = reader
+        self.chunk_size = chunk_size
+        self.decoder = json.JSONDecoder()
+        self.buffer = ""
+        self.pos = 0
+
+    def _read(self, size):
+        """ Appends up to `size` characters to the buffer, dropping the ones already decoded. False at the end of the file """
+        chunk = self.reader.read(size)
+        if not chunk:
+            return False
+        self.buffer = self.buffer[self.pos:] + chunk
+        self.pos = 0
+        return True
+
+    def peek(self):
+        """ The next character which is not whitespace, or "" at the end of the file """
+        while True:
+            self.pos = _WHITESPACE.match(self.buffer, self.pos).end()
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self._read(self.chunk_size):
+                return ""
+
+    def expect(self, chars):
+        """ Consumes the next character, which must be one of `chars` """
+        char = self.peek()
+        if not char:
+            raise ValueError("Unexpected end of SQuAD file")
+        if char not in chars:
+            raise ValueError("Expected one of {!r} in SQuAD file, found {!r}".format(chars, char))
+        self.pos += 1
+        return char
+
+    def decode(self):
+        """ Decodes the next value, doubling the size of the reads while it continues past the end of the buffer """
+        self.peek()
+        read_size = self.chunk_size
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.pos)
+            except json.JSONDecodeError:
+                if not self._read(read_size):
+                    raise
+            else:
+                # A number at the end of the buffer may continue in the next read
+                if end < len(self.buffer) or not self._read(read_size):
+                    self.pos = end
+                    return value
+            read_size *= 2
+
+
+def _iter_squad_entries(reader, chunk_size=1 << 20):
+    """
+    Yields the entries of the top-level "data" array of a SQuAD-like JSON file one at a time,
+    so that only a single article is decoded and held in memory.
+    """
+    stream = _JSONStream(reader, chunk_size)
+    stream.expect("{")
+    if stream.peek() == "}":
+        raise ValueError("No \"data\" array found in SQuAD file")
+    while True:
+        key = stream.decode()
+        stream.expect(":")
+        if key == "data":
+            break
+        # Other top-level values, e.g. the version, are decoded and dropped
+        stream.decode()
+        if stream.expect(",}") == "}":
+            raise ValueError("No \"data\" array found in SQuAD file")
+    stream.expect("[")
+    if stream.peek() == "]":
+        return
+    while True:
+        yield stream.decode()
+        if stream.expect(",]") == "]":
+            return
+
+
+def _squad_example_from_context(
+    context_example,
+    qas_id,
+    question_text,
+    answer_text,
+    start_position_character,
+    title,
+    is_impossible,
+    answers,
+):
+    """ Builds a SquadExample that shares the doc tokens of `context_example` instead of splitting the context again """
+    example = SquadExample(
+        qas_id=qas_id,
+        question_text=question_text,
+        context_text="",
+        answer_text=answer_text,
+        start_position_character=None,
+        title=title,
+        is_impossible=is_impossible,
+        answers=answers,
+    )
+    example.context_text = context_example.context_text
+    example.doc_tokens = context_example.doc_tokens
+    example.char_to_word_offset = context_example.char_to_word_offset
+    if start_position_character is not None and not is_impossible:
+        char_to_word_offset = example.char_to_word_offset
+        example.start_position = char_to_word_offset[start_position_character]
+        example.end_position = char_to_word_offset[
+            min(start_position_character + len(answer_text) - 1, len(char_to_word_offset) - 1)
+        ]
+    return example
+
+
+def get_fast_tokenizer(tokenizer):
+    """
+    Returns a Rust-backed equivalent of `tokenizer`, or None if there is no fast equivalent.
+
+    WordPiece tokenizers (BERT, DistilBERT) are rebuilt from their vocabulary and basic tokenizer
+    settings, so both produce the same subword tokens. transformers 3.1 has no fast ALBERT tokenizer.
+    """
+    if getattr(tokenizer, "is_fast", False):
+        return tokenizer
+    if not isinstance(tokenizer, BertTokenizer):
+        return None
+    basic_tokenizer = tokenizer.basic_tokenizer
+    with tempfile.TemporaryDirectory() as vocab_dir:
+        vocab_file = tokenizer.save_vocabulary(vocab_dir)[0]
+        return BertTokenizerFast(
+            vocab_file,
+            do_lower_case=basic_tokenizer.do_lower_case,
+            tokenize_chinese_chars=basic_tokenizer.tokenize_chinese_chars,
+            strip_accents=getattr(basic_tokenizer, "strip_accents", None),
+            unk_token=tokenizer.unk_token,
+            sep_token=tokenizer.sep_token,
+            pad_token=tokenizer.pad_token,
+            cls_token=tokenizer.cls_token,
+            mask_token=tokenizer.mask_token,
+        )
+
+
+def _get_context_key(example):
+    """ Hash identifying the context of an example, shared by all questions asked about it """
+    return hashlib.sha1("\x00".join([str(example.title), example.context_text]).encode("utf-8")).hexdigest()
+
+
+def _supports_context_features(tokenizer):
+    """ Context features are packed as [CLS] query [SEP] doc [SEP], with padding on the right """
+    return tokenizer.padding_side == "right" and tokenizer.num_special_tokens_to_add(pair=True) == 3
+
+
+def _encode_docs(tokenizer, docs):
+    """ Encode whitespace-tokenized docs into subword ids, with the index of the word each subword comes from """
+    if tokenizer.is_fast:
+        encoded = tokenizer(docs, add_special_tokens=False, is_pretokenized=True)
+        return [(encoded["input_ids"][i], encoded.words(i)) for i in range(len(docs))]
+    encoded = []
+    for doc_tokens in docs:
+        doc_ids = []
+        tok_to_orig_index = []
+        for (i, token) in enumerate(doc_tokens):
+            sub_ids = tokenizer.convert_tokens_to_ids(tokenizer.tokenize(token))
+            doc_ids.extend(sub_ids)
+            tok_to_orig_index.extend([i] * len(sub_ids))
+        encoded.append((doc_ids, tok_to_orig_index))
+    return encoded
+
+
+def _build_context(tokenizer, doc_tokens, doc_ids, tok_to_orig_index):
+    """ Cache entry with the subword encoding of a context, and its windows for each query length """
+    # Words that produce no subword tokens point at the next token, as in the per-word tokenization
+    word_counts = np.bincount(np.asarray(tok_to_orig_index, dtype=np.int64), minlength=len(doc_tokens))
+    return {
+        "doc_ids": doc_ids,
+        "all_doc_tokens": tokenizer.convert_ids_to_tokens(doc_ids),
+        "tok_to_orig_index": tok_to_orig_index,
+        "orig_to_tok_index": np.concatenate(([0], np.cumsum(word_counts)[:-1])).tolist(),
+        "doc_spans": {},
+    }
+
+
+def _get_max_context(doc_spans, doc_length):
+    """
+    For each doc token, find the span in which it has the most context. Ties go to the first span,
+    as in transformers' `_new_check_is_max_context`.
+    """
+    positions = np.arange(doc_length)
+    scores = np.full((len(doc_spans), doc_length), -np.inf)
+    for span_index, (start, length) in enumerate(doc_spans):
+        span_positions = positions[start:start + length]
+        scores[span_index, start:start + length] = (
+            np.minimum(span_positions - start, start + length - 1 - span_positions) + 0.01 * length
+        )
+    return np.argmax(scores, axis=0)
+
+
+def _get_doc_spans(context, max_tokens_for_doc, doc_stride):
+    """ Windows over the context starting every `doc_stride` tokens, cached by the room left by the query """
+    if max_tokens_for_doc not in context["doc_spans"]:
+        doc_length = len(context["doc_ids"])
+        doc_spans = []
+        while len(doc_spans) * doc_stride < doc_length:
+            start = len(doc_spans) * doc_stride
+            length = min(doc_length - start, max_tokens_for_doc)
+            doc_spans.append((start, length))
+            if start + length >= doc_length:
+                break
+        max_context_span = _get_max_context(doc_spans, doc_length) if doc_spans else None
+        context["doc_spans"][max_tokens_for_doc] = (doc_spans, max_context_span)
+    return context["doc_spans"][max_tokens_for_doc]
+
+
+def _squad_convert_example_to_features_from_context(
+    example,
+    tokenizer,
+    query_ids,
+    context,
+    max_seq_length,
+    doc_stride,
+    is_training,
+):
+    """
+    Builds the features of one example from its encoded query and its cached context.
+
+    Mirrors `squad_convert_example_to_features` for right-padded tokenizers with a single separator
+    between the segments: the doc is cut into windows starting every `doc_stride` tokens and each
+    window is packed as [CLS] query [SEP] doc window [SEP] [PAD]...
+    """
+    if is_training and not example.is_impossible:
+        # If the answer cannot be found in the text, then skip this example.
+        actual_text = " ".join(example.doc_tokens[example.start_position : (example.end_position + 1)])
+        cleaned_answer_text = " ".join(whitespace_tokenize(example.answer_text))
+        if actual_text.find(cleaned_answer_text) == -1:
+            logger.warning("Could not find answer: '%s' vs. '%s'", actual_text, cleaned_answer_text)
+            return []
+
+    doc_ids = context["doc_ids"]
+    all_doc_tokens = context["all_doc_tokens"]
+    tok_to_orig_index = context["tok_to_orig_index"]
+    orig_to_tok_index = context["orig_to_tok_index"]
+
+    if is_training and not example.is_impossible:
+        tok_start_position = orig_to_tok_index[example.start_position]
+        if example.end_position < len(example.doc_tokens) - 1:
+            tok_end_position = orig_to_tok_index[example.end_position + 1] - 1
+        else:
+            tok_end_position = len(all_doc_tokens) - 1
+
+        (tok_start_position, tok_end_position) = _improve_answer_span(
+            all_doc_tokens, tok_start_position, tok_end_position, tokenizer, example.answer_text
+        )
+
+    # [CLS] query [SEP] precede the doc window, and one [SEP] follows it
+    doc_offset = len(query_ids) + 2
+    doc_spans, max_context_span = _get_doc_spans(context, max_seq_length - doc_offset - 1, doc_stride)
+    if not doc_spans:
+        return []
+
+    query_tokens = tokenizer.convert_ids_to_tokens(query_ids)
+    features = []
+    for span_index, (start, length) in enumerate(doc_spans):
+        input_ids = (
+            [tokenizer.cls_token_id] + query_ids + [tokenizer.sep_token_id]
+            + doc_ids[start:start + length] + [tokenizer.sep_token_id]
+        )
+        tokens = (
+            [tokenizer.cls_token] + query_tokens + [tokenizer.sep_token]
+            + all_doc_tokens[start:start + length] + [tokenizer.sep_token]
+        )
+        num_padding = max_seq_length - len(input_ids)
+        attention_mask = [1] * len(input_ids) + [0] * num_padding
+        token_type_ids = [0] * doc_offset + [1] * (length + 1) + [0] * num_padding
+        input_ids = input_ids + [tokenizer.pad_token_id] * num_padding
+
+        token_to_orig_map = {}
+        token_is_max_context = {}
+        for j in range(length):
+            token_to_orig_map[doc_offset + j] = tok_to_orig_index[start + j]
+            token_is_max_context[doc_offset + j] = bool(max_context_span[start + j] == span_index)
+
+        # p_mask: mask with 1 for token than cannot be in the answer (0 for token which can be in an answer)
+        # Padding stays unmasked, matching the per-example featuriser
+        cls_index = 0
+        p_mask = np.ones(max_seq_length, dtype=np.int64)
+        p_mask[doc_offset:] = 0
+        input_array = np.asarray(input_ids)
+        p_mask[(input_array == tokenizer.cls_token_id) | (input_array == tokenizer.sep_token_id)] = 1
+        p_mask[cls_index] = 0
+
+        span_is_impossible = example.is_impossible
+        start_position = 0
+        end_position = 0
+        if is_training and not span_is_impossible:
+            # For training, if our document chunk does not contain an annotation
+            # we throw it out, since there is nothing to predict.
+            doc_end = start + length - 1
+            if not (tok_start_position >= start and tok_end_position <= doc_end):
+                start_position = cls_index
+                end_position = cls_index
+                span_is_impossible = True
+            else:
+                start_position = tok_start_position - start + doc_offset
+                end_position = tok_end_position - start + doc_offset
+
+        features.append(
+            SquadFeatures(
+                input_ids,
+                attention_mask,
+                token_type_ids,
+                cls_index,
+                p_mask.tolist(),
+                example_index=0,
+                unique_id=0,
+                paragraph_len=length,
+                token_is_max_context=token_is_max_context,
+                tokens=tokens,
+                token_to_orig_map=token_to_orig_map,
+                start_position=start_position,
+                end_position=end_position,
+                is_impossible=span_is_impossible,
+                qas_id=example.qas_id,
+            )
+        )
+    return features
+
+
+def get_batched_tokenizer(tokenizer, use_fast_tokenizer=False):
+    """
+    Returns the tokenizer used for batched featurisation: the fast equivalent of `tokenizer` when
+    `use_fast_tokenizer` is set and one exists, else `tokenizer` itself. Returns None when the
+    tokenizer's input layout is not supported by the batched path.
+    """
+    batched_tokenizer = None
+    if use_fast_tokenizer:
+        batched_tokenizer = get_fast_tokenizer(tokenizer)
+        if batched_tokenizer is None:
+            logger.warning("No fast tokenizer available for %s, encoding with the slow tokenizer", type(tokenizer).__name__)
+    if batched_tokenizer is None:
+        batched_tokenizer = tokenizer
+    if not _supports_context_features(batched_tokenizer):
+        logger.warning("Batched featurisation does not support %s, using the per-example featuriser", type(tokenizer).__name__)
+        return None
+    return batched_tokenizer
+
+
+def _featurise_batch(
+    batch,
+    tokenizer,
+    cache,
+    max_seq_length,
+    doc_stride,
+    max_query_length,
+    is_training,
+):
+    """
+    Featurise a batch of examples, encoding the contexts missing from `cache` once and adding them to it.
+    Returns the features of each example, and the contexts the batch added to the cache.
+    """
+    queries = tokenizer(
+        [example.question_text for example in batch],
+        add_special_tokens=False,
+        truncation=True,
+        max_length=max_query_length,
+    )
+    context_keys = [_get_context_key(example) for example in batch]
+    new_contexts = {}
+    for key, example in zip(context_keys, batch):
+        if key not in cache:
+            new_contexts.setdefault(key, example.doc_tokens)
+    encoded_docs = _encode_docs(tokenizer, list(new_contexts.values()))
+    for (key, doc_tokens), (doc_ids, tok_to_orig_index) in zip(list(new_contexts.items()), encoded_docs):
+        new_contexts[key] = cache[key] = _build_context(tokenizer, doc_tokens, doc_ids, tok_to_orig_index)
+
+    features = [
+        _squad_convert_example_to_features_from_context(
+            example,
+            tokenizer,
+            queries["input_ids"][i],
+            cache[context_keys[i]],
+            max_seq_length=max_seq_length,
+            doc_stride=doc_stride,
+            is_training=is_training,
+        )
+        for i, example in enumerate(batch)
+    ]
+    return features, new_contexts
+
+
+# The state of a batched featurisation worker, which is kept across its batches
+_batched_worker_state = {}
+
+
+def _init_batched_worker(tokenizer, context_cache, featurize_args):
+    """ Set up a batched featurisation worker, with its own copy of the context cache """
+    _batched_worker_state.clear()
+    _batched_worker_state.update(
+                        tokenizer=tokenizer,
+                        context_cache=dict(context_cache or {}),
+                        return_contexts=context_cache is not None,
+                        featurize_args=featurize_args)
+
+
+def _batched_worker(batch):
+    """ Featurise a batch in a worker, returning the new contexts only if the caller keeps a context cache """
+    state = _batched_worker_state
+    features, new_contexts = _featurise_batch(batch, state["tokenizer"], state["context_cache"], **state["featurize_args"])
+    return features, new_contexts if state["return_contexts"] else {}
+
+
+def _batched_squad_convert_examples_to_features(
+    examples,
+    tokenizer,
+    max_seq_length,
+    doc_stride,
+    max_query_length,
+    is_training,
+    batch_size,
+    tqdm_enabled,
+    total=None,
+    context_cache=None,
+    threads=1,
+):
+    """
+    Featurise examples batch by batch. The queries of a batch are encoded in one call, and each
+    distinct context is encoded and windowed only once, then shared by all questions about it.
+    Without a `context_cache`, contexts are only shared within a batch.
+
+    With several threads, the batches are featurised by a pool of processes. Each worker keeps its
+    own copy of the context cache, and the contexts they encode are added to `context_cache`.
+    """
+    featurize_args = dict(
+        max_seq_length=max_seq_length,
+        doc_stride=doc_stride,
+        max_query_length=max_query_length,
+        is_training=is_training,
+    )
+    if threads > 1 and total is not None:
+        # Smaller batches, so that every worker gets some of a small set
+        batch_size = max(1, min(batch_size, -(-total // threads)))
+    examples = iter(examples)
+    batches = iter(lambda: list(itertools.islice(examples, batch_size)), [])
+
+    pool = None
+    if threads > 1:
+        pool = Pool(threads, initializer=_init_batched_worker, initargs=(tokenizer, context_cache, featurize_args))
+        batch_results = pool.imap(_batched_worker, batches)
+    else:
+        batch_results = (
+            _featurise_batch(batch, tokenizer, context_cache if context_cache is not None else {}, **featurize_args)
+            for batch in batches
+        )
+
+    features = []
+    try:
+        with tqdm(total=total, desc="convert squad examples to features", disable=not tqdm_enabled) as pbar:
+            for batch_features, new_contexts in batch_results:
+                features.extend(batch_features)
+                if context_cache is not None:
+                    context_cache.update(new_contexts)
+                pbar.update(len(batch_features))
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+    return features
+
+
 def alum_squad_convert_examples_to_features(
     examples,
     tokenizer,
@@ -33,13 +524,17 @@ def alum_squad_convert_examples_to_features(
     return_dataset=False,
     threads=1,
     tqdm_enabled=True,
+    is_training=True,
+    use_fast_tokenizer=False,
+    batch_size=1000,
+    context_cache=None,
 ):
     """
     Converts a list of examples into a list of features that can be directly given as input to a model.
     It is model-dependant and takes advantage of many of the tokenizer's features to create the model's inputs.
 
     Args:
-        examples: list of :class:`~transformers.data.processors.squad.SquadExample`
+        examples: list or iterable of :class:`~transformers.data.processors.squad.SquadExample`
         tokenizer: an instance of a child of :class:`~transformers.PreTrainedTokenizer`
         max_seq_length: The maximum sequence length of the inputs.
         doc_stride: The stride used when the context is too large and is split across several features.
@@ -47,7 +542,19 @@ def alum_squad_convert_examples_to_features(
         padding_strategy: Default to "max_length". Which padding strategy to use
         return_dataset: Default False. Optional 'pt'
             if 'pt': returns a torch.data.TensorDataset,
-        threads: multiple processing threadsa-smi
+        threads: Default 1. Number of worker processes. With 1 the examples are featurised in-process,
+            otherwise they are spread over a multiprocessing pool. In the batched path, whole batches are
+            spread over the workers, each with its own copy of `context_cache`.
+        tqdm_enabled: Default True. Show progress bars.
+        is_training: Default True. Compute start and end positions for each feature. The features are also
+            used for adversarial evaluation, which needs the gold positions, so this is on for dev sets too.
+        use_fast_tokenizer: Default False. Encode the examples in batches with the Rust fast tokenizer
+            equivalent to `tokenizer`, when there is one. The features are the same as with the per-example path.
+        batch_size: Default 1000. Number of examples encoded per call in the batched path.
+        context_cache: Default None. Optional dict of context encodings, keyed by a hash of (context, title).
+            Share one dict between calls, e.g. for a training set and its augmentations, to encode and window
+            each context once and only encode the new questions. It must only be shared between calls using
+            the same tokenizer. Setting it selects the batched path, with the slow tokenizer if no fast one is used.
 
 
     Returns:
@@ -69,24 +576,55 @@ def alum_squad_convert_examples_to_features(
 
     # Defining helper methods
     features = []
-    threads = min(threads, cpu_count())
-    with Pool(threads, initializer=squad_convert_example_to_features_init, initargs=(tokenizer,)) as p:
-        annotate_ = partial(
-            squad_convert_example_to_features,
+    batched_tokenizer = None
+    if use_fast_tokenizer or context_cache is not None:
+        batched_tokenizer = get_batched_tokenizer(tokenizer, use_fast_tokenizer)
+    threads = max(1, min(threads, cpu_count()))
+    num_examples = _num_examples(examples)
+    annotate_ = partial(
+        squad_convert_example_to_features,
+        max_seq_length=max_seq_length,
+        doc_stride=doc_stride,
+        max_query_length=max_query_length,
+        padding_strategy=padding_strategy,
+        is_training=is_training,
+    )
+    if batched_tokenizer is not None:
+        features = _batched_squad_convert_examples_to_features(
+            examples,
+            batched_tokenizer,
             max_seq_length=max_seq_length,
             doc_stride=doc_stride,
             max_query_length=max_query_length,
-            padding_strategy=padding_strategy,
-            is_training=True,
+            is_training=is_training,
+            batch_size=batch_size,
+            tqdm_enabled=tqdm_enabled,
+            total=num_examples,
+            context_cache=context_cache,
+            threads=threads,
         )
-        features = list(
-            tqdm(
-                p.imap(annotate_, examples, chunksize=32),
-                total=len(examples),
+    elif threads == 1:
+        # Featurise in-process, without starting a pool or pickling the tokenizer
+        squad_convert_example_to_features_init(tokenizer)
+        features = [
+            annotate_(example)
+            for example in tqdm(
+                examples,
+                total=num_examples,
                 desc="convert squad examples to features",
                 disable=not tqdm_enabled,
             )
-        )
+        ]
+    else:
+        with Pool(threads, initializer=squad_convert_example_to_features_init, initargs=(tokenizer,)) as p:
+            features = list(
+                tqdm(
+                    p.imap(annotate_, examples, chunksize=_get_chunksize(num_examples, threads)),
+                    total=num_examples,
+                    desc="convert squad examples to features",
+                    disable=not tqdm_enabled,
+                )
+            )
     new_features = []
     unique_id = 1000000000
     example_index = 0
@@ -145,6 +683,19 @@ class AlumSquadProcessor(DataProcessor):
         """
         Returns the training examples from the data directory.
 
+        Args:
+            data_dir: Directory containing the data files used for training and evaluating.
+            filename: None by default, specify this if the training file has a different name than the original one
+                which is `train-v1.1.json` and `train-v2.0.json` for squad versions 1.1 and 2.0 respectively.
+
+        """
+        return list(self.alum_iter_examples(data_dir, filename))
+
+    def alum_iter_examples(self, data_dir, filename=None):
+        """
+        Yields the examples from the data directory, streaming the file one article at a time.
+        The questions of a paragraph share the doc tokens of its context, which is split only once.
+
         Args:
             data_dir: Directory containing the data files used for training and evaluating.
             filename: None by default, specify this if the training file has a different name than the original one
@@ -160,42 +711,90 @@ class AlumSquadProcessor(DataProcessor):
         with open(
             os.path.join(data_dir, self.train_file if filename is None else filename), "r", encoding="utf-8"
         ) as reader:
-            input_data = json.load(reader)["data"]
-        return self._create_examples(input_data, "train")
+            for entry in _iter_squad_entries(reader):
+                for paragraph in entry["paragraphs"]:
+                    yield from self._create_paragraph_examples(entry["title"], paragraph)
+
+    def alum_iter_aug_examples(self, aug_examples, title_map, context_map):
+        """
+        Yields the examples of flat augmented records, such as those of `SQuADDataset.iter_generate`,
+        without formatting them as a SQuAD file. Consecutive records of the same context share its doc tokens.
+
+        Args:
+            aug_examples: Iterable of dicts with the `id`, `ctx_id`, `tle_id`, `question` and `answers` of each
+                augmented question, and optionally `is_impossible`.
+            title_map: The titles keyed by `tle_id`.
+            context_map: The contexts keyed by `ctx_id`.
+
+        """
+        aug_examples = (x for x in aug_examples if x["question"])
+        for i, ((tle_id, ctx_id), group) in enumerate(
+            itertools.groupby(aug_examples, key=lambda x: (x["tle_id"], x["ctx_id"]))
+        ):
+            paragraph = {
+                "context": context_map[ctx_id],
+                "qas": [
+                    {
+                        # The id of the original question, made unique for each perturbation
+                        "id": "{}-aug{}-{}".format(x["id"], i, j),
+                        "question": x["question"],
+                        "answers": x["answers"],
+                        "is_impossible": x.get("is_impossible", False),
+                    }
+                    for j, x in enumerate(group)
+                ],
+            }
+            yield from self._create_paragraph_examples(title_map[tle_id], paragraph)
 
     def _create_examples(self, input_data, set_type):
         examples = []
         for entry in tqdm(input_data):
-            title = entry["title"]
             for paragraph in entry["paragraphs"]:
-                context_text = paragraph["context"]
-                for qa in paragraph["qas"]:
-                    qas_id = qa["id"]
-                    question_text = qa["question"]
-                    start_position_character = None
-                    answer_text = None
-                    answers = []
-
-                    is_impossible = qa.get("is_impossible", False)
-                    if not is_impossible:
-                        answer = qa["answers"][0]
-                        answers = qa["answers"]
-                        answer_text = answer["text"]
-                        start_position_character = answer["answer_start"]
-
-                    example = SquadExample(
-                        qas_id=qas_id,
-                        question_text=question_text,
-                        context_text=context_text,
-                        answer_text=answer_text,
-                        start_position_character=start_position_character,
-                        title=title,
-                        is_impossible=is_impossible,
-                        answers=answers,
-                    )
-                    examples.append(example)
+                examples.extend(self._create_paragraph_examples(entry["title"], paragraph))
         return examples
 
+    def _create_paragraph_examples(self, title, paragraph):
+        context_text = paragraph["context"]
+        context_example = None
+        for qa in paragraph["qas"]:
+            qas_id = qa["id"]
+            question_text = qa["question"]
+            start_position_character = None
+            answer_text = None
+            answers = []
+
+            is_impossible = qa.get("is_impossible", False)
+            if not is_impossible:
+                answer = qa["answers"][0]
+                answers = qa["answers"]
+                answer_text = answer["text"]
+                start_position_character = answer["answer_start"]
+
+            if context_example is None:
+                example = SquadExample(
+                    qas_id=qas_id,
+                    question_text=question_text,
+                    context_text=context_text,
+                    answer_text=answer_text,
+                    start_position_character=start_position_character,
+                    title=title,
+                    is_impossible=is_impossible,
+                    answers=answers,
+                )
+                context_example = example
+            else:
+                example = _squad_example_from_context(
+                    context_example,
+                    qas_id=qas_id,
+                    question_text=question_text,
+                    answer_text=answer_text,
+                    start_position_character=start_position_character,
+                    title=title,
+                    is_impossible=is_impossible,
+                    answers=answers,
+                )
+            yield example
+
 
 class AlumSquadV1Processor(AlumSquadProcessor):
     train_file = "train-v1.1.json"
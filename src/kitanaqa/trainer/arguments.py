@@ -279,6 +279,22 @@ class ModelArguments:
     doc_stride: Optional[int] = field(
         default=128
     )
+    preprocessing_num_workers: Optional[int] = field(
+        default=1,
+        metadata={"help": "Number of processes used to convert examples to features, with either the per-example or the batched featuriser. Runs in-process when set to 1."}
+    )
+    use_fast_tokenizer: bool = field(
+        default=False,
+        metadata={"help": "Featurise examples in batches with the Rust fast tokenizer, where one exists for model_type."}
+    )
+    bf16: bool = field(
+        default=False,
+        metadata={"help": "Use bfloat16 autocast mixed precision, on CPU or GPU. Use the fp16 training argument for float16 on GPU."}
+    )
+    gradient_checkpointing: bool = field(
+        default=False,
+        metadata={"help": "Recompute the activations of each encoder layer during backward instead of storing them, in normal and adversarial steps. Supported for bert, albert and distilbert."}
+    )
     freeze_embeds: bool = field(
         default=False,
         metadata={"help": "Freeze token embeddings and positional embeddings for bart, just token embeddings for t5."}
@@ -287,6 +303,70 @@ class ModelArguments:
         default=True,
         metadata={"help": "Use Augmented training."}
     )
+    do_online_aug: bool = field(
+        default=False,
+        metadata={"help": "Perturb training questions on the fly each epoch instead of loading aug_file_path."}
+    )
+    do_aug_stage: bool = field(
+        default=False,
+        metadata={"help": "Generate the augmented training set from train_file_path instead of loading aug_file_path. Perturbations are featurised as they are generated and cached with their generation arguments, so the stage is skipped when a matching cache exists."}
+    )
+    aug_sample_ratio: float = field(
+        default=1.,
+        metadata={"help": "Number of augmented features per original feature in each epoch of online augmentation, or of augmented examples per original example in the augmentation stage."}
+    )
+    aug_num_replacements: int = field(
+        default=2,
+        metadata={"help": "Max number of terms perturbed in a question by online augmentation or the augmentation stage."}
+    )
+    aug_p_dropword: float = field(
+        default=0.1,
+        metadata={"help": "Sampling probability of the drop perturbation in online augmentation or the augmentation stage."}
+    )
+    aug_p_replace: float = field(
+        default=0.1,
+        metadata={"help": "Sampling probability of the synonym perturbation in online augmentation or the augmentation stage."}
+    )
+    aug_p_misspelling: float = field(
+        default=0.1,
+        metadata={"help": "Sampling probability of the misspelling perturbation in online augmentation or the augmentation stage."}
+    )
+    aug_mix_ratio: Optional[float] = field(
+        default=None,
+        metadata={"help": "Number of augmented features drawn per original feature in each epoch, instead of concatenating the augmented and original training sets. Epochs keep the length set by this ratio."}
+    )
+    aug_mix_ratio_final: Optional[float] = field(
+        default=None,
+        metadata={"help": "Mixing ratio of the last epoch, reached following aug_mix_schedule."}
+    )
+    aug_mix_schedule: Optional[str] = field(
+        default=None,
+        metadata={"help": "Curriculum of the mixing ratio over epochs, one of linear or exp."}
+    )
+    use_feature_store: bool = field(
+        default=False,
+        metadata={"help": "Train from memory-mapped copies of the cached training and augmented features, which are read from disk as batches are drawn instead of being held in memory."}
+    )
+    aug_sampling_strategy: str = field(
+        default='random',
+        metadata={"help": "Sampling of the terms perturbed by the augmentation stage or online augmentation, one of random, topK or bottomK."}
+    )
+    aug_sampling_k: int = field(
+        default=3,
+        metadata={"help": "Number of terms considered by topK or bottomK sampling in the augmentation stage or online augmentation."}
+    )
+    aug_importance_scores_file: Optional[str] = field(
+        default=None,
+        metadata={"help": "Term importance scores of the training questions, as written by kitanaqa.augment.importance_scores, used by topK or bottomK sampling."}
+    )
+    aug_seed: int = field(
+        default=42,
+        metadata={"help": "Random seed of the augmentation stage."}
+    )
+    aug_num_workers: int = field(
+        default=0,
+        metadata={"help": "Number of DataLoader workers generating online augmentations. Runs in the training process when set to 0."}
+    )
     do_adv_eval: bool = field(
         default=False,
         metadata={"help": "Perform adversarial attack evaluation."}
@@ -295,6 +375,10 @@ class ModelArguments:
         default=True,
         metadata={"help": "Use ALUM loss."}
     )
+    adv_mode: str = field(
+        default="alum",
+        metadata={"help": "Adversarial training mode with do_alum. One of 'alum' for ALUM virtual adversarial steps, or 'free' for free adversarial training, which replays each batch K times with an optimizer step per replay, updating the perturbation from the same backward pass and carrying it over to the next replay. num_train_epochs is divided by K, so training costs about as much as normal training. Requires K >= 2, alpha is not used in this mode."}
+    )
     eta: Optional[float] = field(
         default=1e-3,
         metadata={"help": "Perturbation step size in ALUM training."}
@@ -311,6 +395,18 @@ class ModelArguments:
         default=None,
         metadata={"help": "ALUM alpha param schedule type."}
     )
+    eta_final: Optional[float] = field(
+        default=None,
+        metadata={"help": "Final perturbation step size of the adversarial attack when adv_step_schedule is set."}
+    )
+    adv_step_schedule: Optional[str] = field(
+        default=None,
+        metadata={"help": "Schedule of the adversarial attack step size from eta to eta_final over the K iterations, 'linear' or 'exp'. Constant by default."}
+    )
+    adv_norm: str = field(
+        default="inf",
+        metadata={"help": "Norm bounding adversarial perturbations to eps, 'inf' or '2'."}
+    )
     eps: Optional[float] = field(
         default=1e-5,
         metadata={"help": "Perturbation radius in ALUM training."}
@@ -321,7 +417,7 @@ class ModelArguments:
     )
     K: Optional[float] = field(
         default=1,
-        metadata={"help": "Attack approx iteration in ALUM training."}
+        metadata={"help": "Attack approx iteration in ALUM training, or number of replays of each batch with adv_mode 'free'."}
     )
     data_dir: Optional[str] = field(
         default=None,
@@ -331,3 +427,19 @@ class ModelArguments:
         default=False,
         metadata={"help" : "Evaluate all checkpoints in output_dir"}
     )
+    eval_num_workers: int = field(
+        default=1,
+        metadata={"help" : "Number of processes evaluating (checkpoint, predict set) pairs in parallel on CPU, each with an equal share of the CPU threads."}
+    )
+    eval_results_file: Optional[str] = field(
+        default=None,
+        metadata={"help" : "JSON lines file storing the evaluation results as they finish, keyed by the checkpoint weights, predict file, eval arguments and do_adv_eval. Stored results are reused instead of evaluating again. Defaults to eval_results.jsonl in output_dir."}
+    )
+    flow_num_workers: int = field(
+        default=1,
+        metadata={"help" : "Number of flow tasks run at the same time in threads, e.g. the evaluation of (checkpoint, predict set) pairs or augmented training runs. Each evaluation thread gets an equal share of the CPU threads."}
+    )
+    aug_configs_file: Optional[str] = field(
+        default=None,
+        metadata={"help" : "JSON file with a list of argument overrides, e.g. aug_file_path or aug_p_replace, each trained as a separate run of the flow."}
+    )
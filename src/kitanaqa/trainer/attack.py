@@ -0,0 +1,183 @@
+import itertools
+import torch
+from torch import autograd, nn
+from typing import Iterable, List, Tuple
+
+from kitanaqa.trainer.custom_schedulers import get_custom_exp, get_custom_linear
+
+
+def get_embed_layer(
+        model: nn.Module,
+        model_type: str) -> nn.Module:
+    """ The input embedding layer of a bert, albert or distilbert QA model """
+    if isinstance(model, nn.DataParallel):
+        model = model.module
+    if model_type == 'bert':
+        return model.bert.get_input_embeddings()
+    elif model_type == 'distilbert':
+        return model.distilbert.get_input_embeddings()
+    elif model_type == 'albert':
+        return model.albert.get_input_embeddings()
+    raise NotImplementedError('Only bert, albert, distilbert models are supported')
+
+
+def init_delta(
+        input_embedding: torch.Tensor,
+        embed_mask: torch.Tensor,
+        sigma: float) -> torch.Tensor:
+    """ Sample an isotropic normal perturbation with std sigma for each example, zeroed where embed_mask is 0 """
+    delta = torch.randn_like(input_embedding) * sigma * embed_mask
+    return delta.requires_grad_()
+
+
+def _example_norms(x: torch.Tensor) -> torch.Tensor:
+    """ L2 norm of each example of a batch, broadcastable against the batch """
+    dims = list(range(1, x.dim()))
+    return torch.sqrt(torch.sum(x * x, dim=dims, keepdim=True))
+
+
+def project(
+        delta: torch.Tensor,
+        eps: float,
+        norm: str = 'inf') -> torch.Tensor:
+    """ Project the perturbation of each example onto the norm ball of radius eps """
+    if norm == 'inf':
+        return torch.clamp(delta, min=-eps, max=eps)
+    elif norm == '2':
+        return torch.clamp(eps / _example_norms(delta).clamp(min=1e-12), max=1) * delta
+    raise NotImplementedError("Only norm = 'inf' and norm = '2' have been implemented")
+
+
+def ascent_step(
+        delta: torch.Tensor,
+        grad: torch.Tensor,
+        step_size: float,
+        norm: str = 'inf') -> torch.Tensor:
+    """ Steepest ascent step of the given size for the norm. It only depends on the direction of grad. """
+    if norm == 'inf':
+        return delta + step_size * grad.sign()
+    elif norm == '2':
+        return delta + step_size * grad / _example_norms(grad).clamp(min=1e-12)
+    raise NotImplementedError("Only norm = 'inf' and norm = '2' have been implemented")
+
+
+def get_step_schedule(
+        num_steps: int,
+        step_size: float,
+        step_size_final: float = None,
+        schedule: str = None) -> Iterable:
+    """ Step sizes of the attack iterations, constant or following a linear or exp schedule to step_size_final """
+    if num_steps > 1 and step_size_final is not None:
+        if schedule == 'linear':
+            return get_custom_linear(max_steps=num_steps, start_val=step_size, end_val=step_size_final)
+        elif schedule == 'exp':
+            return get_custom_exp(max_steps=num_steps, start_val=step_size, end_val=step_size_final)
+    return itertools.repeat(step_size, num_steps)
+
+
+class PGDAttack():
+    """ Projected gradient descent attack on the input embeddings of a QA model
+    ...
+
+    The attack only differentiates with respect to the perturbation, so the gradients of the
+    model parameters are neither computed nor accumulated. The input embeddings are looked up
+    once per batch, and the predictions on the perturbed inputs run under inference mode.
+
+    Methods
+    ----------
+    perturb(batch)
+      Returns the input embeddings of the batch and their adversarial perturbation.
+    __call__(batch)
+      Returns the start and end logits of the model on the perturbed batch.
+    """
+    def __init__(
+            self,
+            model: nn.Module,
+            embed_layer: nn.Module,
+            model_type: str,
+            eps: float,
+            step_size: float,
+            num_steps: int = 1,
+            sigma: float = 0.,
+            norm: str = 'inf',
+            step_schedule: str = None,
+            step_size_final: float = None):
+        """
+        Parameters
+        ----------
+        model : nn.Module
+            The QA model under attack.
+        embed_layer : nn.Module
+            The input embedding layer of the model.
+        model_type : str
+            One of `bert`, `albert`, `distilbert`.
+        eps : float
+            Radius of the norm ball bounding the perturbation of each example.
+        step_size : float
+            Step size of the attack iterations.
+        num_steps : Optional(int)
+            Number of attack iterations. The default value is 1.
+        sigma : Optional(float)
+            Std of the normal noise the perturbation is initialised with. The default value is 0.
+        norm : Optional(str)
+            Norm bounding the perturbation, `inf` or `2`. The default is `inf`.
+        step_schedule : Optional(str)
+            Schedule of the step size over the iterations, `linear` or `exp` from step_size to step_size_final. The default is a constant step size.
+        step_size_final : Optional(float)
+            Step size of the last iteration when a step_schedule is given.
+        """
+        if norm not in ['inf', '2']:
+            raise NotImplementedError("Only norm = 'inf' and norm = '2' have been implemented")
+        self.model = model
+        self.embed_layer = embed_layer
+        self.model_type = model_type
+        self.eps = eps
+        self.step_size = step_size
+        self.num_steps = int(num_steps)
+        self.sigma = sigma
+        self.norm = norm
+        self.step_schedule = step_schedule
+        self.step_size_final = step_size_final
+
+    def _inputs(self, batch: Tuple, inputs_embeds: torch.Tensor, with_positions: bool = True):
+        inputs = {
+            "input_ids": None,
+            "attention_mask": batch[1],
+            "token_type_ids": batch[2],
+            "inputs_embeds": inputs_embeds,
+        }
+        if with_positions:
+            inputs["start_positions"] = batch[3]
+            inputs["end_positions"] = batch[4]
+        if self.model_type in ["xlm", "roberta", "distilbert"]:
+            del inputs["token_type_ids"]
+        return inputs
+
+    def perturb(self, batch: Tuple) -> Tuple[torch.Tensor, torch.Tensor]:
+        """ Returns the input embeddings of the batch and the perturbation maximizing the loss on the gold positions """
+        with torch.no_grad():
+            input_embedding = self.embed_layer(batch[0])
+        # Padding is not perturbed
+        embed_mask = batch[1].unsqueeze(-1).to(input_embedding.dtype)
+        delta = init_delta(input_embedding, embed_mask, self.sigma)
+
+        step_sizes = get_step_schedule(self.num_steps, self.step_size, self.step_size_final, self.step_schedule)
+        for step_size in step_sizes:
+            with torch.enable_grad():
+                outputs = self.model(**self._inputs(batch, input_embedding + delta))
+                adv_loss = outputs[0]
+                if adv_loss.dim() > 0:
+                    adv_loss = adv_loss.mean()  # mean() to average on multi-gpu parallel (not distributed) evaluation
+                grad, = autograd.grad(adv_loss, delta)
+            # Both steps are taken per example, so they do not depend on the batch mean in the loss
+            with torch.no_grad():
+                delta = project(ascent_step(delta, grad, step_size, self.norm), self.eps, self.norm) * embed_mask
+            delta.requires_grad_()
+        return input_embedding, delta.detach()
+
+    def __call__(self, batch: Tuple) -> List[torch.Tensor]:
+        """ Returns the start and end logits of the model on the perturbed batch """
+        input_embedding, delta = self.perturb(batch)
+        with torch.inference_mode():
+            outputs = self.model(**self._inputs(batch, input_embedding + delta, with_positions=False))
+        return outputs[:2]
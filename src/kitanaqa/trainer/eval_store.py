@@ -0,0 +1,121 @@
+import collections
+import hashlib
+import json
+import os
+import threading
+from typing import Dict, Optional, Tuple
+
+from kitanaqa import get_logger
+
+logger = get_logger()
+
+# Serialises the writes of the evaluation tasks running in threads
+_write_lock = threading.Lock()
+
+# Model arguments which change the evaluation metrics
+EVAL_ARG_NAMES = [
+    "model_type",
+    "tokenizer_name_or_path",
+    "max_seq_length",
+    "doc_stride",
+    "max_query_length",
+    "n_best_size",
+    "max_answer_length",
+    "do_lower_case",
+    "version_2_with_negative",
+    "null_score_diff_threshold",
+]
+# Model arguments which also change the adversarial evaluation metrics
+ADV_EVAL_ARG_NAMES = [
+    "eps",
+    "eta",
+    "eta_final",
+    "adv_step_schedule",
+    "adv_norm",
+    "K",
+    "sigma",
+]
+
+
+def file_hash(path: str) -> str:
+    """ SHA-1 of the content of a file, read in chunks """
+    sha = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def eval_args_hash(args, adv: bool) -> str:
+    """ SHA-1 of the model arguments which change the metrics of an evaluation """
+    names = EVAL_ARG_NAMES + (ADV_EVAL_ARG_NAMES if adv else [])
+    values = {name: getattr(args, name, None) for name in names}
+    return hashlib.sha1(json.dumps(values, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+
+class EvalResultStore():
+    """ JSON lines store of evaluation results
+    ...
+
+    Each line records the metrics of a checkpoint on a predict set, keyed by the hash of the
+    checkpoint weights, the hash of the predict file, the hash of the eval arguments and whether
+    the evaluation is adversarial. Evaluations are only recomputed when one of these changes.
+    Records are appended as they finish, so an interrupted sweep keeps its finished results.
+
+    Methods
+    ----------
+    get(key)
+      Returns the recorded metrics for key, or None.
+    put(key, results, **info)
+      Records the metrics for key, along with descriptive fields such as the checkpoint path.
+    """
+    def __init__(self, path: Optional[str]):
+        """
+        Parameters
+        ----------
+        path : Optional(str)
+            Path of the JSON lines file. If None, results are neither read nor written.
+        """
+        self.path = path
+        self._results = {}
+        if path and os.path.exists(path):
+            with open(path) as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        # The last line of an interrupted sweep may be incomplete
+                        continue
+                    self._results[self._key(record)] = collections.OrderedDict(record["eval"])
+            logger.info("Loaded %d evaluation results from %s", len(self._results), path)
+
+    @staticmethod
+    def _key(record: Dict) -> Tuple:
+        return (record["weights_hash"], record["predict_file_hash"], record["eval_args_hash"], record["adv"])
+
+    @staticmethod
+    def make_key(weights_hash: str, predict_file_hash: str, eval_args_hash: str, adv: bool) -> Dict:
+        """ The fields identifying an evaluation """
+        return {
+            "weights_hash": weights_hash,
+            "predict_file_hash": predict_file_hash,
+            "eval_args_hash": eval_args_hash,
+            "adv": adv,
+        }
+
+    def get(self, key: Dict) -> Optional[Dict]:
+        return self._results.get(self._key(key))
+
+    def put(self, key: Dict, results: Dict, **info):
+        self._results[self._key(key)] = results
+        if not self.path:
+            return
+        record = dict(info, eval=results, **key)
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        with _write_lock, open(self.path, "a+") as f:
+            # Start a new line after the incomplete last line of an interrupted sweep
+            if f.tell() > 0:
+                f.seek(f.tell() - 1)
+                if f.read(1) != "\n":
+                    f.write("\n")
+            f.write(json.dumps(record) + "\n")
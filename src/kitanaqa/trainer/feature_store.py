@@ -0,0 +1,107 @@
+import os
+import shutil
+import numpy as np
+import torch
+from torch.utils.data import Dataset, TensorDataset
+
+from kitanaqa import get_logger
+
+logger = get_logger()
+
+# Columns of the training TensorDataset, with the compact dtype they are stored in and the dtype they are read as
+FEATURE_COLUMNS = [
+    ("input_ids", np.int32, torch.long),
+    ("attention_mask", np.int8, torch.long),
+    ("token_type_ids", np.int8, torch.long),
+    ("start_positions", np.int32, torch.long),
+    ("end_positions", np.int32, torch.long),
+    ("feature_index", np.int32, torch.long),
+    ("cls_index", np.int32, torch.long),
+    ("p_mask", np.int8, torch.float),
+    ("is_impossible", np.int8, torch.float),
+]
+
+
+def _column_file(path: str, name: str) -> str:
+    return os.path.join(path, name + ".npy")
+
+
+def feature_store_exists(path: str) -> bool:
+    """ Whether a complete feature store was written at path """
+    return all(os.path.exists(_column_file(path, name)) for name, _, _ in FEATURE_COLUMNS)
+
+
+def save_feature_store(dataset: TensorDataset, path: str):
+    """Writes the tensors of a training dataset to a feature store, one .npy file per column
+
+    Parameters
+    ----------
+    dataset : torch.utils.data.TensorDataset
+        The features in the layout of `alum_squad_convert_examples_to_features`.
+    path : str
+        The directory of the store. It is written under a temporary name and renamed once complete.
+    """
+    if len(dataset.tensors) != len(FEATURE_COLUMNS):
+        raise ValueError('Expected a dataset of {} tensors, got {}'.format(len(FEATURE_COLUMNS), len(dataset.tensors)))
+    tmp_path = path + ".tmp"
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    os.makedirs(tmp_path)
+    for (name, dtype, _), tensor in zip(FEATURE_COLUMNS, dataset.tensors):
+        array = tensor.numpy()
+        stored = array.astype(dtype)
+        if not np.array_equal(stored, array):
+            raise ValueError('Column {} does not fit in {}'.format(name, np.dtype(dtype).name))
+        np.save(_column_file(tmp_path, name), stored)
+    shutil.rmtree(path, ignore_errors=True)
+    os.replace(tmp_path, path)
+    logger.info("Saved %d features into feature store %s", len(dataset), path)
+
+
+class FeatureStore(Dataset):
+    """ Training features read from memory-mapped .npy files
+    ...
+
+    Rows are read from disk when they are indexed, so the features of a large training set are
+    not held in memory, and the OS page cache is shared between DataLoader workers. Each row has
+    the tensors, and dtypes, of a row of the training TensorDataset.
+    """
+    def __init__(self, path: str):
+        """
+        Parameters
+        ----------
+        path : str
+            The directory written by `save_feature_store`.
+        """
+        if not feature_store_exists(path):
+            raise FileNotFoundError('No feature store found at {}'.format(path))
+        self.path = path
+        self._columns = None
+        self._num_features = len(self._get_columns()[0])
+
+    def _get_columns(self):
+        # Opened lazily, so that DataLoader workers map the files rather than receive a pickled copy
+        if self._columns is None:
+            self._columns = [np.load(_column_file(self.path, name), mmap_mode="r") for name, _, _ in FEATURE_COLUMNS]
+        return self._columns
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_columns"] = None
+        return state
+
+    def __len__(self):
+        return self._num_features
+
+    def __getitem__(self, index):
+        return tuple(
+            torch.from_numpy(np.array(column[index])).to(torch_dtype)
+            for column, (_, _, torch_dtype) in zip(self._get_columns(), FEATURE_COLUMNS)
+        )
+
+    def __getitems__(self, indices):
+        """ Reads the rows of a batch with one indexing of each column, used by DataLoaders of torch>=2.0 """
+        columns = [
+            torch.from_numpy(column[np.asarray(indices)]).to(torch_dtype)
+            for column, (_, _, torch_dtype) in zip(self._get_columns(), FEATURE_COLUMNS)
+        ]
+        return list(zip(*columns))
@@ -0,0 +1,135 @@
+import math
+import torch
+from torch.utils.data import ConcatDataset, Dataset, DistributedSampler
+from typing import List, Optional, Tuple
+
+from kitanaqa.trainer.custom_schedulers import get_custom_exp, get_custom_linear
+from kitanaqa import get_logger
+
+logger = get_logger()
+
+
+class MixedFeatureDataset(ConcatDataset):
+    """ The original training features followed by the augmented features, which `MixingSampler` draws from at a ratio """
+    def __init__(self, orig_dataset: Dataset, aug_dataset: Dataset):
+        """
+        Parameters
+        ----------
+        orig_dataset : torch.utils.data.Dataset
+            The features of the original training set, e.g. a `FeatureStore`.
+        aug_dataset : torch.utils.data.Dataset
+            The features of the augmented training set.
+        """
+        if not len(orig_dataset):
+            raise ValueError('MixedFeatureDataset requires at least one original feature')
+        super().__init__([orig_dataset, aug_dataset])
+        self.num_orig = len(orig_dataset)
+        self.num_aug = len(aug_dataset)
+
+    def __getitems__(self, indices: List[int]) -> List:
+        """ Reads the rows of a batch from each set at once where it supports batched reads, e.g. a `FeatureStore` """
+        rows = [None] * len(indices)
+        for dataset, offset, positions in (
+                (self.datasets[0], 0, [p for p, i in enumerate(indices) if i < self.num_orig]),
+                (self.datasets[1], self.num_orig, [p for p, i in enumerate(indices) if i >= self.num_orig])):
+            if not positions:
+                continue
+            dataset_indices = [indices[p] - offset for p in positions]
+            if hasattr(dataset, '__getitems__'):
+                dataset_rows = dataset.__getitems__(dataset_indices)
+            else:
+                dataset_rows = [dataset[i] for i in dataset_indices]
+            for p, row in zip(positions, dataset_rows):
+                rows[p] = row
+        return rows
+
+
+def get_mix_ratios(
+        num_epochs: int,
+        start_val: float,
+        end_val: Optional[float]=None,
+        schedule: Optional[str]=None) -> List[float]:
+    """
+    The ratio of augmented to original features in each epoch, constant or following a linear or exponential schedule
+    """
+    if schedule is None or end_val is None or num_epochs == 1:
+        return [start_val] * num_epochs
+    if schedule == 'linear':
+        return list(get_custom_linear(max_steps=num_epochs, start_val=start_val, end_val=end_val))
+    if schedule == 'exp':
+        return list(get_custom_exp(max_steps=num_epochs, start_val=start_val, end_val=end_val))
+    raise ValueError("aug_mix_schedule should be one of 'linear', 'exp'")
+
+
+def _draw(num_draws: int, size: int, generator: torch.Generator) -> torch.Tensor:
+    """ num_draws indices of range(size) without replacement, cycling through reshuffled passes when num_draws > size """
+    if num_draws == 0 or size == 0:
+        return torch.zeros(0, dtype=torch.long)
+    passes = [torch.randperm(size, generator=generator) for _ in range(math.ceil(num_draws / size))]
+    return torch.cat(passes)[:num_draws]
+
+
+class MixingSampler(DistributedSampler):
+    """ Samples the features of a `MixedFeatureDataset`, interleaving original and augmented features at a ratio set for each epoch
+    ...
+
+    Every epoch has the length of the original set plus `ratios[0]` times as many augmented
+    features. In epoch e, `ratios[e]` augmented features are drawn per original feature, so a
+    curriculum which increases the ratio draws fewer original features in later epochs, but the
+    number of optimisation steps, and the learning rate schedule, stay the same. Each set is
+    drawn without replacement and reshuffled every epoch. Only the indices of an epoch are held.
+
+    It extends DistributedSampler so that the Trainer sets the epoch of each pass, including when
+    training resumes from a checkpoint, and the ranks of distributed training draw disjoint
+    shares of the epoch.
+    """
+    def __init__(
+                self,
+                dataset: MixedFeatureDataset,
+                ratios: List[float],
+                num_replicas: Optional[int]=None,
+                rank: Optional[int]=None,
+                seed: int=0):
+        """
+        Parameters
+        ----------
+        dataset : MixedFeatureDataset
+            The original and augmented features.
+        ratios : List[float]
+            The number of augmented features per original feature in each epoch, e.g. from `get_mix_ratios`. Later epochs use the last ratio.
+        num_replicas : Optional(int)
+            Number of processes in distributed training. Defaults to the world size of the process group.
+        rank : Optional(int)
+            Rank of the current process in distributed training. Defaults to the rank in the process group.
+        seed : Optional(int)
+            Random seed of the draws, which are the same in every process. The default value is 0.
+        """
+        super().__init__(dataset, num_replicas=num_replicas, rank=rank, shuffle=True, seed=seed)
+        if any(ratio < 0 for ratio in ratios):
+            raise ValueError('Mixing ratios must be non-negative')
+        self.ratios = ratios
+        self.num_orig = dataset.num_orig
+        self.num_aug = dataset.num_aug
+        self.epoch_length = self.num_orig + round(self.num_orig * ratios[0])
+        self.num_samples = math.ceil(self.epoch_length / self.num_replicas)
+        self.total_size = self.num_samples * self.num_replicas
+
+    def get_epoch_counts(self, epoch: int) -> Tuple[int, int]:
+        """ The number of original and augmented features drawn in an epoch """
+        ratio = self.ratios[min(epoch, len(self.ratios) - 1)]
+        num_aug = round(self.epoch_length * ratio / (1 + ratio)) if self.num_aug else 0
+        return self.epoch_length - num_aug, num_aug
+
+    def __iter__(self):
+        generator = torch.Generator()
+        generator.manual_seed(self.seed + self.epoch)
+        num_orig, num_aug = self.get_epoch_counts(self.epoch)
+        logger.info('Epoch %d draws %d original and %d augmented features', self.epoch, num_orig, num_aug)
+        indices = torch.cat([
+            _draw(num_orig, self.num_orig, generator),
+            self.num_orig + _draw(num_aug, self.num_aug, generator),
+        ])
+        indices = indices[torch.randperm(len(indices), generator=generator)]
+        # Repeat indices so that every replica draws num_samples
+        indices = indices.repeat(math.ceil(self.total_size / len(indices)))[:self.total_size]
+        return iter(indices[self.rank:self.total_size:self.num_replicas].tolist())
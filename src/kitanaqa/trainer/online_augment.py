@@ -0,0 +1,275 @@
+import copy
+import math
+import random
+import numpy as np
+import torch
+from torch.utils.data import IterableDataset, get_worker_info
+from typing import Dict, List
+
+from kitanaqa.augment.term_replacement import DropTerms, ReplaceTerms
+from kitanaqa.trainer.alum_squad_processor import (
+    _batched_squad_convert_examples_to_features,
+    get_batched_tokenizer,
+)
+from kitanaqa import get_logger
+
+logger = get_logger()
+
+
+def _feature_to_tensors(feature, feature_index):
+    """ Convert a SquadFeatures to the tensors of one row of the training TensorDataset """
+    return (
+        torch.tensor(feature.input_ids, dtype=torch.long),
+        torch.tensor(feature.attention_mask, dtype=torch.long),
+        torch.tensor(feature.token_type_ids, dtype=torch.long),
+        torch.tensor(feature.start_position, dtype=torch.long),
+        torch.tensor(feature.end_position, dtype=torch.long),
+        torch.tensor(feature_index, dtype=torch.long),
+        torch.tensor(feature.cls_index, dtype=torch.long),
+        torch.tensor(feature.p_mask, dtype=torch.float),
+        torch.tensor(feature.is_impossible, dtype=torch.float),
+    )
+
+
+class OnlineAugSquadDataset(IterableDataset):
+    """ Training dataset which perturbs the questions of SQuAD examples on the fly
+    ...
+
+    Each epoch yields the features of every original example, plus augmented features for
+    `sample_ratio` times as many, in random order. Questions are perturbed when they are drawn,
+    so every epoch sees new augmentations, and no augmented corpus is written to disk or kept
+    in memory. Contexts are tokenised once, when the dataset is built, and only the questions
+    are encoded during training.
+
+    With several DataLoader workers, each worker generates its own share of the epoch.
+    """
+    def __init__(
+                self,
+                examples: List,
+                tokenizer,
+                max_seq_length: int=384,
+                doc_stride: int=128,
+                max_query_length: int=64,
+                sample_ratio: float=1.,
+                num_replacements: int=2,
+                p_replace: float=0.1,
+                p_dropword: float=0.1,
+                p_misspelling: float=0.1,
+                custom_importance_scores: Dict=None,
+                sampling_strategy: str='random',
+                sampling_k: int=3,
+                use_fast_tokenizer: bool=False,
+                context_cache: Dict=None,
+                batch_size: int=64):
+        """
+        Parameters
+        ----------
+        examples : List
+            The original training examples, as :class:`~transformers.data.processors.squad.SquadExample`.
+        tokenizer :
+            The Transformer model tokenizer used to preprocess the data.
+        max_seq_length : Optional(int)
+            Max length for the input tokens. The default value is 384.
+        doc_stride : Optional(int)
+            The stride used when the context is split across several features. The default value is 128.
+        max_query_length : Optional(int)
+            Max length for the query segment. The default value is 64.
+        sample_ratio : Optional(float)
+            Number of augmented features generated per epoch for each original feature. The default value is 1.
+        num_replacements : Optional(int)
+            Upper bound on the number of terms perturbed in a question. The default value is 2.
+        p_replace : Optional(float)
+            Sampling probability for the synonym perturbation. Normalized with the other perturbation probabilities.
+        p_dropword : Optional(float)
+            Sampling probability for the drop perturbation. Normalized with the other perturbation probabilities.
+        p_misspelling : Optional(float)
+            Sampling probability for the misspelling perturbation. Normalized with the other perturbation probabilities.
+        custom_importance_scores : Optional(Dict)
+            Dictionary with keys matching each question ID, and values the (term, weight) pairs of the question, used to sample the terms to replace.
+        sampling_strategy : Optional(str)
+            Strategy used to sample terms to replace, one of `random`, `topK` or `bottomK`. The default is `random`.
+        sampling_k : Optional(int)
+            The number of terms included in topK or bottomK sampling. The default value is 3.
+        use_fast_tokenizer : Optional(bool)
+            Encode questions with the Rust fast tokenizer equivalent to `tokenizer`, where one exists.
+        context_cache : Optional(Dict)
+            Encoded contexts keyed by a hash of (context, title), e.g. shared with the featurisation of the training set.
+        batch_size : Optional(int)
+            Number of questions perturbed and encoded together. The default value is 64.
+        """
+        if not examples:
+            raise ValueError('OnlineAugSquadDataset requires at least one example')
+        self.tokenizer = get_batched_tokenizer(tokenizer, use_fast_tokenizer)
+        if self.tokenizer is None:
+            raise NotImplementedError('Online augmentation does not support {}'.format(type(tokenizer).__name__))
+
+        self.examples = examples
+        self.max_seq_length = max_seq_length
+        self.doc_stride = doc_stride
+        self.max_query_length = max_query_length
+        self.sample_ratio = sample_ratio
+        self.num_replacements = num_replacements
+        self.custom_importance_scores = custom_importance_scores
+        self.sampling_strategy = sampling_strategy
+        self.sampling_k = sampling_k
+        self.batch_size = batch_size
+        self.context_cache = context_cache if context_cache is not None else {}
+
+        # Normalize probabilities of each augmentation
+        probs = [p_dropword, p_replace, p_misspelling]
+        self.probs = [p / sum(probs) for p in probs]
+        self.augmentation_types = ['drop', 'synonym', 'misspelling']
+        # The perturbation generators load their resources in the process which uses them
+        self._augmenters = None
+
+        # Featurise the original examples once, to encode every context and count the epoch length
+        self._num_example_features = [len(x) for x in self._convert(self.examples)]
+        self.num_orig_features = sum(self._num_example_features)
+        self.num_aug_features = math.ceil(self.num_orig_features * sample_ratio)
+        logger.info('Generating {} aug features per epoch from {} orig features'.format(
+                                                    self.num_aug_features,
+                                                    self.num_orig_features))
+
+    def _convert(self, examples: List) -> List:
+        """ Featurise examples against the cached contexts """
+        return _batched_squad_convert_examples_to_features(
+                    examples,
+                    self.tokenizer,
+                    max_seq_length=self.max_seq_length,
+                    doc_stride=self.doc_stride,
+                    max_query_length=self.max_query_length,
+                    is_training=True,
+                    batch_size=self.batch_size,
+                    tqdm_enabled=False,
+                    context_cache=self.context_cache)
+
+    def _get_augmenters(self) -> Dict:
+        if self._augmenters is None:
+            # Only load the generators which can be sampled
+            self._augmenters = {'drop': DropTerms()}
+            for aug_type, p in zip(self.augmentation_types, self.probs):
+                if aug_type != 'drop' and p > 0:
+                    self._augmenters[aug_type] = ReplaceTerms(rep_type=aug_type)
+        return self._augmenters
+
+    def _augment(self, example):
+        """ Returns a copy of example with a perturbed question, or None if no perturbation was found """
+        augmenters = self._get_augmenters()
+        aug_type = np.random.choice(self.augmentation_types, p=self.probs)
+        # Randomly select a number of terms to replace, from 1 up to the max `num_replacements`
+        reps = np.random.randint(1, self.num_replacements + 1)
+        if aug_type == 'drop':
+            aug_questions = augmenters['drop'].drop_terms(
+                                    example.question_text,
+                                    num_terms=reps,
+                                    num_output_sents=1)
+        else:
+            importance_score = None
+            if self.custom_importance_scores:
+                importance_score = self.custom_importance_scores.get(example.qas_id)
+            aug_questions = augmenters[aug_type].replace_terms(
+                                    sentence=example.question_text,
+                                    importance_scores=importance_score,
+                                    num_replacements=reps,
+                                    num_output_sents=1,
+                                    sampling_strategy=self.sampling_strategy,
+                                    sampling_k=self.sampling_k)
+        if not aug_questions or not aug_questions[0]:
+            return None
+        aug_example = copy.copy(example)
+        aug_example.question_text = aug_questions[0]
+        return aug_example
+
+    def _num_worker_aug_features(self, worker_id: int, num_workers: int) -> int:
+        """ Number of augmented features produced by a worker """
+        num_aug_features = self.num_aug_features // num_workers
+        if worker_id < self.num_aug_features % num_workers:
+            num_aug_features += 1
+        return num_aug_features
+
+    def _get_shard(self):
+        """ Indices of the original examples and the number of augmented features produced by this worker """
+        worker_info = get_worker_info()
+        if worker_info is None:
+            return np.arange(len(self.examples)), self.num_aug_features
+        # Reseed the perturbation generators, which sample from the global random state
+        np.random.seed(worker_info.seed % 2**32)
+        random.seed(worker_info.seed)
+        num_aug_features = self._num_worker_aug_features(worker_info.id, worker_info.num_workers)
+        return np.arange(worker_info.id, len(self.examples), worker_info.num_workers), num_aug_features
+
+    def __iter__(self):
+        orig_indices, num_aug_features = self._get_shard()
+        # Draw as many augmented examples as there are original ones, in proportion to their features
+        num_aug_draws = math.ceil(len(orig_indices) * self.sample_ratio)
+        draws = [(idx, False) for idx in orig_indices]
+        if len(orig_indices):
+            draws += [(idx, True) for idx in np.random.choice(orig_indices, size=num_aug_draws)]
+        draws = [draws[i] for i in np.random.permutation(len(draws))]
+
+        feature_index = 0
+        num_aug_remaining = num_aug_features
+        keep_unperturbed = False
+        while draws or num_aug_remaining > 0:
+            refill = not draws
+            if refill:
+                # Perturbations which fail or produce fewer features are made up with new draws
+                draws = [(idx, True) for idx in np.random.choice(len(self.examples), size=self.batch_size)]
+            batch, draws = draws[:self.batch_size], draws[self.batch_size:]
+            examples, is_aug = [], []
+            for idx, aug in batch:
+                example = self.examples[idx]
+                if aug:
+                    if num_aug_remaining <= 0:
+                        continue
+                    aug_example = self._augment(example)
+                    if aug_example is None and not keep_unperturbed:
+                        continue
+                    example = aug_example or example
+                examples.append(example)
+                is_aug.append(aug)
+
+            if refill and not examples:
+                logger.warning('Unable to perturb the sampled questions, filling the epoch with original questions')
+                keep_unperturbed = True
+            for features, aug in zip(self._convert(examples), is_aug):
+                if aug:
+                    features = features[:max(0, num_aug_remaining)]
+                    num_aug_remaining -= len(features)
+                for feature in features:
+                    yield _feature_to_tensors(feature, feature_index)
+                    feature_index += 1
+
+    def __len__(self):
+        return self.num_orig_features + self.num_aug_features
+
+    def num_batches(self, batch_size: int, num_workers: int=0, drop_last: bool=False) -> int:
+        """ Number of batches yielded by a DataLoader over the dataset
+
+        Each DataLoader worker batches its own share of the epoch, so with several workers
+        every worker may yield a partial last batch, and there are more batches than
+        `len(self) / batch_size`.
+
+        Parameters
+        ----------
+        batch_size : int
+            The batch size of the DataLoader.
+        num_workers : Optional(int)
+            The number of worker processes of the DataLoader. The default value is 0.
+        drop_last : Optional(bool)
+            Whether the DataLoader drops the last, partial batch of each worker.
+
+        Returns
+        -------
+        int
+            The number of batches in an epoch.
+        """
+        rounding = math.floor if drop_last else math.ceil
+        if num_workers == 0:
+            return rounding(len(self) / batch_size)
+        num_batches = 0
+        for worker_id in range(num_workers):
+            num_features = sum(self._num_example_features[worker_id::num_workers])
+            num_features += self._num_worker_aug_features(worker_id, num_workers)
+            num_batches += rounding(num_features / batch_size)
+        return num_batches
@@ -22,8 +22,7 @@ from transformers import (
 )
 
 from kitanaqa.trainer.arguments import ModelArguments
-from kitanaqa.trainer.utils import load_and_cache_examples, post_to_slack, build_flow
-from transformers.file_utils import is_apex_available
+from kitanaqa.trainer.utils import load_train_inputs, build_flow, get_flow_executor
 
 from kitanaqa import get_logger
 logger = get_logger()
@@ -35,12 +34,14 @@ MODEL_CLASSES = {
 }
 
 
-def _setup(model_args, training_args):
+def _setup(model_args, training_args, load_inputs=True):
     """ Prepare environment and models for training and evaluation """
 
     if model_args.model_type not in list(MODEL_CLASSES.keys()):
         raise NotImplementedError("Model type should be 'bert', 'albert'")
-    if not is_apex_available():
+    if training_args.fp16 and training_args.device.type != "cuda":
+        # float16 autocast relies on the CUDA GradScaler, use bf16 for mixed precision on CPU
+        logger.warning("fp16 requires a CUDA device, training in full precision")
         training_args.fp16 = False
 
     # Setup the environment
@@ -71,31 +72,9 @@ def _setup(model_args, training_args):
     )
     logger.info("Training/evaluation parameters %s", training_args)
 
-    # Load model and tokenizer
-    config, model_cls, tokenizer_cls = MODEL_CLASSES[model_args.model_type]
-    tokenizer = tokenizer_cls.from_pretrained(
-        model_args.tokenizer_name_or_path if model_args.tokenizer_name_or_path else model_args.model_name_or_path,
-        cache_dir=model_args.cache_dir,
-    )
-
-    model = model_cls.from_pretrained(
-        model_args.model_name_or_path,
-        cache_dir=model_args.cache_dir,
-    )
-
-    # Load training dataset
-    if training_args.do_train:
-        train_dataset = load_and_cache_examples(model_args, tokenizer)
-    else:
-        train_dataset = None
-
-    # Load aug dataset
-    if training_args.do_train and model_args.do_aug:
-        aug_dataset = load_and_cache_examples(model_args, tokenizer, use_aug_path=True)
-        logger.info('Concatenate augmented examples to original examples. Train length = {}, Aug length = {}'.format(len(train_dataset), len(aug_dataset)))
-        train_dataset += aug_dataset
-
-    return model, tokenizer, train_dataset
+    if not load_inputs:
+        return None, None, None
+    return load_train_inputs(model_args, training_args)
 
 
 if __name__ == "__main__":
@@ -116,13 +95,23 @@ if __name__ == "__main__":
     parser = HfArgumentParser(dataclass_types=[ModelArguments, TrainingArguments])
     model_args, training_args = parser.parse_json_file(config_path)
 
-    model, tokenizer, train_dataset = _setup(model_args, training_args)
+    aug_configs = None
+    if model_args.aug_configs_file:
+        with open(model_args.aug_configs_file) as f:
+            aug_configs = json.load(f)
+
+    # Augmented runs and the augmentation stage load their own model and data in the flow
+    model, tokenizer, train_dataset = _setup(
+            model_args,
+            training_args,
+            load_inputs=not (aug_configs or (training_args.do_train and model_args.do_aug_stage)))
 
     f = build_flow(
             (model_args, training_args),
             model=model,
             tokenizer=tokenizer,
-            train_dataset=train_dataset)
+            train_dataset=train_dataset,
+            aug_configs=aug_configs)
 
     if f:
-        f.run()
+        f.run(executor=get_flow_executor(model_args.flow_num_workers))
@@ -0,0 +1,180 @@
+import collections
+import numpy as np
+from typing import Dict, List
+
+from transformers.data.metrics.squad_metrics import get_final_text
+
+
+def _get_valid_positions(features: List, seq_length: int):
+    """ Masks of the positions which can start and end an answer span in each feature """
+    valid_start = np.zeros((len(features), seq_length), dtype=bool)
+    valid_end = np.zeros((len(features), seq_length), dtype=bool)
+    for i, feature in enumerate(features):
+        # Only context tokens map back to the original document
+        positions = np.fromiter(feature.token_to_orig_map.keys(), dtype=np.int64)
+        positions = positions[positions < min(len(feature.tokens), seq_length)]
+        valid_end[i, positions] = True
+        valid_start[i, positions] = [feature.token_is_max_context.get(p, False) for p in positions.tolist()]
+    return valid_start, valid_end
+
+
+def _get_best_indexes(logits: np.ndarray, n_best_size: int) -> np.ndarray:
+    """ Indexes of the n-best logits of each row, ties broken by position as in a stable sort """
+    return np.argsort(-logits, axis=1, kind='stable')[:, :n_best_size]
+
+
+def _get_span_text(example, feature, start_index: int, end_index: int, tokenizer, do_lower_case: bool, verbose_logging: bool) -> str:
+    """ The text of the original document covered by the span of feature tokens """
+    tok_tokens = feature.tokens[start_index:(end_index + 1)]
+    orig_doc_start = feature.token_to_orig_map[start_index]
+    orig_doc_end = feature.token_to_orig_map[end_index]
+    orig_tokens = example.doc_tokens[orig_doc_start:(orig_doc_end + 1)]
+
+    tok_text = tokenizer.convert_tokens_to_string(tok_tokens)
+    # Clean whitespace
+    tok_text = " ".join(tok_text.strip().split())
+    orig_text = " ".join(orig_tokens)
+    return get_final_text(tok_text, orig_text, do_lower_case, verbose_logging)
+
+
+def compute_predictions(
+        examples: List,
+        features: List,
+        feature_indices: np.ndarray,
+        all_logits: np.ndarray,
+        n_best_size: int,
+        max_answer_length: int,
+        do_lower_case: bool,
+        verbose_logging: bool,
+        version_2_with_negative: bool,
+        null_score_diff_threshold: float,
+        tokenizer) -> Dict:
+    """Decode the answer of each example from the start and end logits of its features
+
+    The predictions are identical to those of `transformers` `compute_predictions_logits`. The
+    n-best start and end positions of all the features, and the scores of their valid spans, are
+    computed at once on the logit arrays. The answer text is then only recovered for the best
+    spans of each example, until its prediction is known.
+
+    Parameters
+    ----------
+    examples : List
+        The examples in the evaluation dataset.
+    features : List
+        SQuAD-like features corresponding to the evaluation dataset.
+    feature_indices : np.ndarray
+        The index in `features` of each row of `all_logits`.
+    all_logits : np.ndarray
+        The (num_features, 2, seq_length) start and end logits of the features.
+    n_best_size : int
+        Number of start and end positions considered in each feature.
+    max_answer_length : int
+        Max number of tokens in an answer span.
+    do_lower_case : bool
+        Whether the tokenizer lower cases the text.
+    verbose_logging : bool
+        Log the alignment failures between the answer tokens and the original text.
+    version_2_with_negative : bool
+        Whether examples can be unanswerable.
+    null_score_diff_threshold : float
+        The null answer is predicted when its score exceeds the best span score by more than this threshold.
+    tokenizer :
+        The tokenizer used to preprocess the data.
+
+    Returns
+    -------
+    Dict
+        The predicted answer text of each example, keyed by qas_id.
+    """
+    # Rows of the logits in the order of the features
+    logits = np.empty((len(features),) + all_logits.shape[1:], dtype=all_logits.dtype)
+    logits[feature_indices] = all_logits
+    start_logits, end_logits = logits[:, 0], logits[:, 1]
+
+    start_indexes = _get_best_indexes(start_logits, n_best_size)
+    end_indexes = _get_best_indexes(end_logits, n_best_size)
+    rows = np.arange(len(features))[:, None]
+    # Scores are summed in double precision, as the Python floats of compute_predictions_logits
+    best_start_logits = start_logits[rows, start_indexes].astype(np.float64)
+    best_end_logits = end_logits[rows, end_indexes].astype(np.float64)
+    # (num_features, n_best_size, n_best_size) candidate spans
+    scores = best_start_logits[:, :, None] + best_end_logits[:, None, :]
+    lengths = end_indexes[:, None, :] - start_indexes[:, :, None] + 1
+    valid_start, valid_end = _get_valid_positions(features, logits.shape[-1])
+    is_valid = (
+        valid_start[rows, start_indexes][:, :, None]
+        & valid_end[rows, end_indexes][:, None, :]
+        & (lengths >= 1)
+        & (lengths <= max_answer_length)
+    )
+    null_scores = start_logits[:, 0].astype(np.float64) + end_logits[:, 0].astype(np.float64)
+
+    example_index_to_features = collections.defaultdict(list)
+    for feature_index, feature in enumerate(features):
+        example_index_to_features[feature.example_index].append(feature_index)
+
+    all_predictions = collections.OrderedDict()
+    for example_index, example in enumerate(examples):
+        feature_ids = np.array(example_index_to_features[example_index], dtype=np.int64)
+
+        # Candidates in the order compute_predictions_logits visits them, which breaks ties in the sort
+        candidate_ids, start_ranks, end_ranks = np.nonzero(is_valid[feature_ids])
+        candidate_features = feature_ids[candidate_ids]
+        candidate_starts = start_indexes[candidate_features, start_ranks]
+        candidate_ends = end_indexes[candidate_features, end_ranks]
+        candidate_scores = scores[candidate_features, start_ranks, end_ranks]
+        if version_2_with_negative:
+            # The null answer of the feature with the min null score
+            null_feature = feature_ids[np.argmin(null_scores[feature_ids])]
+            score_null = float(null_scores[null_feature])
+            candidate_features = np.append(candidate_features, null_feature)
+            candidate_starts = np.append(candidate_starts, 0)
+            candidate_ends = np.append(candidate_ends, 0)
+            candidate_scores = np.append(candidate_scores, score_null)
+        order = np.argsort(-candidate_scores, kind='stable')
+
+        seen_predictions = set()
+        num_best = 0
+        best_non_null_text, best_non_null_logits = None, None
+        for i in order.tolist():
+            if num_best >= n_best_size:
+                break
+            start_index = int(candidate_starts[i])
+            if start_index > 0:  # this is a non-null prediction
+                final_text = _get_span_text(
+                                    example,
+                                    features[candidate_features[i]],
+                                    start_index,
+                                    int(candidate_ends[i]),
+                                    tokenizer,
+                                    do_lower_case,
+                                    verbose_logging)
+                if final_text in seen_predictions:
+                    continue
+            else:
+                final_text = ""
+            seen_predictions.add(final_text)
+            num_best += 1
+            if final_text:
+                best_non_null_logits = (
+                    float(start_logits[candidate_features[i], start_index]),
+                    float(end_logits[candidate_features[i], candidate_ends[i]]))
+                best_non_null_text = final_text
+                break
+            if not version_2_with_negative:
+                break
+
+        if not version_2_with_negative:
+            # In very rare edge cases there are no valid predictions, and the nonce prediction is used
+            all_predictions[example.qas_id] = final_text if num_best else "empty"
+            continue
+        if best_non_null_text is None:
+            # Only the null prediction, so the nonce prediction is the best non-null one
+            best_non_null_text, best_non_null_logits = "empty", (0., 0.)
+        # predict "" iff the null score - the score of best non-null > threshold
+        score_diff = score_null - best_non_null_logits[0] - best_non_null_logits[1]
+        if score_diff > null_score_diff_threshold:
+            all_predictions[example.qas_id] = ""
+        else:
+            all_predictions[example.qas_id] = best_non_null_text
+    return all_predictions
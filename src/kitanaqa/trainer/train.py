@@ -3,25 +3,31 @@ import os
 import logging
 import timeit
 import itertools
+import contextlib
+import copy
+import functools
+import inspect
 import numpy as np
 from tqdm import tqdm
 from typing import Optional
 from operator import itemgetter
 
 from torch import nn
-from torch.utils.data import SequentialSampler, DataLoader
+from torch.utils.data import SequentialSampler, DataLoader, IterableDataset
 from torch.utils.data._utils.collate import default_collate
 from torch import autograd
+from torch.utils.checkpoint import checkpoint
 
 from typing import List, Dict, Any
 
 from transformers import Trainer as HFTrainer
 from transformers import PreTrainedModel, AdamW
-from transformers.file_utils import is_apex_available
-from transformers.data.processors.squad import SquadResult
-from transformers.data.metrics.squad_metrics import squad_evaluate, compute_predictions_logits
+from transformers.data.metrics.squad_metrics import squad_evaluate
 
+from kitanaqa.trainer.attack import PGDAttack, ascent_step, get_embed_layer, init_delta, project
 from kitanaqa.trainer.custom_schedulers import get_custom_exp, get_custom_linear
+from kitanaqa.trainer.mixing import MixedFeatureDataset, MixingSampler, get_mix_ratios
+from kitanaqa.trainer.span_decoder import compute_predictions
 from kitanaqa import get_logger
 
 # Init logging
@@ -29,15 +35,64 @@ logger = get_logger()
 
 #autograd.set_detect_anomaly(True)
 
-if is_apex_available():
-    from apex import amp
-
 
 def tensor_to_list(tensor):
     """ Convert a Tensor to List """
     return tensor.detach().cpu().tolist()
 
 
+def _checkpointed_forward(self, *args, **kwargs):
+    """ Run the layer forward without keeping its activations, recomputing them during backward """
+    forward = super(type(self), self).forward
+    if self.training and torch.is_grad_enabled():
+        # Layers such as those of DistilBERT are called with keyword arguments only, which checkpoint does not accept before torch 1.13
+        bound = inspect.signature(forward).bind(*args, **kwargs)
+        return checkpoint(functools.partial(forward, **bound.kwargs), *bound.args, use_reentrant=False)
+    return forward(*args, **kwargs)
+
+
+_checkpointed_classes = {}
+
+
+def enable_gradient_checkpointing(model: PreTrainedModel, model_type: str):
+    """ Enable activation checkpointing on each layer of the encoder of a bert, albert or distilbert model """
+    if model_type == 'bert':
+        layers = model.bert.encoder.layer
+    elif model_type == 'distilbert':
+        layers = model.distilbert.transformer.layer
+    elif model_type == 'albert':
+        layers = model.albert.encoder.albert_layer_groups
+    else:
+        raise NotImplementedError('Only bert, albert, distilbert models support gradient checkpointing')
+    for layer in layers:
+        # Swap the class rather than wrapping the layer, so parameter names and checkpoints are unchanged
+        cls = type(layer)
+        if cls not in _checkpointed_classes:
+            _checkpointed_classes[cls] = type(cls.__name__, (cls,), {'forward': _checkpointed_forward})
+        layer.__class__ = _checkpointed_classes[cls]
+
+
+class ReplayDataLoader(DataLoader):
+    """DataLoader yielding each of its batches `num_replays` times in a row, for free adversarial training
+
+    Each worker batches its own share of an iterable dataset, so the length of datasets which count their
+    batches per worker, see `OnlineAugSquadDataset.num_batches`, includes the partial batch of every worker.
+    """
+    def __init__(self, dataset, num_replays: int = 1, **kwargs):
+        super().__init__(dataset, **kwargs)
+        self.num_replays = num_replays
+
+    def __iter__(self):
+        for batch in super().__iter__():
+            for _ in range(self.num_replays):
+                yield batch
+
+    def __len__(self):
+        if isinstance(self.dataset, IterableDataset) and hasattr(self.dataset, 'num_batches'):
+            return self.dataset.num_batches(self.batch_size, self.num_workers, self.drop_last) * self.num_replays
+        return super().__len__() * self.num_replays
+
+
 class Trainer(HFTrainer):
     """ A class to provide the adversarial and augmented training and evaluation
     ...
@@ -87,11 +142,19 @@ class Trainer(HFTrainer):
             msg = 'Only bert, albert, distilbert models are support in ALUM training'
             raise NotImplementedError(msg)
 
+        if self.args.fp16 and self.params and self.params.bf16:
+            raise ValueError('Only one of fp16 and bf16 may be set')
+
+        if self.params and self.params.gradient_checkpointing:
+            enable_gradient_checkpointing(self.model, self.params.model_type)
+
+        if self.do_alum and self.params.adv_mode not in ['alum', 'free']:
+            raise ValueError("adv_mode should be one of 'alum', 'free'")
+        if self.do_alum and self.params.adv_mode == 'free' and self.params.K < 2:
+            # The first replay is not perturbed beyond the initial noise, so one replay never trains on an ascent step
+            raise ValueError("adv_mode 'free' requires K >= 2")
+
         if self.do_alum and self.args.do_train:
-            # Initialize delta for ALUM adv grad
-            self._delta = None
-            # Set ALUM optimizer
-            self._alum_optimizer = None
             # Set ALUM scheduler
             if self.params.alpha_schedule == 'exp' and self.params.alpha_final:
                 self._alpha_scheduler = get_custom_exp(
@@ -109,16 +172,21 @@ class Trainer(HFTrainer):
                 self._alpha_scheduler = itertools.repeat(self.params.alpha, self.args.num_train_epochs)
 
             # Set static embedding layer
-            if self.params.model_type == 'bert':
-                self._embed_layer = self.model.bert.get_input_embeddings()
-            elif self.params.model_type == 'distilbert':
-                self._embed_layer = self.model.distilbert.get_input_embeddings()
+            self._embed_layer = get_embed_layer(self.model, self.params.model_type)
             # ALUM step template
-            self._step = self._alum_step
+            self._step = self._free_step if self.params.adv_mode == 'free' else self._alum_step
             # Tracking training steps for ALUM grad accumulation
             self._step_idx = 0
             self._n_steps = len(self.get_train_dataloader())
             self._alpha = None
+
+            if self.params.adv_mode == 'free':
+                # Each minibatch is replayed K times, so training runs 1/K of the epochs for the same number of steps
+                self.args = copy.copy(self.args)
+                self.args.num_train_epochs = self.args.num_train_epochs / self.params.K
+                logger.info('Free adversarial training replays each batch %d times for %.2f epochs',
+                            self.params.K, self.args.num_train_epochs)
+                self._free_delta = None
         elif self.args.do_train:
             # Use non-ALUM training step
             self._step = self._normal_step
@@ -141,7 +209,8 @@ class Trainer(HFTrainer):
         if self.params.model_type in ["xlm", "roberta", "distilbert"]:
             del inputs["token_type_ids"]
 
-        outputs = model(**inputs)
+        with self._autocast():
+            outputs = model(**inputs)
         # model outputs are always tuple in transformers (see doc)
         loss = outputs[0]
 
@@ -150,11 +219,7 @@ class Trainer(HFTrainer):
         if self.args.gradient_accumulation_steps > 1:
             loss = loss / self.args.gradient_accumulation_steps
 
-        if self.args.fp16: #  assumes using apex
-            with amp.scale_loss(loss, self.optimizer) as scaled_loss:
-                scaled_loss.backward()
-        else:
-            loss.backward()
+        self._backward(loss)
 
         return loss.detach()
 
@@ -182,7 +247,7 @@ class Trainer(HFTrainer):
             self.global_step = 0
 
         output = {**logs, **{"step": self.global_step}}
-        if self.do_alum:
+        if self.do_alum and self.params.adv_mode == 'alum':
             output = {**output, **{"alpha": self._alpha}}
         if iterator is not None:
             iterator.write(output)
@@ -223,39 +288,18 @@ class Trainer(HFTrainer):
         if self.params.model_type in ["xlm", "roberta", "distilbert"]:
             del inputs["token_type_ids"]
 
-        # Initialize delta for every actual batch
-        if self._step_idx % self.args.gradient_accumulation_steps == 0:
-            m = torch.distributions.multivariate_normal.MultivariateNormal(torch.zeros(768),torch.eye(768)*(self.params.sigma ** 2))
-            # TODO: clamp distribution
-            sample = m.sample((self.params.max_seq_length,))
-            self._delta = torch.tensor(sample, requires_grad = True, device = self.args.device)
-            if not self._alum_optimizer:
-                optimizer_params = [
-                    {
-                        "params": self._delta
-                    }
-                ]
-                opt = AdamW(optimizer_params)
-                if self.args.fp16:
-                    _, self._alum_optimizer = amp.initialize(
-                                                self.model,
-                                                opt,
-                                                opt_level=self.args.fp16_opt_level)
-                else:
-                    self._alum_optimizer = opt
+        # Initialize a perturbation for each example of the batch, padding is not perturbed
+        embed_mask = batch[1].unsqueeze(-1).to(input_embedding.dtype)
+        delta = init_delta(input_embedding, embed_mask, sigma=self.params.sigma)
 
         # Predict logits and generate normal loss with normal inputs_embeds
-        outputs = model(**inputs)
+        with self._autocast():
+            outputs = model(**inputs)
         normal_loss, start_logits, end_logits = outputs[0:3]
         start_logits, end_logits = torch.argmax(start_logits, dim=1), torch.argmax(end_logits, dim=1)
 
-        # Generation of attack shouldn't affect the gradients of model parameters
-        # Set model to inference mode and disable accumulation of gradients
-        model.eval()
-        for param in model.parameters():
-            param.requires_grad = False
-
-        # Iterative attack
+        # Iterative attack. Gradients are only taken with respect to delta, so the attack
+        # leaves the gradients of the model parameters untouched
         for i in range(self.params.K):
             # Generate adversarial gradients with perturbed inputs and target = predicted logits
             inputs = {
@@ -264,42 +308,34 @@ class Trainer(HFTrainer):
                 "token_type_ids": batch[2],
                 "start_positions": start_logits,
                 "end_positions": end_logits,
-                "inputs_embeds": input_embedding + self._delta,
+                "inputs_embeds": input_embedding + delta,
             }
             if self.params.model_type in ["xlm", "roberta", "distilbert"]:
                 del inputs["token_type_ids"]
 
-            outputs = model(**inputs)
+            with self._autocast():
+                outputs = model(**inputs)
             adv_loss = outputs[0]
 
             if self.args.n_gpu > 1:
                 adv_loss = adv_loss.mean()  # mean() to average on multi-gpu parallel (not distributed) training
-            if self.args.gradient_accumulation_steps > 1:
-                adv_loss = adv_loss / self.args.gradient_accumulation_steps
 
-            # Accumulating gradients for delta (g_adv) only, model gradients are not affected because we set model.eval()
             if self.args.fp16:
-                # Gradients are unscaled during context manager exit.
-                with amp.scale_loss(adv_loss, self._alum_optimizer) as scaled_loss:
-                    scaled_loss.backward()
+                # Scale the loss so that half precision gradients do not underflow, then unscale g_adv
+                g_adv, = autograd.grad(self.scaler.scale(adv_loss), delta)
+                g_adv = g_adv / self.scaler.get_scale()
             else:
-                adv_loss.backward()
+                g_adv, = autograd.grad(adv_loss, delta)
 
             # Check for inf/NaN in delta grad. These can be introduced by instability in mixed-precision training.
-            if not torch.all(torch.isfinite(self._delta.grad.data)):
-                logger.warning('Detected inf/NaN in adv gradient. Zeroing and continuing accumulation')
-                self._alum_optimizer.zero_grad()
-
-            # Calculate g_adv and update delta every actual epoch
-            if (self._step_idx + 1) % self.args.gradient_accumulation_steps == 0:
-                g_adv = self._delta.grad.data.detach()
-                self._delta.data = self._alum_grad_project((self._delta + self.params.eta * g_adv), self.params.eps, 'inf')
-                del g_adv
-
-        # Set model to train mode and enable accumulation of gradients
-        for param in model.parameters():
-            param.requires_grad = True
-        model.train()
+            if not torch.all(torch.isfinite(g_adv)):
+                logger.warning('Detected inf/NaN in adv gradient. Zeroing and continuing attack')
+                g_adv.zero_()
+
+            # Update and project the perturbation of each example
+            with torch.no_grad():
+                delta = project((delta + self.params.eta * g_adv), self.params.eps, self.params.adv_norm) * embed_mask
+            delta.requires_grad_()
 
         # Generate adversarial loss with perturbed inputs against predicted logits
         inputs = {
@@ -308,12 +344,13 @@ class Trainer(HFTrainer):
             "token_type_ids": batch[2],
             "start_positions": start_logits,
             "end_positions": end_logits,
-            "inputs_embeds": input_embedding + self._delta,
+            "inputs_embeds": input_embedding + delta.detach(),
         }
         if self.params.model_type in ["xlm", "roberta", "distilbert"]:
             del inputs["token_type_ids"]
 
-        outputs = model(**inputs)
+        with self._autocast():
+            outputs = model(**inputs)
         adv_loss = outputs[0]
 
         loss = normal_loss + self._alpha * adv_loss
@@ -323,17 +360,70 @@ class Trainer(HFTrainer):
             loss = loss / self.args.gradient_accumulation_steps
 
         # Accumulating gradients for all parameters in the model
-        if self.args.fp16:
-            with amp.scale_loss(loss, self.optimizer) as scaled_loss:
-                scaled_loss.backward()
-        else:
-            loss.backward()
+        self._backward(loss)
 
         self._step_idx += 1
 
         return normal_loss.detach()
 
 
+    def _free_step(
+            self,
+            model: nn.Module,
+            batch: List) -> torch.Tensor:
+        """ Free adversarial training step, as in Shafahi et al. (2019)
+
+        The train dataloader replays each minibatch K times in a row, see `ReplayDataLoader`, and the
+        optimizer steps after every replay. Each replay runs one forward and backward with the perturbed
+        inputs and the gold positions, whose gradient also updates delta for the next replay. Delta is
+        carried over to the next minibatch when the shapes match, so a step costs about a normal step.
+        """
+        model.train()
+        batch = tuple(t.to(self.args.device) for t in batch)
+
+        input_embedding = self._embed_layer(batch[0])
+        # Padding is not perturbed
+        embed_mask = batch[1].unsqueeze(-1).to(torch.float)
+        delta = self._free_delta
+        if delta is None or delta.shape != input_embedding.shape:
+            delta = init_delta(input_embedding.detach(), embed_mask, sigma=self.params.sigma)
+        else:
+            delta = (delta * embed_mask).requires_grad_()
+
+        inputs = {
+            "input_ids": None,
+            "attention_mask": batch[1],
+            "token_type_ids": batch[2],
+            "start_positions": batch[3],
+            "end_positions": batch[4],
+            "inputs_embeds": input_embedding + delta,
+        }
+        if self.params.model_type in ["xlm", "roberta", "distilbert"]:
+            del inputs["token_type_ids"]
+
+        with self._autocast():
+            outputs = model(**inputs)
+        loss = outputs[0]
+
+        if self.args.n_gpu > 1:
+            loss = loss.mean()  # mean() to average on multi-gpu parallel (not distributed) training
+        if self.args.gradient_accumulation_steps > 1:
+            loss = loss / self.args.gradient_accumulation_steps
+
+        # Accumulating gradients for all parameters in the model, and for delta
+        self._backward(loss)
+
+        # Check for inf/NaN in delta grad. These can be introduced by instability in mixed-precision training.
+        if not torch.all(torch.isfinite(delta.grad)):
+            logger.warning('Detected inf/NaN in adv gradient. Zeroing and continuing attack')
+            delta.grad.zero_()
+        # The ascent step only depends on the direction of the gradient, not on the loss scaling
+        with torch.no_grad():
+            delta = ascent_step(delta, delta.grad, self.params.eta, self.params.adv_norm)
+            self._free_delta = project(delta, self.params.eps, self.params.adv_norm) * embed_mask
+
+        return loss.detach()
+
     def training_step(
             self,
             model: nn.Module,
@@ -355,27 +445,57 @@ class Trainer(HFTrainer):
         """
         return self._step(model, batch)
 
-    def _alum_grad_project(self, grad, eps, ord = 'inf'):
-        if ord == 2:
-            dims = list(range(1, grad.dim()))
-            norms = torch.sqrt(torch.sum(grad * grad, dim=dims, keepdim=True))
-            return torch.min(torch.ones(norms.shape), eps / norms) * grad
-        elif ord == 'inf':
-            return torch.clamp(grad, min = -eps, max = eps)
-        else:
-            msg = "Only ord = inf and ord = 2 have been implemented"
-            raise NotImplementedError(msg)
+    def _get_train_sampler(self):
+        """Draws the original and augmented features of a `MixedFeatureDataset` at the `aug_mix_ratio` of each epoch,
+        see `MixingSampler`. Other datasets are sampled by the HFTrainer.
+        """
+        if isinstance(self.train_dataset, MixedFeatureDataset) and self.params and self.params.aug_mix_ratio is not None:
+            distributed = self.args.local_rank != -1
+            return MixingSampler(
+                        self.train_dataset,
+                        get_mix_ratios(
+                            int(np.ceil(self.args.num_train_epochs)),
+                            self.params.aug_mix_ratio,
+                            self.params.aug_mix_ratio_final,
+                            self.params.aug_mix_schedule),
+                        num_replicas=None if distributed else 1,
+                        rank=None if distributed else 0,
+                        seed=self.args.seed)
+        return super()._get_train_sampler()
+
+    def get_train_dataloader(self) -> DataLoader:
+        """Returns the training DataLoader. Datasets generated on the fly, such as online augmentation, are
+        iterated in `aug_num_workers` worker processes and are not sampled. In free adversarial training,
+        each batch is replayed K times, see `ReplayDataLoader`.
+        """
+        is_iterable = isinstance(self.train_dataset, IterableDataset)
+        is_free = self.do_alum and self.params.adv_mode == 'free'
+        if is_iterable or is_free:
+            return ReplayDataLoader(
+                self.train_dataset,
+                num_replays=self.params.K if is_free else 1,
+                batch_size=self.args.train_batch_size,
+                sampler=None if is_iterable else self._get_train_sampler(),
+                collate_fn=self.data_collator,
+                drop_last=self.args.dataloader_drop_last,
+                num_workers=self.params.aug_num_workers if is_iterable and self.params else 0,
+            )
+        return super().get_train_dataloader()
+
+    def _autocast(self):
+        """ Mixed precision context for the forward passes: float16 with fp16, or bfloat16 with bf16 """
+        if self.args.fp16:
+            return torch.autocast(device_type=self.args.device.type, dtype=torch.float16)
+        if self.params and self.params.bf16:
+            return torch.autocast(device_type=self.args.device.type, dtype=torch.bfloat16)
+        return contextlib.nullcontext()
 
-    def _adv_sgn_attack(self, delta, eps, eps_iter, ord = 'inf'):
-        if ord == 'inf':
-            grad_sign = delta.grad.data.sign()
-            delta.data += eps * grad_sign
-            delta.data = torch.clamp(delta.data, min = -eps, max = eps)
-            return delta
+    def _backward(self, loss):
+        """ Backward pass, scaling float16 losses with the Trainer's GradScaler """
+        if self.args.fp16:
+            self.scaler.scale(loss).backward()
         else:
-            msg = "Only ord = inf has been implemented"
-            raise NotImplementedError(msg)
-
+            loss.backward()
 
     def adv_evaluate(
             self,
@@ -414,8 +534,7 @@ class Trainer(HFTrainer):
         if not os.path.exists(self.args.output_dir) and self.args.local_rank in [-1, 0]:
             os.makedirs(self.args.output_dir)
 
-        # TODO Add batch attacks for eval
-        eval_batch_size = max(1, self.args.n_gpu)
+        eval_batch_size = self.args.per_device_eval_batch_size * max(1, self.args.n_gpu)
 
         # Note that DistributedSampler samples randomly
         eval_sampler = SequentialSampler(dataset)
@@ -430,95 +549,50 @@ class Trainer(HFTrainer):
         logger.info("  Num examples = %d", len(dataset))
         logger.info("  Batch size = %d", eval_batch_size)
 
-        all_results = []
+        # Logits are gathered on the host with one transfer per batch
+        all_logits = None
+        all_example_indices = np.empty(len(dataset), dtype=np.int64)
+        num_evaluated = 0
         start_time = timeit.default_timer()
 
-        if self.params.model_type == 'bert':
-            _embed_layer = self.model.bert.get_input_embeddings()
-        elif self.params.model_type == 'distilbert':
-            _embed_layer = self.model.distilbert.get_input_embeddings()
-        elif self.params.model_type == 'albert':
-            _embed_layer = self.model.albert.get_input_embeddings()
+        attack = PGDAttack(
+                    self.model,
+                    get_embed_layer(self.model, self.params.model_type),
+                    self.params.model_type,
+                    eps=args.eps,
+                    step_size=args.eta,
+                    num_steps=args.K,
+                    sigma=args.sigma,
+                    norm=args.adv_norm,
+                    step_schedule=args.adv_step_schedule,
+                    step_size_final=args.eta_final)
 
         self.model.eval()
         for batch in tqdm(eval_dataloader, desc="Evaluating"):
+            example_indices = batch[5].numpy()
             batch = tuple(t.to(self.args.device) for t in batch)
-            adv_outputs = []  # (k_iter, batch_size)
-            # Set static embedding layer
-            _delta = None
-            for i_iter in range(args.K):
-                input_embedding = torch.stack([_embed_layer(x) for x in batch[0]])
-                if not _delta:
-                    m = torch.distributions.multivariate_normal.MultivariateNormal(torch.zeros(768),torch.eye(768)*(args.sigma ** 2))
-                    _sample = m.sample((args.max_seq_length,))
-                    _delta = torch.tensor(_sample, requires_grad = True, device = self.args.device)
-
-                adv_input_embedding = input_embedding + _delta
-                inputs = {
-                    "input_ids": None,
-                    "attention_mask": batch[1],
-                    "token_type_ids": batch[2],
-                    "start_positions": batch[3],
-                    "end_positions": batch[4],
-                    "inputs_embeds": adv_input_embedding,
-                }
-
-                if self.params.model_type in ["xlm", "roberta", "distilbert"]:
-                    del inputs["token_type_ids"]
-
-                intermed_adv_outputs = self.model(**inputs)
-
-                adv_loss = intermed_adv_outputs[0]
-                adv_loss.backward()
-
-                # Calculate g_adv and update delta
-                g_adv = _delta.grad.data.detach()
-                _delta = self._adv_sgn_attack(_delta, args.eps, args.eta, 'inf')
-                del g_adv
-            _delta.grad.zero_()
-
             # TODO: Check inf/NaN. How should we proceed with eval if NaNs?
+            adv_outputs = attack(batch)
 
-            with torch.no_grad():
-                # Generate adversarial loss with perturbed inputs against predicted logits
-                inputs = {
-                    "input_ids": None,
-                    "attention_mask": batch[1],
-                    "token_type_ids": batch[2],
-                    "inputs_embeds": input_embedding + _delta
-                }
-
-                if self.params.model_type in ["xlm", "roberta", "distilbert"]:
-                    del inputs["token_type_ids"]
-
-                adv_outputs = self.model(**inputs)
-
-                example_indices = batch[5]
-
-            for i, example_index in enumerate(example_indices):
-                eval_feature = features[example_index.item()]
-                unique_id = int(eval_feature.unique_id)
-
-                adv_output = [tensor_to_list(output[i]) for output in adv_outputs]
-
-                start_logits, end_logits = adv_output
-                result = SquadResult(unique_id, start_logits, end_logits)
-                example_id = example_index.item()
-                all_results.append(result)
+            batch_logits = torch.stack(adv_outputs, dim=1).float().cpu().numpy()
+            if all_logits is None:
+                all_logits = np.empty((len(dataset),) + batch_logits.shape[1:], dtype=np.float32)
+            batch_size = len(example_indices)
+            all_logits[num_evaluated:num_evaluated + batch_size] = batch_logits
+            all_example_indices[num_evaluated:num_evaluated + batch_size] = example_indices
+            num_evaluated += batch_size
 
         eval_time = timeit.default_timer() - start_time
         logger.info("  Evaluation done in total %f secs (%f sec per example)", eval_time, eval_time / len(dataset))
 
-        predictions = compute_predictions_logits(
+        predictions = compute_predictions(
             examples,
             features,
-            all_results,
+            all_example_indices,
+            all_logits,
             args.n_best_size,
             args.max_answer_length,
             args.do_lower_case,
-            None,
-            None,
-            None,
             args.verbose_logging,
             args.version_2_with_negative,
             args.null_score_diff_threshold,
@@ -580,12 +654,16 @@ class Trainer(HFTrainer):
         logger.info("  Num examples = %d", len(dataset))
         logger.info("  Batch size = %d", eval_batch_size)
 
-        all_results = []
+        # Logits are gathered on the host with one transfer per batch
+        all_logits = None
+        all_example_indices = np.empty(len(dataset), dtype=np.int64)
+        num_evaluated = 0
         start_time = timeit.default_timer()
 
         for batch in tqdm(eval_dataloader, desc="Evaluating"):
 
             self.model.eval()
+            example_indices = batch[5].numpy()
             batch = tuple(t.to(self.args.device) for t in batch)
             with torch.no_grad():
                 inputs = {
@@ -597,37 +675,28 @@ class Trainer(HFTrainer):
                 if self.params.model_type in ["xlm", "roberta", "distilbert"]:
                     del inputs["token_type_ids"]
 
-                example_indices = batch[3]
-
                 outputs = self.model(**inputs)
 
-                example_indices = batch[5]
-
-            for i, example_index in enumerate(example_indices):
-                eval_feature = features[example_index.item()]
-                unique_id = int(eval_feature.unique_id)
-
-                output = [tensor_to_list(output[i]) for output in outputs]
-
-                start_logits, end_logits = output
-                result = SquadResult(unique_id, start_logits, end_logits)
-
-                all_results.append(result)
+            batch_logits = torch.stack(outputs[:2], dim=1).float().cpu().numpy()
+            if all_logits is None:
+                all_logits = np.empty((len(dataset),) + batch_logits.shape[1:], dtype=np.float32)
+            batch_size = len(example_indices)
+            all_logits[num_evaluated:num_evaluated + batch_size] = batch_logits
+            all_example_indices[num_evaluated:num_evaluated + batch_size] = example_indices
+            num_evaluated += batch_size
 
         eval_time = timeit.default_timer() - start_time
         logger.info("  Evaluation done in total %f secs (%f sec per example)", eval_time, eval_time / len(dataset))
 
         # Compute predictions
-        predictions = compute_predictions_logits(
+        predictions = compute_predictions(
             examples,
             features,
-            all_results,
+            all_example_indices,
+            all_logits,
             args.n_best_size,
             args.max_answer_length,
             args.do_lower_case,
-            None,
-            None,
-            None,
             args.verbose_logging,
             args.version_2_with_negative,
             args.null_score_diff_threshold,
@@ -1,18 +1,26 @@
 import random
 import torch
 import os
+import json
+import hashlib
 import logging
 import requests
 import glob
+import threading
 import numpy as np
-from typing import Tuple
-from dataclasses import replace
+from datetime import timedelta
+from typing import Callable, Dict, List, Tuple
+from dataclasses import fields, replace
 from torch.utils.data import Dataset
-from transformers.data.processors.squad import SquadV1Processor, SquadV2Processor
-from transformers import squad_convert_examples_to_features
+from transformers.data.processors.squad import SquadV1Processor
 from prefect import Flow, task
+from prefect.engine.cache_validators import partial_inputs_only
+from prefect.engine.executors import LocalDaskExecutor, LocalExecutor
 from prefect.utilities.notifications import slack_notifier
 from kitanaqa.trainer.train import Trainer
+from kitanaqa.trainer.eval_store import EvalResultStore, eval_args_hash, file_hash
+from kitanaqa.trainer.feature_store import FeatureStore, feature_store_exists, save_feature_store
+from kitanaqa.trainer.mixing import MixedFeatureDataset
 from kitanaqa.trainer.alum_squad_processor import (
     alum_squad_convert_examples_to_features,
     AlumSquadV1Processor,
@@ -41,12 +49,26 @@ MODEL_CLASSES = {
 logger = logging.getLogger(__name__)
 
 
+def get_cached_features_file(args, evaluate=False, use_aug_path=False) -> str:
+    """ Path of the features cached by `load_and_cache_examples` """
+    train_or_aug_path = args.train_file_path if not use_aug_path else args.aug_file_path
+    return os.path.join(
+        args.data_dir if args.data_dir else ".",
+        "cached_{}_{}_{}".format(
+            "dev" if evaluate else "train_{}".format(os.path.splitext(os.path.basename(train_or_aug_path or "squad"))[0]),
+            list(filter(None, args.model_name_or_path.split("/"))).pop(),
+            str(args.max_seq_length),
+        ),
+    )
+
+
 def load_and_cache_examples(
         args,
         tokenizer,
         evaluate=False,
         use_aug_path=False,
-        output_examples=False) -> torch.utils.data.TensorDataset:
+        output_examples=False,
+        context_cache=None) -> torch.utils.data.TensorDataset:
     """Loads SQuAD-like data features from dataset file (or cache)
 
     Parameters
@@ -75,6 +97,10 @@ def load_and_cache_examples(
             Corresponds to the doc_stride input param for some Huggingface Transformer models.
         - args.max_query_length : Optional[int]
               Max length for the query segment in the Transformer model input.
+        - args.preprocessing_num_workers : Optional[int]
+              Number of processes used to convert examples to features. With 1, featurisation runs in-process.
+        - args.use_fast_tokenizer : Optional[bool]
+              Featurise in batches with the Rust fast tokenizer equivalent to `tokenizer`, where one exists.
     tokenizer : 
         The Transformer model tokenizer used to preprocess the data.
     evaluate : Optional(Bool)
@@ -83,13 +109,15 @@ def load_and_cache_examples(
         A flag to define whether to use the aug_file_path or the train_file_path. If True, the augmented data path is used when loading and caching the data.
     output_examples : Optional(Bool)
         A flag to define whether the examples and features should be returned by the data preprocessor. If False, the preprocessor only returns the dataset. This is necessary if the Trainer is used for evaluation or in a pipeline where training is followed by evaluation.
+    context_cache : Optional(Dict)
+        Encoded contexts keyed by a hash of (context, title). Pass the same dict when loading the training set and its augmentations so that each context is tokenised and windowed once, and only the new questions are encoded.
 
     Returns
     -------
     torch.utils.data.TensorDataset
         The dataset containing the data to be used for training or evaluation.
         Important Notes:
-        - If the output_examples is True, examples and features also are returned.
+        - If the output_examples is True, examples and features also are returned. Training examples are streamed into featurisation and not kept, so they are returned as None.
         - If evaluate = True, the output will be a dictionary for which the keys are the name of the datasets used for evaluation and the values are the dataset (and optionally the examples and features).
         
     """
@@ -101,14 +129,7 @@ def load_and_cache_examples(
     train_or_aug_path = args.train_file_path if not use_aug_path else args.aug_file_path
 
     input_dir = args.data_dir if args.data_dir else "."
-    cached_features_file = os.path.join(
-        input_dir,
-        "cached_{}_{}_{}".format(
-            "dev" if evaluate else "train",
-            list(filter(None, args.model_name_or_path.split("/"))).pop(),
-            str(args.max_seq_length),
-        ),
-    )
+    cached_features_file = get_cached_features_file(args, evaluate=evaluate, use_aug_path=use_aug_path)
 
     # Init features and dataset from cache if it exists
     if os.path.exists(cached_features_file) and not args.overwrite_cache:
@@ -142,21 +163,25 @@ def load_and_cache_examples(
                     examples[predict_sets] = processor.alum_get_dev_examples(args.data_dir, filename=predict_paths)
                     logger.info("Evaluation Data is fetched for %s.", predict_sets)
             else:
-                processor = SquadV2Processor() if args.version_2_with_negative else SquadV1Processor()
-                examples = processor.get_train_examples(args.data_dir, filename=train_or_aug_path)
+                # Training examples are streamed from the file straight into featurisation
+                processor = AlumSquadV2Processor() if args.version_2_with_negative else AlumSquadV1Processor()
+                examples = processor.alum_iter_examples(args.data_dir, filename=train_or_aug_path)
         
         
         if not evaluate:
-            features, dataset = squad_convert_examples_to_features(
+            features, dataset = alum_squad_convert_examples_to_features(
                 examples=examples,
                 tokenizer=tokenizer,
                 max_seq_length=args.max_seq_length,
                 doc_stride=args.doc_stride,
                 max_query_length=args.max_query_length,
-                is_training=not evaluate,
                 return_dataset="pt",
-                #threads=args.threads,
+                threads=args.preprocessing_num_workers,
+                use_fast_tokenizer=args.use_fast_tokenizer,
+                context_cache=context_cache,
             )
+            # Training examples are not needed once featurised, so they are not kept or cached
+            examples = None
 
             logger.info("Saving features into cached file %s", cached_features_file)
             torch.save({"features": features, "dataset": dataset, "examples": examples}, cached_features_file)
@@ -172,7 +197,8 @@ def load_and_cache_examples(
                     doc_stride=args.doc_stride,
                     max_query_length=args.max_query_length,
                     return_dataset="pt",
-                    #threads=args.threads,
+                    threads=args.preprocessing_num_workers,
+                    use_fast_tokenizer=args.use_fast_tokenizer,
                 )
                 logger.info("Feature Extraction for Evaluation Data from %s is Finished.", predict_sets)
             logger.info("Saving features into cached file %s", cached_features_file)
@@ -183,6 +209,234 @@ def load_and_cache_examples(
     return dataset
 
 
+# Model arguments which change the features generated by the augmentation stage
+AUG_STAGE_ARG_NAMES = [
+    "model_type",
+    "max_seq_length",
+    "doc_stride",
+    "max_query_length",
+    "version_2_with_negative",
+    "aug_sample_ratio",
+    "aug_num_replacements",
+    "aug_p_dropword",
+    "aug_p_replace",
+    "aug_p_misspelling",
+    "aug_sampling_strategy",
+    "aug_sampling_k",
+    "aug_seed",
+]
+
+def get_aug_stage_cache_file(args) -> str:
+    """ Path of the features cached by the augmentation stage, named after a hash of the training file and the arguments generating them """
+    values = {name: getattr(args, name) for name in AUG_STAGE_ARG_NAMES}
+    values["tokenizer_name_or_path"] = args.tokenizer_name_or_path or args.model_name_or_path
+    values["train_file_hash"] = file_hash(os.path.join(args.data_dir or "", args.train_file_path))
+    if args.aug_importance_scores_file:
+        values["importance_scores_hash"] = file_hash(args.aug_importance_scores_file)
+    aug_hash = hashlib.sha1(json.dumps(values, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+    return os.path.join(
+        args.data_dir if args.data_dir else ".",
+        "cached_aug_{}_{}_{}_{}".format(
+            os.path.splitext(os.path.basename(args.train_file_path))[0],
+            list(filter(None, args.model_name_or_path.split("/"))).pop(),
+            str(args.max_seq_length),
+            aug_hash[:12],
+        ),
+    )
+
+
+def load_and_cache_aug_stage(args, tokenizer, context_cache=None) -> torch.utils.data.TensorDataset:
+    """Generates the augmented training set and converts it to features, or loads them from cache
+
+    Perturbations of the examples in train_file_path are generated by `SQuADDataset.iter_generate`
+    and streamed into featurisation, so no augmented SQuAD file is written or held in memory. The
+    features are cached under a name which hashes the training file and the generation and
+    featurisation arguments, see `get_aug_stage_cache_file`, and are only generated again when
+    one of them changes.
+
+    Parameters
+    ----------
+    args : kitanaqa.trainer.arguments.ModelArguments
+        A set of arguments related to the model. Specifically, the following arguments are used in this function:
+        - args.train_file_path : str
+            Path to the training data file, relative to data_dir if given
+        - args.aug_sample_ratio, args.aug_num_replacements, args.aug_p_dropword, args.aug_p_replace, args.aug_p_misspelling, args.aug_sampling_strategy, args.aug_sampling_k : 
+            Parameters of the generated perturbations, see `SQuADDataset`
+        - args.aug_importance_scores_file : Optional[str]
+            Term importance scores of the training questions, see `kitanaqa.augment.importance_scores`
+        - args.aug_seed : int
+            Random seed of the generation
+        - args.overwrite_cache : Bool
+            Generate the features again, even if they are cached
+        As well as the featurisation arguments of `load_and_cache_examples`.
+    tokenizer : 
+        The Transformer model tokenizer used to preprocess the data.
+    context_cache : Optional(Dict)
+        Encoded contexts keyed by a hash of (context, title), shared with the featurisation of the training set.
+
+    Returns
+    -------
+    torch.utils.data.TensorDataset
+        The dataset of the augmented features.
+    """
+    cached_features_file = get_aug_stage_cache_file(args)
+    if os.path.exists(cached_features_file) and not args.overwrite_cache:
+        logger.info("Loading augmented features from cached file %s", cached_features_file)
+        return torch.load(cached_features_file)["dataset"]
+
+    # Imported here, as the perturbation generators fetch their resources on import
+    from kitanaqa.augment.augment_squad import SQuADDataset
+    from kitanaqa.augment.importance_scores import load_importance_scores
+    logger.info("Generating augmented features from dataset file %s", args.train_file_path)
+    with open(os.path.join(args.data_dir or "", args.train_file_path), "r", encoding="utf-8") as f:
+        raw_examples = json.load(f)
+    random.seed(args.aug_seed)
+    np.random.seed(args.aug_seed)
+    aug_generator = SQuADDataset(
+        raw_examples,
+        custom_importance_scores=load_importance_scores(args.aug_importance_scores_file) if args.aug_importance_scores_file else None,
+        is_training=True,
+        sample_ratio=args.aug_sample_ratio,
+        num_replacements=args.aug_num_replacements,
+        sampling_k=args.aug_sampling_k,
+        sampling_strategy=args.aug_sampling_strategy,
+        p_replace=args.aug_p_replace,
+        p_dropword=args.aug_p_dropword,
+        p_misspelling=args.aug_p_misspelling,
+    )
+    processor = AlumSquadV2Processor() if args.version_2_with_negative else AlumSquadV1Processor()
+    features, dataset = alum_squad_convert_examples_to_features(
+        examples=processor.alum_iter_aug_examples(
+            aug_generator.iter_generate(),
+            aug_generator.title_map,
+            aug_generator.context_map),
+        tokenizer=tokenizer,
+        max_seq_length=args.max_seq_length,
+        doc_stride=args.doc_stride,
+        max_query_length=args.max_query_length,
+        return_dataset="pt",
+        threads=args.preprocessing_num_workers,
+        use_fast_tokenizer=args.use_fast_tokenizer,
+        context_cache=context_cache,
+    )
+
+    logger.info("Saving augmented features into cached file %s", cached_features_file)
+    # Renamed once complete, so that an interrupted stage does not leave a matching cache
+    torch.save({"features": features, "dataset": dataset, "examples": None}, cached_features_file + ".tmp")
+    os.replace(cached_features_file + ".tmp", cached_features_file)
+    return dataset
+
+
+def load_feature_store(cached_features_file: str, load_dataset: Callable, overwrite_cache: bool=False) -> FeatureStore:
+    """Memory-mapped store of the features cached in cached_features_file, written from the loaded dataset the first time
+
+    Parameters
+    ----------
+    cached_features_file : str
+        The cache of the features. The store is written next to it.
+    load_dataset : Callable
+        Returns the TensorDataset of the features, e.g. by loading the cache.
+    overwrite_cache : Optional(bool)
+        Write the store again, even if it exists. The default value is False.
+
+    Returns
+    -------
+    kitanaqa.trainer.feature_store.FeatureStore
+        The features, read from disk when they are indexed.
+    """
+    store_path = cached_features_file + "_store"
+    if overwrite_cache or not feature_store_exists(store_path):
+        dataset = load_dataset()
+        save_feature_store(dataset, store_path)
+        del dataset
+    logger.info("Loading features from feature store %s", store_path)
+    return FeatureStore(store_path)
+
+
+def load_train_inputs(model_args, training_args) -> Tuple:
+    """Loads the pre-trained model, the tokenizer and the training dataset of a run
+
+    Parameters
+    ----------
+    model_args : kitanaqa.trainer.arguments.ModelArguments
+        A set of arguments related to the model, the training data and its augmentation.
+    training_args : transformers.training_args.TrainingArguments
+        A set of arguments related to the training loop.
+
+    Returns
+    -------
+    Tuple
+        The model, the tokenizer and the training dataset. The dataset is None unless `do_train` is set.
+    """
+    # Load model and tokenizer
+    config, model_cls, tokenizer_cls = MODEL_CLASSES[model_args.model_type]
+    tokenizer = tokenizer_cls.from_pretrained(
+        model_args.tokenizer_name_or_path if model_args.tokenizer_name_or_path else model_args.model_name_or_path,
+        cache_dir=model_args.cache_dir,
+    )
+
+    model = model_cls.from_pretrained(
+        model_args.model_name_or_path,
+        cache_dir=model_args.cache_dir,
+    )
+
+    # Augmented examples reuse the contexts of the training set, so they share its tokenised contexts
+    context_cache = {} if model_args.do_aug else None
+
+    # Load training dataset
+    if training_args.do_train and model_args.do_online_aug:
+        # Imported here, as the perturbation generators fetch their resources on import
+        from kitanaqa.trainer.online_augment import OnlineAugSquadDataset
+        from kitanaqa.augment.importance_scores import load_importance_scores
+        processor = AlumSquadV2Processor() if model_args.version_2_with_negative else AlumSquadV1Processor()
+        train_dataset = OnlineAugSquadDataset(
+            processor.alum_get_dev_examples(model_args.data_dir, filename=model_args.train_file_path),
+            tokenizer,
+            max_seq_length=model_args.max_seq_length,
+            doc_stride=model_args.doc_stride,
+            max_query_length=model_args.max_query_length,
+            sample_ratio=model_args.aug_sample_ratio,
+            num_replacements=model_args.aug_num_replacements,
+            p_replace=model_args.aug_p_replace,
+            p_dropword=model_args.aug_p_dropword,
+            p_misspelling=model_args.aug_p_misspelling,
+            custom_importance_scores=load_importance_scores(model_args.aug_importance_scores_file) if model_args.aug_importance_scores_file else None,
+            sampling_strategy=model_args.aug_sampling_strategy,
+            sampling_k=model_args.aug_sampling_k,
+            use_fast_tokenizer=model_args.use_fast_tokenizer,
+        )
+    elif training_args.do_train and model_args.use_feature_store:
+        train_dataset = load_feature_store(
+                            get_cached_features_file(model_args),
+                            lambda: load_and_cache_examples(model_args, tokenizer, context_cache=context_cache),
+                            overwrite_cache=model_args.overwrite_cache)
+    elif training_args.do_train:
+        train_dataset = load_and_cache_examples(model_args, tokenizer, context_cache=context_cache)
+    else:
+        train_dataset = None
+
+    # Load aug dataset
+    if training_args.do_train and model_args.do_aug and not model_args.do_online_aug:
+        if model_args.do_aug_stage:
+            cached_aug_file = get_aug_stage_cache_file(model_args)
+            load_aug_dataset = lambda: load_and_cache_aug_stage(model_args, tokenizer, context_cache=context_cache)
+        else:
+            cached_aug_file = get_cached_features_file(model_args, use_aug_path=True)
+            load_aug_dataset = lambda: load_and_cache_examples(model_args, tokenizer, use_aug_path=True, context_cache=context_cache)
+        if model_args.use_feature_store:
+            aug_dataset = load_feature_store(cached_aug_file, load_aug_dataset, overwrite_cache=model_args.overwrite_cache)
+        else:
+            aug_dataset = load_aug_dataset()
+        if model_args.aug_mix_ratio is not None:
+            logger.info('Mix augmented examples with original examples. Train length = {}, Aug length = {}'.format(len(train_dataset), len(aug_dataset)))
+            train_dataset = MixedFeatureDataset(train_dataset, aug_dataset)
+        else:
+            logger.info('Concatenate augmented examples to original examples. Train length = {}, Aug length = {}'.format(len(train_dataset), len(aug_dataset)))
+            train_dataset += aug_dataset
+
+    return model, tokenizer, train_dataset
+
+
 slack_url = os.environ['SLACK_WEBHOOK_URL'] if 'SLACK_WEBHOOK_URL' in os.environ else None
 def post_to_slack(obj, old_state, new_state):
     """
@@ -198,6 +452,128 @@ def post_to_slack(obj, old_state, new_state):
     return new_state
 
 
+def load_checkpoint_weights(model, checkpoint: str):
+    """Load the weights saved in a checkpoint directory into an existing model, in place
+
+    Parameters
+    ----------
+    model : transformers.PreTrainedModel
+        The model to update. It must have the architecture of the checkpoint.
+    checkpoint : str
+        The checkpoint directory, containing the weights file written by `save_pretrained`.
+    """
+    state_dict = torch.load(os.path.join(checkpoint, WEIGHTS_NAME), map_location="cpu")
+    model.load_state_dict(state_dict)
+    logger.info("Loaded the weights of %s", checkpoint)
+
+
+# The state of an evaluation worker, which is kept across its jobs
+_eval_worker_state = {}
+
+
+def _init_eval_worker(model_args, eval_args, tokenizer, dataset, examples=None, features=None, num_threads: int=None, state: Dict=None):
+    """Set up the evaluation worker state, limiting the number of threads of the process if given
+
+    Without examples and features, they are loaded from the eval feature cache of `load_and_cache_examples`.
+    Spawned workers load them once this way, rather than each receiving a pickled copy of the lists, and
+    keep the eval tensors given in shared memory rather than the cached ones.
+    """
+    if num_threads:
+        torch.set_num_threads(num_threads)
+    if examples is None or features is None:
+        cached_features = torch.load(get_cached_features_file(model_args, evaluate=True))
+        examples, features = cached_features["examples"], cached_features["features"]
+        del cached_features
+    state = _eval_worker_state if state is None else state
+    state.clear()
+    state.update(
+                        model_args=model_args,
+                        eval_args=eval_args,
+                        tokenizer=tokenizer,
+                        dataset=dataset,
+                        examples=examples,
+                        features=features)
+
+
+def _eval_worker(job: Tuple[str, str], state: Dict=None):
+    """ Evaluate a checkpoint on a predict set, reusing the model of the previous job of the worker """
+    checkpoint, predict_set = job
+    state = _eval_worker_state if state is None else state
+    model_args = state['model_args']
+    if 'trainer' not in state:
+        _, model_cls, _ = MODEL_CLASSES[model_args.model_type]
+        state['model'] = model_cls.from_pretrained(
+            checkpoint,
+            cache_dir=model_args.cache_dir,
+        )
+        state['trainer'] = Trainer(
+            model_args=model_args,
+            data_collator=None,
+            model=state['model'],
+            tokenizer=state['tokenizer'],
+            args=state['eval_args'],
+            prediction_loss_only=True,
+        )
+    elif state['checkpoint'] != checkpoint:
+        load_checkpoint_weights(state['model'], checkpoint)
+    state['checkpoint'] = checkpoint
+
+    trainer = state['trainer']
+    evaluate = trainer.adv_evaluate if model_args.do_adv_eval else trainer.evaluate
+    results = evaluate(
+                checkpoint,
+                model_args,
+                state['tokenizer'],
+                state['dataset'][predict_set],
+                state['examples'][predict_set],
+                state['features'][predict_set])
+    return checkpoint, predict_set, results
+
+
+def _get_checkpoints(model_args, training_args) -> List[str]:
+    """ The checkpoints to evaluate, all those in the output_dir if eval_all_checkpoints is set """
+    if model_args.eval_all_checkpoints:
+        checkpoints = list(
+            os.path.dirname(c)
+            for c in sorted(glob.glob(training_args.output_dir + "/**/" + WEIGHTS_NAME, recursive=True))
+        )
+        return [x for x in checkpoints if 'checkpoint' in x]
+    if not os.path.exists(model_args.model_name_or_path):
+        logger.warning("You are running a non-local model checkpoint. This may or may not be what you intended.")
+    return [model_args.model_name_or_path]
+
+
+def _get_eval_store(model_args, training_args) -> EvalResultStore:
+    return EvalResultStore(
+                model_args.eval_results_file
+                or os.path.join(training_args.output_dir, "eval_results.jsonl"))
+
+
+def _get_eval_keys(model_args, checkpoints: List[str], adv: bool) -> Dict:
+    """ The EvalResultStore keys of the (checkpoint, predict_set) pairs whose weights and predict files are local """
+    if not model_args.predict_file_path:
+        return {}
+    args_hash = eval_args_hash(model_args, adv)
+    predict_file_hashes = {}
+    for predict_set, predict_path in model_args.predict_file_path.items():
+        predict_path = os.path.join(model_args.data_dir or "", predict_path)
+        if os.path.isfile(predict_path):
+            predict_file_hashes[predict_set] = file_hash(predict_path)
+    eval_keys = {}
+    for checkpoint in checkpoints:
+        weights_path = os.path.join(checkpoint, WEIGHTS_NAME)
+        if not os.path.isfile(weights_path):
+            continue
+        weights_hash = file_hash(weights_path)
+        for predict_set, predict_file_hash in predict_file_hashes.items():
+            eval_keys[(checkpoint, predict_set)] = EvalResultStore.make_key(
+                                                            weights_hash,
+                                                            predict_file_hash,
+                                                            args_hash,
+                                                            adv)
+    return eval_keys
+
+
 @task(name="eval", state_handlers=[post_to_slack])
 def eval_task(args):
     """Evaluates the model on a the evaluation datasets
@@ -216,6 +592,10 @@ def eval_task(args):
               Pretrained tokenizer name or path if not the same as model_name
         - cache_dir : str
               The path to store the pretrained models
+        - eval_num_workers : int
+              Number of processes evaluating (checkpoint, predict set) pairs in parallel, on CPU only. The workers share the eval tensors, and each loads the examples and features once from the feature cache
+        - eval_results_file : str
+              JSON lines store of the results, keyed by the checkpoint weights, predict file, eval arguments and do_adv_eval. Stored results are returned without evaluating again. The default is `eval_results.jsonl` in the output_dir
         The following arguments from the TrainingArguments are used in this function:
         - output_dir : str
               The output directory where the model predictions and checkpoints will be written.
@@ -249,81 +629,342 @@ def eval_task(args):
     """
     model_args, training_args = args
     all_eval_sets_results = {}
-    if model_args.eval_all_checkpoints:
-        checkpoints = [training_args.output_dir]
-        checkpoints = list(
-            os.path.dirname(c)
-            for c in sorted(glob.glob(training_args.output_dir + "/**/" + WEIGHTS_NAME, recursive=True))
-        )
-        checkpoints = [x for x in checkpoints if 'checkpoint' in x]
-    else:
-        if not os.path.exists(model_args.model_name_or_path):
-            logger.warning("You are running a non-local model checkpoint. This may or may not be what you intended.")
-        checkpoints = [model_args.model_name_or_path]
-    for checkpoint in checkpoints:
-        # Load model and tokenizer
-        config, model_cls, tokenizer_cls = MODEL_CLASSES[model_args.model_type]
-        tokenizer = tokenizer_cls.from_pretrained(
-            model_args.tokenizer_name_or_path if model_args.tokenizer_name_or_path else checkpoint,
-            cache_dir=model_args.cache_dir,
-        )
-        model = model_cls.from_pretrained(
-            checkpoint,
-            cache_dir=model_args.cache_dir,
-        )
-
-        # Initialize the Trainer
-        eval_args = replace(training_args, do_train=False)
-        trainer = Trainer(
-            model_args=model_args,
-            data_collator=None,
-            model=model,
-            tokenizer=tokenizer,
-            args=eval_args,
-            prediction_loss_only=True,
-        )
+    checkpoints = _get_checkpoints(model_args, training_args)
+    if not checkpoints:
+        logger.warning("No checkpoint found in %s", training_args.output_dir)
+        return all_eval_sets_results
 
-        # Load SQuAD-specific dataset and examples for metric calculation
-        dataset, examples, features = load_and_cache_examples(
-            model_args,
-            tokenizer,
-            evaluate=True,
-            output_examples=True)
-        
-        logger.info("Predict Sets are : %s", examples.keys())
-        for predict_set in examples:
-            results = {}
-            model_idx = checkpoint.split("-")[-1]
-            if model_args.do_adv_eval:
-                results[model_idx] = {
+    # Stored results are reused for unchanged (weights, predict file, eval args) pairs
+    eval_args = replace(training_args, do_train=False)
+    adv = bool(model_args.do_adv_eval)
+    store = _get_eval_store(model_args, training_args)
+    eval_keys = _get_eval_keys(model_args, checkpoints, adv)
+    jobs = []
+    for checkpoint in checkpoints:
+        for predict_set in (model_args.predict_file_path or {}):
+            key = eval_keys.get((checkpoint, predict_set))
+            results = store.get(key) if key else None
+            if results is not None:
+                logger.info("Reusing the results of %s on %s", checkpoint, predict_set)
+                all_eval_sets_results.setdefault(predict_set, {})[checkpoint.split("-")[-1]] = {
                                     'model_args': model_args,
                                     'training_args': eval_args,
-                                    'eval': trainer.adv_evaluate(
-                                            checkpoint,
-                                            model_args,
-                                            tokenizer,
-                                            dataset[predict_set],
-                                            examples[predict_set],
-                                            features[predict_set])
+                                    'eval': results
                             }
             else:
-                results[model_idx] = {
+                jobs.append((checkpoint, predict_set))
+    if model_args.predict_file_path and not jobs:
+        logger.info("Results: {}".format(all_eval_sets_results))
+        return all_eval_sets_results
+
+    # The tokenizer and eval datasets are loaded once. Each worker loads the model once, and only swaps the weights per checkpoint
+    config, model_cls, tokenizer_cls = MODEL_CLASSES[model_args.model_type]
+    tokenizer = tokenizer_cls.from_pretrained(
+        model_args.tokenizer_name_or_path if model_args.tokenizer_name_or_path else checkpoints[0],
+        cache_dir=model_args.cache_dir,
+    )
+
+    # Load SQuAD-specific dataset and examples for metric calculation
+    dataset, examples, features = load_and_cache_examples(
+        model_args,
+        tokenizer,
+        evaluate=True,
+        output_examples=True)
+    # Workers read the eval tensors from shared memory rather than from a copy
+    for predict_set in dataset:
+        for tensor in dataset[predict_set].tensors:
+            tensor.share_memory_()
+    logger.info("Predict Sets are : %s", examples.keys())
+    if not model_args.predict_file_path:
+        jobs = [(checkpoint, predict_set) for checkpoint in checkpoints for predict_set in examples]
+
+    num_workers = min(max(1, model_args.eval_num_workers), len(jobs))
+    if num_workers > 1 and eval_args.device.type != "cpu":
+        logger.warning("Checkpoints are only evaluated in parallel on CPU, evaluating sequentially on %s", eval_args.device)
+        num_workers = 1
+    worker_args = (model_args, eval_args, tokenizer, dataset, examples, features)
+    pool = None
+    if num_workers > 1:
+        # Each worker gets an equal share of the CPU threads, so that they do not oversubscribe the cores
+        num_threads = max(1, torch.get_num_threads() // num_workers)
+        logger.info("Evaluating with %d workers of %d threads", num_workers, num_threads)
+        # Only the tensors are shared, so the workers load the examples and features from the feature cache
+        pool = torch.multiprocessing.get_context("spawn").Pool(
+                                                    num_workers,
+                                                    initializer=_init_eval_worker,
+                                                    initargs=(model_args, eval_args, tokenizer, dataset, None, None, num_threads))
+        job_results = pool.imap_unordered(_eval_worker, jobs)
+    else:
+        _init_eval_worker(*worker_args)
+        job_results = map(_eval_worker, jobs)
+
+    try:
+        # Results are recorded as they finish
+        for checkpoint, predict_set, results in job_results:
+            all_eval_sets_results.setdefault(predict_set, {})[checkpoint.split("-")[-1]] = {
                                     'model_args': model_args,
                                     'training_args': eval_args,
-                                    'eval': trainer.evaluate(
-                                            checkpoint,
-                                            model_args,
-                                            tokenizer,
-                                            dataset[predict_set],
-                                            examples[predict_set],
-                                            features[predict_set])
+                                    'eval': results
                             }
-            all_eval_sets_results[predict_set] = results
-            logger.info("The evaluation for %s dataset is finished.", predict_set)
+            key = eval_keys.get((checkpoint, predict_set))
+            if key:
+                store.put(key, results, checkpoint=checkpoint, predict_set=predict_set)
+            logger.info("The evaluation of %s on %s dataset is finished.", checkpoint, predict_set)
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+        _eval_worker_state.clear()
     logger.info("Results: {}".format(all_eval_sets_results))
     return all_eval_sets_results
 
 
+# Eval datasets shared by the evaluation jobs of a flow, keyed by their tokenizer and featurisation arguments
+_eval_data_cache = {}
+_eval_data_lock = threading.Lock()
+
+
+def _file_stamp(path: str) -> Tuple:
+    """ The modification time and size of a file, or None if it does not exist """
+    if not os.path.isfile(path):
+        return None
+    stat = os.stat(path)
+    return stat.st_mtime_ns, stat.st_size
+
+
+def _get_eval_data(model_args) -> Tuple:
+    """ The tokenizer and the eval datasets, examples and features, loaded once per process """
+    # Training does not change the tokenizer, so the checkpoints of a run share the one it was trained with
+    tokenizer_name_or_path = model_args.tokenizer_name_or_path or model_args.model_name_or_path
+    cache_key = (
+        tokenizer_name_or_path,
+        model_args.model_name_or_path,
+        model_args.data_dir,
+        tuple(sorted(model_args.predict_file_path.items())),
+        # A predict file changed since it was loaded is loaded again
+        tuple(_file_stamp(os.path.join(model_args.data_dir or "", path)) for _, path in sorted(model_args.predict_file_path.items())),
+        eval_args_hash(model_args, adv=False),
+    )
+    with _eval_data_lock:
+        if cache_key not in _eval_data_cache:
+            _, _, tokenizer_cls = MODEL_CLASSES[model_args.model_type]
+            tokenizer = tokenizer_cls.from_pretrained(
+                tokenizer_name_or_path,
+                cache_dir=model_args.cache_dir,
+            )
+            dataset, examples, features = load_and_cache_examples(
+                model_args,
+                tokenizer,
+                evaluate=True,
+                output_examples=True)
+            _eval_data_cache[cache_key] = (tokenizer, dataset, examples, features)
+        return _eval_data_cache[cache_key]
+
+
+def get_run_args(args, aug_configs: List[Dict]) -> List[Tuple]:
+    """Derives the arguments of a training run for each augmentation configuration
+
+    Parameters
+    ----------
+    args : tuple
+        The base (ModelArguments, TrainingArguments) of the runs.
+    aug_configs : List[Dict]
+        The arguments which differ in each run, e.g. `aug_file_path` or `aug_p_replace`. Keys may be fields of either the ModelArguments or the TrainingArguments. Unless an `output_dir` is given, run i is written to `run-i` in the base output_dir.
+
+    Returns
+    -------
+    List[Tuple]
+        The (ModelArguments, TrainingArguments) of each run.
+    """
+    model_args, training_args = args
+    model_fields = {f.name for f in fields(model_args)}
+    training_fields = {f.name for f in fields(training_args)}
+    runs = []
+    for i, config in enumerate(aug_configs):
+        unknown = set(config) - model_fields - training_fields
+        if unknown:
+            raise ValueError('Unknown arguments in augmentation config {}: {}'.format(i, sorted(unknown)))
+        training_config = {k: v for k, v in config.items() if k in training_fields and k not in model_fields}
+        training_config.setdefault('output_dir', os.path.join(training_args.output_dir, 'run-{}'.format(i)))
+        runs.append((
+            replace(model_args, **{k: v for k, v in config.items() if k in model_fields}),
+            replace(training_args, **training_config),
+        ))
+    return runs
+
+
+def get_flow_executor(num_workers: int=1):
+    """ A local executor running up to num_workers tasks of a flow at the same time, in threads """
+    if num_workers > 1:
+        return LocalDaskExecutor(scheduler="threads", num_workers=num_workers)
+    return LocalExecutor()
+
+
+def _aug_stage_worker(model_args):
+    """ Generates and caches the augmented features of a run, along with their feature store if used """
+    _, _, tokenizer_cls = MODEL_CLASSES[model_args.model_type]
+    tokenizer = tokenizer_cls.from_pretrained(
+        model_args.tokenizer_name_or_path if model_args.tokenizer_name_or_path else model_args.model_name_or_path,
+        cache_dir=model_args.cache_dir,
+    )
+    load_aug_dataset = lambda: load_and_cache_aug_stage(model_args, tokenizer)
+    if model_args.use_feature_store:
+        load_feature_store(get_aug_stage_cache_file(model_args), load_aug_dataset, overwrite_cache=True)
+    else:
+        load_aug_dataset()
+
+
+@task(name="augment", state_handlers=[post_to_slack])
+def augment_task(args):
+    """Runs the augmentation stage of a run, unless its features are already cached
+
+    The stage runs in a separate process: generation seeds and draws from the global random
+    state, which the tasks running in other threads of the flow also use.
+
+    Parameters
+    ----------
+    args : tuple
+        The (ModelArguments, TrainingArguments) of the run. The stage only runs for training with `do_aug_stage`, see `load_and_cache_aug_stage`.
+
+    Returns
+    -------
+    tuple
+        The args of the run, once its augmented features are cached. When the stage has generated them, `overwrite_cache` is unset, so that the run loads them instead of generating them again.
+    """
+    model_args, training_args = args
+    if not (training_args.do_train and model_args.do_aug and model_args.do_aug_stage) or model_args.do_online_aug:
+        return args
+    cached_features_file = get_aug_stage_cache_file(model_args)
+    if os.path.exists(cached_features_file) and not model_args.overwrite_cache:
+        logger.info("Skipping the augmentation stage, the features are cached in %s", cached_features_file)
+        return args
+
+    with torch.multiprocessing.get_context("spawn").Pool(1) as pool:
+        pool.apply(_aug_stage_worker, (model_args,))
+    return replace(model_args, overwrite_cache=False), training_args
+
+
+@task(name="train_run", state_handlers=[post_to_slack])
+def train_run_task(args):
+    """Loads the model and training data of a run and trains it
+
+    Parameters
+    ----------
+    args : tuple
+        The (ModelArguments, TrainingArguments) of the run, e.g. from `get_run_args`.
+
+    Returns
+    -------
+    tuple
+        The args of the run, once it is trained.
+    """
+    model, tokenizer, train_dataset = load_train_inputs(*args)
+    train_task.run(args, model, tokenizer, train_dataset)
+    return args
+
+
+@task(name="list_eval_jobs")
+def list_eval_jobs_task(runs: List[Tuple]) -> Tuple[List[Tuple], List[str]]:
+    """ The (model_args, training_args, checkpoint, predict_set) evaluation jobs of the runs, and the EvalResultStore key of each job """
+    jobs = []
+    eval_keys = []
+    for model_args, training_args in runs:
+        if not model_args.predict_file_path:
+            raise ValueError('Flow evaluation requires predict_file_path')
+        checkpoints = _get_checkpoints(model_args, training_args)
+        run_eval_keys = _get_eval_keys(model_args, checkpoints, bool(model_args.do_adv_eval))
+        for checkpoint in checkpoints:
+            for predict_set in model_args.predict_file_path:
+                jobs.append((model_args, training_args, checkpoint, predict_set))
+                eval_keys.append(run_eval_keys.get((checkpoint, predict_set)))
+    return jobs, eval_keys
+
+
+_validate_eval_key = partial_inputs_only(validate_on=["eval_key"])
+
+
+def _eval_key_validator(state, inputs: Dict, parameters: Dict) -> bool:
+    """ Cached results are only reused for the same EvalResultStore key, i.e. the same weights, predict file and eval arguments """
+    # Without a key, e.g. for a remote checkpoint, the job is always evaluated
+    if inputs.get("eval_key") is None:
+        return False
+    return _validate_eval_key(state, inputs, parameters)
+
+
+# The evaluation state of each flow thread, which keeps its model across its jobs
+_eval_thread_state = threading.local()
+
+
+@task(name="eval_job", cache_for=timedelta(days=1), cache_validator=_eval_key_validator)
+def eval_job_task(job: Tuple, eval_key: str):
+    """Evaluates a checkpoint on a predict set, or returns the stored results of the pair
+
+    The tokenizer and eval sets are loaded once per process. Each flow thread loads the model once, swaps the weights of each checkpoint it evaluates, and uses an equal share of the CPU threads.
+
+    Parameters
+    ----------
+    job : tuple
+        The (ModelArguments, TrainingArguments, checkpoint, predict_set) of the evaluation.
+    eval_key : str
+        The EvalResultStore key of the job, on which the Prefect cache of the results is also validated. None if the checkpoint weights or predict file are not local.
+
+    Returns
+    -------
+    OrderedDict
+        The evaluation results of the job.
+    """
+    model_args, training_args, checkpoint, predict_set = job
+    store = _get_eval_store(model_args, training_args)
+    results = store.get(eval_key) if eval_key else None
+    if results is not None:
+        logger.info("Reusing the results of %s on %s", checkpoint, predict_set)
+        return results
+
+    tokenizer, dataset, examples, features = _get_eval_data(model_args)
+    eval_args = replace(training_args, do_train=False)
+    state = vars(_eval_thread_state)
+    if state.get('model_args') != model_args or state.get('eval_args') != eval_args:
+        num_threads = None
+        if model_args.flow_num_workers > 1:
+            num_threads = max(1, (os.cpu_count() or 1) // model_args.flow_num_workers)
+        _init_eval_worker(model_args, eval_args, tokenizer, dataset, examples, features, num_threads, state=state)
+    _, _, results = _eval_worker((checkpoint, predict_set), state=state)
+    if eval_key:
+        store.put(eval_key, results, checkpoint=checkpoint, predict_set=predict_set)
+    logger.info("The evaluation of %s on %s dataset is finished.", checkpoint, predict_set)
+    return results
+
+
+@task(name="eval_results", state_handlers=[post_to_slack])
+def collect_eval_results_task(jobs: List[Tuple], job_results: List) -> Dict:
+    """Gathers the results of the evaluation jobs
+
+    Parameters
+    ----------
+    jobs : List[Tuple]
+        The (ModelArguments, TrainingArguments, checkpoint, predict_set) of each evaluation job.
+    job_results : List
+        The evaluation results of each job.
+
+    Returns
+    -------
+    Dict
+        The results in the structure returned by `eval_task`. With several runs, the results of each run are keyed by its output_dir.
+    """
+    all_runs_results = {}
+    for (model_args, training_args, checkpoint, predict_set), results in zip(jobs, job_results):
+        run_results = all_runs_results.setdefault(training_args.output_dir, {})
+        run_results.setdefault(predict_set, {})[checkpoint.split("-")[-1]] = {
+                                    'model_args': model_args,
+                                    'training_args': replace(training_args, do_train=False),
+                                    'eval': results
+                            }
+    if len(all_runs_results) == 1:
+        all_runs_results = next(iter(all_runs_results.values()))
+    logger.info("Results: {}".format(all_runs_results))
+    return all_runs_results
+
+
 @task(name="train", state_handlers=[post_to_slack])
 def train_task(args, model, tokenizer, train_dataset):
     """Train the model on using the training dataset
@@ -372,19 +1013,28 @@ def build_flow(
             label: str='default',
             model=None,
             tokenizer=None,
-            train_dataset=None) -> Flow:
-    """Constructs a Prefect flow composed of sequential modeling steps
+            train_dataset=None,
+            aug_configs: List[Dict]=None) -> Flow:
+    """Constructs a Prefect flow composed of training and evaluation tasks
+
+    Evaluation is mapped over each (checkpoint, predict set) pair, and training over each
+    augmentation configuration, so that a parallel executor such as `get_flow_executor(n)`
+    runs them at the same time. Without a model, each run loads its own model and data in the
+    flow, after its augmentation stage, see `augment_task`. The results of the evaluation jobs
+    are cached on their EvalResultStore keys, see `eval_job_task`.
 
     Parameters
     ----------
     label : Optional(str)
         The unique tag used to identify the Flow instance. The default value is 'default'
     model : Optional(transformers.PreTrainedModel)
-        The pre-trained Transformer model. This parameter is required for training. The default value is None.
+        The pre-trained Transformer model. If None, each run loads its model and training data in the flow. The default value is None.
     tokenizer : Optional(transformers.PreTrainedTokenizer)
         The tokenizer used to preprocess the data for the model.
     train_dataset : torch.utils.data.TensorDataset
-        The training dataset. This parameter is required for training. The default value is None.
+        The training dataset, required along with the model. The default value is None.
+    aug_configs : Optional(List[Dict])
+        Arguments of several training runs, see `get_run_args`. Each run loads its own model and data, and is trained and evaluated separately. The default value is None.
 
     Returns
     -------
@@ -392,29 +1042,26 @@ def build_flow(
         A prefect Flow object contained the specified steps and parameters
     """
     model_args, training_args = args
+    if not (training_args.do_train or training_args.do_eval):
+        logging.error('Flow must be instantiated with at least one of \"do_train\", \"do_eval\"')
+        return None
+
     with Flow(label) as f:
-        if training_args.do_eval and training_args.do_train:
-            res = eval_task(
+        runs = get_run_args(args, aug_configs) if aug_configs else [args]
+        upstream_tasks = None
+        if training_args.do_train and (aug_configs or model is None):
+            runs = train_run_task.map(augment_task.map(runs))
+        elif training_args.do_train:
+            upstream_tasks = [
+                train_task(
                     (model_args, training_args),
-                    upstream_tasks=[
-                        train_task(
-                            (model_args, training_args),
-                            model,
-                            tokenizer,
-                            train_dataset
-                        )
-                    ]
+                    model,
+                    tokenizer,
+                    train_dataset
                 )
-        elif training_args.do_eval:
-            res = eval_task((model_args, training_args))
-        elif training_args.do_train:
-            res = train_task(
-                        (model_args, training_args),
-                        model,
-                        tokenizer,
-                        train_dataset
-                    )
-        else:
-            f = None
-            logging.error('Flow must be instantiated with at least one of \"do_train\", \"do_eval\"')
+            ]
+        if training_args.do_eval:
+            eval_jobs = list_eval_jobs_task(runs, upstream_tasks=upstream_tasks)
+            jobs, eval_keys = eval_jobs[0], eval_jobs[1]
+            res = collect_eval_results_task(jobs, eval_job_task.map(jobs, eval_keys))
     return f
@@ -0,0 +1,145 @@
+import copy
+import io
+import json
+import pytest
+import pkg_resources
+from transformers import DistilBertTokenizer
+from transformers.data.processors.squad import SquadV1Processor
+from kitanaqa.trainer import alum_squad_processor
+from kitanaqa.trainer.alum_squad_processor import (
+    _iter_squad_entries,
+    alum_squad_convert_examples_to_features,
+    AlumSquadV1Processor,
+)
+
+DATA_PATH = pkg_resources.resource_filename(
+            'kitanaqa', 'support/unittest-squad.json')
+
+
+def _get_examples():
+    processor = AlumSquadV1Processor()
+    return processor.alum_get_dev_examples(None, filename=DATA_PATH)
+
+
+def test_fast_features_match_slow_features():
+    tokenizer = DistilBertTokenizer.from_pretrained('distilbert-base-uncased')
+    examples = _get_examples()
+    # A short max_seq_length splits each context over several windows
+    featurize_args = {
+        "max_seq_length": 64,
+        "doc_stride": 16,
+        "max_query_length": 16,
+        "tqdm_enabled": False,
+    }
+    slow_features = alum_squad_convert_examples_to_features(examples, tokenizer, **featurize_args)
+    fast_features = alum_squad_convert_examples_to_features(
+                                        examples,
+                                        tokenizer,
+                                        use_fast_tokenizer=True,
+                                        batch_size=3,
+                                        **featurize_args)
+
+    assert len(slow_features) == len(fast_features)
+    for slow_feature, fast_feature in zip(slow_features, fast_features):
+        assert vars(slow_feature) == vars(fast_feature)
+
+
+def test_shared_context_cache_matches_slow_features():
+    tokenizer = DistilBertTokenizer.from_pretrained('distilbert-base-uncased')
+    examples = _get_examples()
+    # Augmented examples ask new questions about the same contexts
+    aug_examples = copy.deepcopy(examples)
+    for example in aug_examples:
+        example.question_text = " ".join(example.question_text.split()[1:])
+    featurize_args = {
+        "max_seq_length": 64,
+        "doc_stride": 16,
+        "max_query_length": 16,
+        "tqdm_enabled": False,
+    }
+    context_cache = {}
+    alum_squad_convert_examples_to_features(examples, tokenizer, context_cache=context_cache, **featurize_args)
+    num_contexts = len(context_cache)
+    cached_features = alum_squad_convert_examples_to_features(
+                                        aug_examples,
+                                        tokenizer,
+                                        context_cache=context_cache,
+                                        **featurize_args)
+    slow_features = alum_squad_convert_examples_to_features(aug_examples, tokenizer, **featurize_args)
+
+    assert len(context_cache) == num_contexts
+    assert len(slow_features) == len(cached_features)
+    for slow_feature, cached_feature in zip(slow_features, cached_features):
+        assert vars(slow_feature) == vars(cached_feature)
+
+
+def test_batched_features_match_slow_features_with_threads(monkeypatch):
+    # Featurise in 2 processes, even on a single core machine
+    monkeypatch.setattr(alum_squad_processor, 'cpu_count', lambda: 2)
+    tokenizer = DistilBertTokenizer.from_pretrained('distilbert-base-uncased')
+    examples = _get_examples()
+    featurize_args = {
+        "max_seq_length": 64,
+        "doc_stride": 16,
+        "max_query_length": 16,
+        "tqdm_enabled": False,
+        "threads": 2,
+    }
+    slow_features = alum_squad_convert_examples_to_features(examples, tokenizer, **featurize_args)
+    context_cache = {}
+    batched_features = alum_squad_convert_examples_to_features(
+                                        examples,
+                                        tokenizer,
+                                        batch_size=3,
+                                        context_cache=context_cache,
+                                        **featurize_args)
+
+    # The contexts encoded by the workers are added to the caller's cache
+    assert len(context_cache) == len({(example.title, example.context_text) for example in examples})
+    assert len(slow_features) == len(batched_features)
+    for slow_feature, batched_feature in zip(slow_features, batched_features):
+        assert vars(slow_feature) == vars(batched_feature)
+
+
+def test_streamed_entries_match_json_load():
+    with open(DATA_PATH, 'r') as f:
+        raw = f.read()
+    # Small chunks force entries to be decoded across several reads
+    entries = list(_iter_squad_entries(io.StringIO(raw), chunk_size=64))
+    assert entries == json.loads(raw)['data']
+
+
+class _ReadSizeRecorder(io.StringIO):
+    """ A text reader recording the size of each read """
+    def __init__(self, text):
+        super().__init__(text)
+        self.read_sizes = []
+
+    def read(self, size=-1):
+        self.read_sizes.append(size)
+        return super().read(size)
+
+
+def test_streamed_entry_spanning_several_chunks():
+    # A top-level string value before the data array looks like its key
+    squad = {
+        "version": "\"data\": [\"not an entry\"]",
+        "data": [{"title": "long", "context": "word " * 2000}, {"title": "short"}],
+    }
+    reader = _ReadSizeRecorder(json.dumps(squad))
+    entries = list(_iter_squad_entries(reader, chunk_size=16))
+    assert entries == squad["data"]
+    # Reads double while the long entry is incomplete, rather than adding a chunk at a time
+    assert max(reader.read_sizes) > 16
+    assert len(reader.read_sizes) < 40
+
+
+def test_streamed_examples_match_eager_examples():
+    streamed_examples = list(AlumSquadV1Processor().alum_iter_examples(None, filename=DATA_PATH))
+    eager_examples = SquadV1Processor().get_train_examples(None, filename=DATA_PATH)
+    assert len(streamed_examples) == len(eager_examples)
+    for streamed, eager in zip(streamed_examples, eager_examples):
+        assert streamed.qas_id == eager.qas_id
+        assert streamed.doc_tokens == eager.doc_tokens
+        assert streamed.start_position == eager.start_position
+        assert streamed.end_position == eager.end_position
@@ -0,0 +1,61 @@
+import pytest
+import torch
+from transformers import BertConfig, BertForQuestionAnswering
+from kitanaqa.trainer.attack import PGDAttack, get_embed_layer, get_step_schedule
+
+
+def _get_model_and_batch(batch_size=3, seq_length=16):
+    torch.manual_seed(0)
+    config = BertConfig(
+                vocab_size=100,
+                hidden_size=32,
+                num_hidden_layers=2,
+                num_attention_heads=2,
+                intermediate_size=64)
+    model = BertForQuestionAnswering(config)
+    model.eval()
+    input_ids = torch.randint(1, 100, (batch_size, seq_length))
+    attention_mask = torch.ones(batch_size, seq_length, dtype=torch.long)
+    # The last example is padded
+    attention_mask[-1, seq_length // 2:] = 0
+    token_type_ids = torch.zeros(batch_size, seq_length, dtype=torch.long)
+    start_positions = torch.randint(0, seq_length // 2, (batch_size,))
+    end_positions = start_positions + 1
+    return model, (input_ids, attention_mask, token_type_ids, start_positions, end_positions)
+
+
+@pytest.mark.parametrize("norm", ["inf", "2"])
+def test_pgd_attack_bounds(norm):
+    model, batch = _get_model_and_batch()
+    eps = 1e-2
+    attack = PGDAttack(
+                model,
+                get_embed_layer(model, 'bert'),
+                'bert',
+                eps=eps,
+                step_size=5e-3,
+                num_steps=3,
+                sigma=1e-3,
+                norm=norm)
+    input_embedding, delta = attack.perturb(batch)
+
+    assert delta.shape == input_embedding.shape
+    # Padding is not perturbed
+    assert torch.all(delta[-1, batch[0].size(1) // 2:] == 0)
+    if norm == "inf":
+        assert delta.abs().max() <= eps + 1e-6
+    else:
+        assert torch.all(delta.flatten(1).norm(dim=1) <= eps + 1e-6)
+    # Model parameter gradients are left untouched
+    assert all(param.grad is None for param in model.parameters())
+
+    start_logits, end_logits = attack(batch)
+    assert start_logits.shape == batch[0].shape
+    assert end_logits.shape == batch[0].shape
+
+
+def test_step_schedule():
+    assert list(get_step_schedule(3, 1.)) == [1., 1., 1.]
+    steps = list(get_step_schedule(3, 1., 3., schedule='linear'))
+    assert steps == pytest.approx([1., 2., 3.])
+    assert list(get_step_schedule(1, 1., 3., schedule='linear')) == [1.]
@@ -66,3 +66,50 @@ def test_generate():
     }
     model_tester = AugSquadTester(**hparams)
     model_tester.generate_and_check_results()
+
+
+def test_iter_generate():
+    data_file = pkg_resources.resource_filename(
+        'kitanaqa', 'support/train-v1.1.json')
+    with open(data_file, 'r') as f:
+        examples = json.load(f)
+    generator = SQuADDataset(
+                    examples,
+                    num_replacements=1,
+                    sample_ratio=0.0001,
+                    sampling_strategy='random',
+                    is_training=True)
+    aug_examples = list(generator.iter_generate())
+    assert len(aug_examples) <= generator.num_aug_examples
+    for aug_example in aug_examples:
+        assert aug_example['ctx_id'] in generator.context_map
+        assert aug_example['tle_id'] in generator.title_map
+        assert isinstance(aug_example['question'], str)
+        assert 'is_impossible' in aug_example
+    # Nothing is kept by the generator
+    assert generator.aug_dataset == []
+
+
+def test_generate_drop_perturbations(tmpdir, monkeypatch):
+    monkeypatch.chdir(tmpdir)
+    data_file = pkg_resources.resource_filename(
+        'kitanaqa', 'support/unittest-squad.json')
+    with open(data_file, 'r') as f:
+        examples = json.load(f)
+    generator = SQuADDataset(
+                    examples,
+                    num_replacements=2,
+                    sample_ratio=2.,
+                    p_replace=0.,
+                    p_dropword=0.,
+                    p_misspelling=1.,
+                    is_training=True,
+                    out_prefix='unittest',
+                    verbose=True)
+    generator.generate()
+    assert len(generator.dataset) == generator.num_aug_examples
+    # The drop perturbations added to each misspelled question are questions in their own right
+    for aug_example in generator.dataset:
+        assert isinstance(aug_example['question'], str)
+    with open('unittest_aug_squad_v1.json', 'r') as f:
+        assert json.load(f) == generator()
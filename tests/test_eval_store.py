@@ -0,0 +1,36 @@
+import types
+from kitanaqa.trainer.eval_store import EvalResultStore, eval_args_hash
+
+
+def test_eval_result_store(tmpdir):
+    path = str(tmpdir.join("eval_results.jsonl"))
+    key = EvalResultStore.make_key("weights", "predict_file", "eval_args", False)
+    adv_key = EvalResultStore.make_key("weights", "predict_file", "eval_args", True)
+
+    store = EvalResultStore(path)
+    assert store.get(key) is None
+    store.put(key, {"exact": 50., "f1": 60.}, checkpoint="checkpoint-10", predict_set="dev")
+
+    # An interrupted write leaves an incomplete last line, which is skipped
+    with open(path, "a") as f:
+        f.write('{"weights_hash": "wei')
+    store = EvalResultStore(path)
+    assert store.get(key) == {"exact": 50., "f1": 60.}
+    assert store.get(adv_key) is None
+
+    store.put(adv_key, {"exact": 40., "f1": 45.})
+    store = EvalResultStore(path)
+    assert store.get(key) == {"exact": 50., "f1": 60.}
+    assert store.get(adv_key) == {"exact": 40., "f1": 45.}
+
+
+def test_eval_args_hash():
+    args = types.SimpleNamespace(n_best_size=20, max_answer_length=30, eps=1e-5)
+    args_hash = eval_args_hash(args, adv=False)
+    adv_args_hash = eval_args_hash(args, adv=True)
+    # Attack parameters only change the key of adversarial evaluations
+    args.eps = 1e-4
+    assert eval_args_hash(args, adv=False) == args_hash
+    assert eval_args_hash(args, adv=True) != adv_args_hash
+    args.n_best_size = 10
+    assert eval_args_hash(args, adv=False) != args_hash
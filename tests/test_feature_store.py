@@ -0,0 +1,42 @@
+import pickle
+import pytest
+import torch
+from torch.utils.data import TensorDataset
+from kitanaqa.trainer.feature_store import FeatureStore, feature_store_exists, save_feature_store
+
+
+def _dataset(num_features, seq_length=16):
+    return TensorDataset(
+        torch.randint(0, 30000, (num_features, seq_length)),
+        torch.ones(num_features, seq_length, dtype=torch.long),
+        torch.zeros(num_features, seq_length, dtype=torch.long),
+        torch.randint(0, seq_length, (num_features,)),
+        torch.randint(0, seq_length, (num_features,)),
+        torch.arange(num_features),
+        torch.zeros(num_features, dtype=torch.long),
+        torch.randint(0, 2, (num_features, seq_length)).float(),
+        torch.zeros(num_features),
+    )
+
+
+def test_feature_store(tmpdir):
+    dataset = _dataset(10)
+    path = str(tmpdir.join("cached_train_store"))
+    assert not feature_store_exists(path)
+    save_feature_store(dataset, path)
+    store = FeatureStore(path)
+    assert len(store) == len(dataset)
+    for i in (0, 9):
+        for stored, expected in zip(store[i], dataset[i]):
+            assert stored.dtype == expected.dtype
+            assert torch.equal(stored, expected)
+    # Workers receive the path of the store, not a copy of the features
+    assert pickle.loads(pickle.dumps(store))[3][0].tolist() == dataset[3][0].tolist()
+
+
+def test_feature_store_lossy_column(tmpdir):
+    dataset = _dataset(2)
+    tensors = list(dataset.tensors)
+    tensors[7] = tensors[7] * 0.5
+    with pytest.raises(ValueError):
+        save_feature_store(TensorDataset(*tensors), str(tmpdir.join("store")))
@@ -0,0 +1,63 @@
+import pytest
+import pkg_resources
+import torch
+from transformers import DistilBertConfig, DistilBertForQuestionAnswering, DistilBertTokenizer
+from kitanaqa.augment.importance_scores import (
+    ImportanceScorer,
+    _iter_squad_questions,
+    load_importance_scores,
+)
+
+DATA_PATH = pkg_resources.resource_filename(
+            'kitanaqa', 'support/unittest-squad.json')
+
+
+@pytest.fixture(scope="module")
+def scorer_inputs():
+    torch.manual_seed(0)
+    tokenizer = DistilBertTokenizer.from_pretrained('distilbert-base-uncased')
+    model = DistilBertForQuestionAnswering(DistilBertConfig(dim=32, n_layers=2, n_heads=2, hidden_dim=64))
+    return model, tokenizer
+
+
+def test_batched_scores(scorer_inputs):
+    model, tokenizer = scorer_inputs
+    questions = list(_iter_squad_questions(DATA_PATH))[:8]
+    scores = ImportanceScorer(model, tokenizer, 'distilbert', max_seq_length=64, batch_size=16).score(questions)
+    single_scores = ImportanceScorer(model, tokenizer, 'distilbert', max_seq_length=64, batch_size=1).score(questions)
+    for qid, question, _ in questions:
+        assert [term for term, _ in scores[qid]] == [term for term, _ in single_scores[qid]]
+        assert [score for _, score in scores[qid]] == pytest.approx([score for _, score in single_scores[qid]], abs=1e-5)
+
+
+def test_gradient_scores(scorer_inputs):
+    model, tokenizer = scorer_inputs
+    questions = list(_iter_squad_questions(DATA_PATH))[:8]
+    scores = ImportanceScorer(model, tokenizer, 'distilbert', max_seq_length=64, batch_size=16, mode='gradient').score(questions)
+    single_scores = ImportanceScorer(model, tokenizer, 'distilbert', max_seq_length=64, batch_size=1, mode='gradient').score(questions)
+    mask_scores = ImportanceScorer(model, tokenizer, 'distilbert', max_seq_length=64).score(questions)
+    for qid, question, _ in questions:
+        assert [term for term, _ in scores[qid]] == [term for term, _ in mask_scores[qid]]
+        assert [score for _, score in scores[qid]] == pytest.approx([score for _, score in single_scores[qid]], abs=1e-5)
+    assert all(p.grad is None for p in model.parameters())
+
+
+def test_invalid_mode(scorer_inputs):
+    model, tokenizer = scorer_inputs
+    with pytest.raises(ValueError):
+        ImportanceScorer(model, tokenizer, 'distilbert', mode='saliency')
+
+def test_score_file_resumes(scorer_inputs, tmpdir):
+    model, tokenizer = scorer_inputs
+    output_file = str(tmpdir.join("scores.jsonl"))
+    scorer = ImportanceScorer(model, tokenizer, 'distilbert', max_seq_length=64)
+    scores = scorer.score_file(DATA_PATH, output_file, chunk_size=2)
+    assert load_importance_scores(output_file) == scores
+
+    # An interrupted run leaves an incomplete last chunk, which is scored again
+    with open(output_file) as f:
+        lines = f.read().splitlines()
+    with open(output_file, "w") as f:
+        f.write("\n".join(lines[:-1]) + "\n" + lines[-1][:10])
+    assert scorer.score_file(DATA_PATH, output_file, chunk_size=2) == scores
+    assert load_importance_scores(output_file) == scores
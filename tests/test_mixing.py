@@ -0,0 +1,51 @@
+import pytest
+import torch
+from torch.utils.data import TensorDataset
+from kitanaqa.trainer.mixing import MixedFeatureDataset, MixingSampler, get_mix_ratios
+
+
+def _mixed_dataset(num_orig, num_aug):
+    return MixedFeatureDataset(
+                TensorDataset(torch.arange(num_orig)),
+                TensorDataset(torch.arange(num_aug)))
+
+
+def test_mixing_sampler_ratio():
+    dataset = _mixed_dataset(100, 30)
+    sampler = MixingSampler(dataset, [0.5], num_replicas=1, rank=0)
+    assert len(sampler) == 150
+    indices = list(sampler)
+    assert len(indices) == 150
+    # Every original feature, and each augmented feature at most twice
+    assert sorted(i for i in indices if i < 100) == list(range(100))
+    assert max(indices.count(i) for i in range(100, 130)) == 2
+    sampler.set_epoch(1)
+    assert list(sampler) != indices
+
+
+def test_mixing_sampler_curriculum():
+    dataset = _mixed_dataset(100, 1000)
+    ratios = get_mix_ratios(3, 0.25, 1., 'linear')
+    assert ratios == pytest.approx([0.25, 0.625, 1.])
+    sampler = MixingSampler(dataset, ratios, num_replicas=1, rank=0)
+    for epoch in range(3):
+        sampler.set_epoch(epoch)
+        indices = list(sampler)
+        num_orig, num_aug = sampler.get_epoch_counts(epoch)
+        assert len(indices) == 125
+        assert sum(i >= 100 for i in indices) == num_aug
+        assert num_aug == pytest.approx(125 * ratios[epoch] / (1 + ratios[epoch]), abs=1)
+
+
+def test_mixing_sampler_replicas():
+    dataset = _mixed_dataset(51, 20)
+    samplers = [MixingSampler(dataset, [0.5], num_replicas=2, rank=rank) for rank in range(2)]
+    shares = [list(sampler) for sampler in samplers]
+    assert len(shares[0]) == len(shares[1]) == len(samplers[0])
+    assert {i for share in shares for i in share if i < 51} == set(range(51))
+
+
+def test_mixed_dataset_batched_reads():
+    dataset = _mixed_dataset(5, 3)
+    indices = [6, 0, 4, 5, 7, 1]
+    assert dataset.__getitems__(indices) == [dataset[i] for i in indices]
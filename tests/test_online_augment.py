@@ -0,0 +1,47 @@
+import math
+import pytest
+import pkg_resources
+from torch.utils.data import DataLoader
+from transformers import DistilBertTokenizer
+from kitanaqa.trainer.alum_squad_processor import (
+    alum_squad_convert_examples_to_features,
+    AlumSquadV1Processor,
+)
+from kitanaqa.trainer.online_augment import OnlineAugSquadDataset
+
+DATA_PATH = pkg_resources.resource_filename(
+            'kitanaqa', 'support/unittest-squad.json')
+
+
+@pytest.mark.parametrize("num_workers", [0, 2])
+def test_online_aug_epoch(num_workers):
+    tokenizer = DistilBertTokenizer.from_pretrained('distilbert-base-uncased')
+    examples = AlumSquadV1Processor().alum_get_dev_examples(None, filename=DATA_PATH)
+    featurize_args = {
+        "max_seq_length": 64,
+        "doc_stride": 16,
+        "max_query_length": 16,
+    }
+    dataset = OnlineAugSquadDataset(
+                            examples,
+                            tokenizer,
+                            sample_ratio=0.5,
+                            p_replace=0.,
+                            p_misspelling=0.,
+                            batch_size=4,
+                            **featurize_args)
+    _, orig_dataset = alum_squad_convert_examples_to_features(
+                                            examples,
+                                            tokenizer,
+                                            return_dataset="pt",
+                                            tqdm_enabled=False,
+                                            **featurize_args)
+
+    assert len(dataset) == len(orig_dataset) + math.ceil(len(orig_dataset) * 0.5)
+    batches = list(DataLoader(dataset, batch_size=8, num_workers=num_workers))
+    input_ids = [tuple(row.tolist()) for batch in batches for row in batch[0]]
+    # Every epoch has the exact length, and includes all the original features
+    assert len(input_ids) == len(dataset)
+    # Each worker yields a partial last batch
+    assert len(batches) == dataset.num_batches(8, num_workers)
+    assert {tuple(row[0].tolist()) for row in orig_dataset} <= set(input_ids)
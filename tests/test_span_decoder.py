@@ -0,0 +1,62 @@
+import numpy as np
+import pytest
+import pkg_resources
+from transformers import DistilBertTokenizer
+from transformers.data.processors.squad import SquadResult
+from transformers.data.metrics.squad_metrics import compute_predictions_logits
+from kitanaqa.trainer.alum_squad_processor import (
+    alum_squad_convert_examples_to_features,
+    AlumSquadV1Processor,
+)
+from kitanaqa.trainer.span_decoder import compute_predictions
+
+DATA_PATH = pkg_resources.resource_filename(
+            'kitanaqa', 'support/unittest-squad.json')
+
+
+@pytest.mark.parametrize("version_2_with_negative", [False, True])
+@pytest.mark.parametrize("n_best_size,max_answer_length", [(20, 30), (3, 2)])
+def test_predictions_match_compute_predictions_logits(version_2_with_negative, n_best_size, max_answer_length):
+    tokenizer = DistilBertTokenizer.from_pretrained('distilbert-base-uncased')
+    examples = AlumSquadV1Processor().alum_get_dev_examples(None, filename=DATA_PATH)
+    features = alum_squad_convert_examples_to_features(
+                                    examples,
+                                    tokenizer,
+                                    max_seq_length=64,
+                                    doc_stride=16,
+                                    max_query_length=16,
+                                    tqdm_enabled=False)
+    rng = np.random.RandomState(0)
+    # Rounded logits have ties, which must be broken in the same order
+    all_logits = np.round(rng.randn(len(features), 2, 64) * 3).astype(np.float32)
+    results = [
+        SquadResult(feature.unique_id, logits[0].tolist(), logits[1].tolist())
+        for feature, logits in zip(features, all_logits)
+    ]
+    decode_args = {
+        "n_best_size": n_best_size,
+        "max_answer_length": max_answer_length,
+        "do_lower_case": True,
+        "verbose_logging": False,
+        "version_2_with_negative": version_2_with_negative,
+        "null_score_diff_threshold": 0.,
+        "tokenizer": tokenizer,
+    }
+    expected = compute_predictions_logits(
+                            examples,
+                            features,
+                            results,
+                            output_prediction_file=None,
+                            output_nbest_file=None,
+                            output_null_log_odds_file=None,
+                            **decode_args)
+    # Rows of the logits do not need to follow the order of the features
+    feature_indices = rng.permutation(len(features))
+    predictions = compute_predictions(
+                            examples,
+                            features,
+                            feature_indices,
+                            all_logits[feature_indices],
+                            **decode_args)
+
+    assert predictions == expected
@@ -1,8 +1,12 @@
 import pytest
 import os
+import torch
 import shutil
 import pkg_resources
 import gc
+import pendulum
+from dask.base import tokenize
+from prefect.engine.state import Cached
 from transformers import (
     AlbertConfig,
     AlbertForQuestionAnswering,
@@ -17,8 +21,9 @@ from transformers import (
     TrainingArguments,
 )
 from kitanaqa.trainer.arguments import ModelArguments
-from kitanaqa.trainer.train import Trainer
-from kitanaqa.trainer.utils import load_and_cache_examples
+import kitanaqa.trainer.train as train_module
+from kitanaqa.trainer.train import Trainer, enable_gradient_checkpointing
+from kitanaqa.trainer.utils import _eval_key_validator, load_and_cache_examples
 
 MODEL_CLASSES = {
     "albert": (AlbertConfig, AlbertForQuestionAnswering, AlbertTokenizer),
@@ -66,7 +71,9 @@ class TrainerTester:
             max_steps,
             save_steps,
             seed,
-            fp16):
+            fp16,
+            adv_mode="alum",
+            K=1):
 
         args = {
             "model_type": model_type,
@@ -95,6 +102,8 @@ class TrainerTester:
             "save_steps": save_steps,
             "seed": seed,
             "fp16": fp16,
+            "adv_mode": adv_mode,
+            "K": K,
         }
         parser = HfArgumentParser(dataclass_types=[ModelArguments, TrainingArguments])
         self.model_args, self.training_args = parser.parse_dict(args)
@@ -245,6 +254,43 @@ def test_alum_train():
         gc.collect()
 
 
+def test_free_adv_train():
+        hparams = {
+            "model_type" : "distilbert",
+            "model_name_or_path" : "distilbert-base-uncased",
+            "output_dir" : "./unittest_outputs",
+            "cache_dir" : "./unittest_outputs",
+            "data_dir" : "./unittest_outputs",
+            "train_file_path" : TRAIN_PATH,
+            "predict_file_path" : {"dev-v1.1": EVAL_PATH},
+            "aug_file_path" : None,
+            "do_aug" : False,
+            "do_alum" : True,
+            "alpha" : 5,
+            "eps" : 1e-4,
+            "eta" : 1e-5,
+            "sigma" : 1e-3,
+            "do_train" : True,
+            "do_adv_eval" : False,
+            "do_eval" : False,
+            "per_device_train_batch_size" : 2,
+            "per_device_eval_batch_size" : 1,
+            "gradient_accumulation_steps" : 2,
+            "eval_all_checkpoints" : False,
+            "num_train_epochs" : 1,
+            "max_steps" : -1,
+            "save_steps" : 1,
+            "seed" : 512,
+            "fp16" : False,
+            "adv_mode" : "free",
+            "K" : 2
+        }
+        trainer = TrainerTester(**hparams)
+        trainer._train_and_check_results()
+        del trainer
+        gc.collect()
+
+
 def test_adv_eval():
         hparams = {
             "model_type" : "distilbert",
@@ -348,3 +394,126 @@ def test_regular_eval():
         trainer._eval_and_check_results()
 
         trainer._reset_env()
+
+
+def _get_tiny_bert_trainer(output_dir, model, batch_size, **model_kwargs):
+    """ A Trainer of a small, randomly initialised BERT, along with a batch of random training inputs """
+    seq_length = 16
+    train_dataset = torch.utils.data.TensorDataset(
+        torch.randint(1, model.config.vocab_size, (batch_size, seq_length)),
+        torch.ones(batch_size, seq_length, dtype=torch.long),
+        torch.zeros(batch_size, seq_length, dtype=torch.long),
+        torch.randint(0, seq_length, (batch_size,)),
+        torch.randint(0, seq_length, (batch_size,)),
+    )
+    model_args = ModelArguments(
+        model_type="bert",
+        model_name_or_path="bert-base-uncased",
+        train_file_path=TRAIN_PATH,
+        predict_file_path={},
+        do_alum=True,
+        **model_kwargs,
+    )
+    training_args = TrainingArguments(
+        output_dir=output_dir,
+        do_train=True,
+        no_cuda=True,
+        num_train_epochs=1,
+        per_device_train_batch_size=batch_size,
+    )
+    trainer = Trainer(
+        model_args=model_args,
+        data_collator=None,
+        model=model,
+        args=training_args,
+        train_dataset=train_dataset,
+        prediction_loss_only=True,
+    )
+    return trainer, train_dataset.tensors
+
+
+def test_alum_step_with_gradient_checkpointing(tmpdir):
+    torch.manual_seed(0)
+    config = BertConfig(vocab_size=100, hidden_size=32, num_hidden_layers=2, num_attention_heads=2, intermediate_size=64)
+    model = BertForQuestionAnswering(config)
+    trainer, batch = _get_tiny_bert_trainer(str(tmpdir), model, batch_size=2, K=2, gradient_checkpointing=True)
+    loss = trainer.training_step(model, batch)
+    assert torch.isfinite(loss)
+    assert all(param.grad is not None for param in model.qa_outputs.parameters())
+
+
+def test_checkpointed_layer_with_keyword_arguments(monkeypatch):
+    # As in torch < 1.13, where the non-reentrant checkpoint does not take keyword arguments for the function
+    def checkpoint(function, *args, use_reentrant=True, **kwargs):
+        if kwargs:
+            raise ValueError("Unexpected keyword arguments: " + ",".join(kwargs))
+        return torch.utils.checkpoint.checkpoint(function, *args, use_reentrant=use_reentrant)
+    monkeypatch.setattr(train_module, "checkpoint", checkpoint)
+
+    torch.manual_seed(0)
+    config = DistilBertConfig(vocab_size=100, dim=32, n_layers=1, n_heads=2, hidden_dim=64, dropout=0., attention_dropout=0.)
+    model = DistilBertForQuestionAnswering(config)
+    layer = model.distilbert.transformer.layer[0]
+    x = torch.randn(2, 8, 32, requires_grad=True)
+    attn_mask = torch.ones(2, 8)
+    expected = layer(x=x, attn_mask=attn_mask)[-1]
+
+    # DistilBERT calls its layers with keyword arguments only
+    enable_gradient_checkpointing(model, "distilbert")
+    model.train()
+    output = layer(x=x, attn_mask=attn_mask, head_mask=None, output_attentions=False)[-1]
+    assert torch.allclose(output, expected)
+    output.sum().backward()
+    assert x.grad is not None
+
+
+def test_free_step_requires_two_passes(tmpdir):
+    model = BertForQuestionAnswering(BertConfig(vocab_size=100, hidden_size=32, num_hidden_layers=2, num_attention_heads=2, intermediate_size=64))
+    with pytest.raises(ValueError):
+        _get_tiny_bert_trainer(str(tmpdir), model, batch_size=2, adv_mode="free", K=1)
+
+
+def test_free_step_ascends_the_loss(tmpdir):
+    torch.manual_seed(0)
+    # Without dropout and initial noise, the first replay gives the loss of the unperturbed inputs
+    config = BertConfig(vocab_size=100, hidden_size=32, num_hidden_layers=2, num_attention_heads=2, intermediate_size=64,
+                        hidden_dropout_prob=0., attention_probs_dropout_prob=0.)
+    model = BertForQuestionAnswering(config)
+    trainer, batch = _get_tiny_bert_trainer(str(tmpdir), model, batch_size=4, adv_mode="free", K=2, sigma=0., eta=1e-1, eps=1e-1)
+    with torch.no_grad():
+        clean_loss = model(
+            input_ids=batch[0],
+            attention_mask=batch[1],
+            token_type_ids=batch[2],
+            start_positions=batch[3],
+            end_positions=batch[4])[0]
+    loss = trainer.training_step(model, batch)
+    assert torch.isclose(loss, clean_loss)
+
+    # The next replay is perturbed by the delta carried over, after one ascent step
+    replay_loss = trainer.training_step(model, batch)
+    assert replay_loss > clean_loss
+    assert all(param.grad is not None and torch.all(torch.isfinite(param.grad)) for param in model.qa_outputs.parameters())
+
+
+def test_free_training_replays_each_batch(tmpdir):
+    model = BertForQuestionAnswering(BertConfig(vocab_size=100, hidden_size=32, num_hidden_layers=2, num_attention_heads=2, intermediate_size=64))
+    trainer, batch = _get_tiny_bert_trainer(str(tmpdir), model, batch_size=4, adv_mode="free", K=2)
+    # The epochs are divided by K, for the same number of optimizer steps as normal training
+    assert trainer.args.num_train_epochs == 0.5
+    dataloader = trainer.get_train_dataloader()
+    assert len(dataloader) == 2
+    first, replay = list(dataloader)
+    assert all(torch.equal(a, b) for a, b in zip(first, replay))
+
+
+def test_eval_job_cache_is_keyed_on_eval_key():
+    job = ("model_args", "training_args", "output/checkpoint-1", "dev")
+    state = Cached(
+        hashed_inputs={"job": tokenize(job), "eval_key": tokenize("weights-a")},
+        cached_result_expiration=pendulum.now("utc").add(days=1))
+    assert _eval_key_validator(state, {"job": job, "eval_key": "weights-a"}, {})
+    # The same checkpoint path with retrained weights has a new key
+    assert not _eval_key_validator(state, {"job": job, "eval_key": "weights-b"}, {})
+    # Jobs without a key are never served from the cache
+    assert not _eval_key_validator(state, {"job": job, "eval_key": None}, {})